@@ -0,0 +1,21 @@
+"""
+Autenticación de los endpoints admin con ADMIN_TOKEN
+
+La usan app.py y async_app.py (a los dos les alcanza con request.headers).
+Sin ADMIN_TOKEN configurado los endpoints admin responden 401: un deploy que
+se olvidó la variable no deja expuestos historiales, trazas ni el catálogo.
+"""
+
+import hmac
+import os
+
+
+def is_admin(req) -> bool:
+    """Valida el token de X-Admin-Token o Authorization: Bearer (sin ADMIN_TOKEN no pasa nadie)"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        return False
+
+    provided = req.headers.get("X-Admin-Token") or req.headers.get("Authorization", "").replace("Bearer ", "", 1)
+    # En bytes: con str compare_digest tira TypeError si alguno trae caracteres no ASCII
+    return hmac.compare_digest(provided.encode("utf-8"), admin_token.encode("utf-8"))
@@ -0,0 +1,110 @@
+"""
+Control de admisión a la IA con carriles de prioridad
+
+Cuando OpenRouter se pone lento las generaciones en curso y las colas de los
+ejecutores crecen, y todos los clientes esperan más. Antes de generar, cada
+mensaje pasa por acá con su carril:
+
+    alta    conversación nueva o pregunta de talle/stock (el cliente está por comprar)
+    normal  precios y marcas
+    baja    el resto (horarios, ubicación, envíos, pagos, charla)
+
+La carga es la mayor de en_curso / ADMISSION_MAX_INFLIGHT y
+cola / ADMISSION_MAX_QUEUE. Las dos cuentas son del proceso: el controlador
+es uno para todas las tiendas y la cola es la suma de sus ejecutores. Cada carril tiene un umbral de carga a partir
+del cual sus mensajes se responden sin la IA (respuesta de respaldo por
+palabras clave): baja primero, después normal y, con todo saturado, alta.
+Así las generaciones en curso quedan acotadas y lo que se sacrifica es lo
+que menos importa.
+"""
+
+import os
+import threading
+from typing import Callable, Dict, Optional
+
+import metrics
+
+LANE_HIGH = "alta"
+LANE_NORMAL = "normal"
+LANE_LOW = "baja"
+
+# Intenciones (openrouter.detect_intent) de clientes a mitad de compra
+HIGH_INTENTS = {"talla"}
+NORMAL_INTENTS = {"precio", "marca"}
+
+_shared: Optional["AdmissionController"] = None
+_shared_lock = threading.Lock()
+
+
+def lane_for(intent: str, new_conversation: bool) -> str:
+    """Carril de un mensaje según su intención y si el cliente recién empieza"""
+    if new_conversation or intent in HIGH_INTENTS:
+        return LANE_HIGH
+    if intent in NORMAL_INTENTS:
+        return LANE_NORMAL
+    return LANE_LOW
+
+
+class AdmissionController:
+    """Cuenta las generaciones en curso y decide, por carril, si un mensaje va a la IA"""
+
+    def __init__(self, max_inflight: int, max_queue: int = 0, thresholds: Dict[str, float] = None):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.thresholds = {LANE_HIGH: 1.0, LANE_NORMAL: 0.8, LANE_LOW: 0.5}
+        self.thresholds.update(thresholds or {})
+        self.inflight = 0
+        self._queue_depth: Optional[Callable[[], int]] = None
+        self._lock = threading.Lock()
+
+    def set_queue_function(self, function: Callable[[], int]):
+        """Cola que cuenta la carga (la de todas las tiendas, como inflight)"""
+        self._queue_depth = function
+
+    def load(self, queue_depth: int = 0, extra: int = 0) -> float:
+        """Carga (1.0 = al límite de generaciones en curso o de cola), contando extra generaciones más"""
+        load = (self.inflight + extra) / self.max_inflight
+        if self.max_queue > 0:
+            load = max(load, queue_depth / self.max_queue)
+        return load
+
+    def admit(self, lane: str, queue_depth: int = None) -> bool:
+        """Reserva un lugar para generar; False si el carril se descarta con esta carga"""
+        if queue_depth is None:
+            queue_depth = self._queue_depth() if self._queue_depth else 0
+
+        with self._lock:
+            # Contando el lugar que ocuparía este mensaje: ningún carril pasa su umbral
+            admitted = self.load(queue_depth, extra=1) <= self.thresholds[lane]
+            if admitted:
+                self.inflight += 1
+
+        metrics.ADMISSION.inc(lane, "admitido" if admitted else "descartado")
+        return admitted
+
+    def release(self):
+        """Libera el lugar de una generación que terminó"""
+        with self._lock:
+            self.inflight -= 1
+
+
+def get_controller() -> Optional[AdmissionController]:
+    """Controlador del proceso según las variables de entorno (None si está desactivado)"""
+    global _shared
+
+    max_inflight = int(os.getenv("ADMISSION_MAX_INFLIGHT", 16))
+    if max_inflight <= 0:
+        return None
+
+    # Uno solo para todas las tiendas: comparten la IA
+    with _shared_lock:
+        if _shared is None:
+            _shared = AdmissionController(
+                max_inflight,
+                max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", 50)),
+                thresholds={
+                    LANE_NORMAL: float(os.getenv("ADMISSION_SHED_NORMAL", 0.8)),
+                    LANE_LOW: float(os.getenv("ADMISSION_SHED_LOW", 0.5))
+                }
+            )
+        return _shared
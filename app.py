@@ -1,23 +1,134 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 import os
+import json
+import threading
+import time
 from dotenv import load_dotenv
-from whatsapp import WhatsAppAPI
-from database import Database
+from catalog_import import CatalogImporter, CatalogImportError, text_stream
+import catalog_import
+from reservations import ReservationError
+from admin_auth import is_admin
+from tenants import load_tenants
+from log_setup import setup_logging
+import metrics
+import tracing
+import webhook_events
+import write_buffer
 import logging
 
 # Cargar variables de entorno
 load_dotenv()
 
-# Configurar logging
-logging.basicConfig(level=logging.INFO)
+# Configurar logging (estructurado y fuera de los hilos de request)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Inicializar Flask app
 app = Flask(__name__)
 
-# Inicializar servicios
-whatsapp_api = WhatsAppAPI()
-db = Database()
+# Tiendas (una o varias sucursales); cada una con su base, caches, ejecutor y credenciales
+tenants = load_tenants(serialize=app.json.dumps)
+
+# Servicios de la tienda predeterminada (la única si no hay TENANTS_FILE)
+default_tenant = tenants.default
+whatsapp_api = default_tenant.whatsapp
+db = default_tenant.db
+
+metrics.QUEUE_DEPTH.set_function(tenants.queue_depth)
+tracing.set_persister(db.save_trazas)
+
+# Tareas de fondo de cada tienda: archivador (0 días lo desactiva) y barredor de reservas
+background_stops = []
+for tenant in tenants:
+    if float(os.getenv("ARCHIVE_AFTER_DAYS", 90)) > 0:
+        background_stops.append(tenant.archive.start(
+            older_than_days=float(os.getenv("ARCHIVE_AFTER_DAYS", 90)),
+            interval=float(os.getenv("ARCHIVE_INTERVAL_HOURS", 24)) * 3600
+        ))
+    background_stops.append(tenant.reservations.start(interval=float(os.getenv("RESERVATION_SWEEP_SECONDS", 30))))
+
+# Estados de entrega (sent/delivered/read): guardarlos o descartarlos sin procesar
+record_statuses = os.getenv("RECORD_MESSAGE_STATUSES", "true").lower() == "true"
+
+# Paginación de los endpoints de lectura
+MAX_PAGE_SIZE = 200
+# Versiones del catálogo de las que depende /products (el stock cambia con cada reserva)
+PRODUCT_VERSIONS = ("productos", "stock")
+PAGINATED_PRODUCT_ARGS = ("cursor", "limit", "sort", "precio_min", "precio_max", "talla", "color")
+
+# Se pone en False al apagar: los webhooks nuevos reciben 503 y WhatsApp los reintenta
+accepting_webhooks = True
+
+def shutdown(timeout: float = None) -> bool:
+    """Deja de aceptar webhooks y termina las respuestas en curso"""
+    global accepting_webhooks
+    accepting_webhooks = False
+    
+    logger.info("Apagando: procesando mensajes pendientes...")
+    
+    for stop in background_stops:
+        stop.set()
+    
+    # Las ráfagas que estaban esperando se responden ya; lo que siga en los shards se responde sin ventana
+    for tenant in tenants:
+        if tenant.whatsapp.coalescer:
+            tenant.whatsapp.coalescer.flush_all()
+    
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    drained = True
+    for tenant in tenants:
+        remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+        drained = tenant.executor.shutdown(wait=True, timeout=remaining) and drained
+    
+    # Lo que quedó en el buffer de escritura se guarda antes de salir
+    drained = write_buffer.close_all(timeout) and drained
+    
+    if drained:
+        logger.info("Mensajes pendientes procesados")
+    else:
+        logger.error("Timeout esperando mensajes pendientes")
+    
+    return drained
+
+_shutdown_thread = None
+_shutdown_deadline = None
+
+def begin_shutdown(timeout: float = None) -> threading.Thread:
+    """Deja de aceptar webhooks ya mismo y vacía las colas en segundo plano (al recibir SIGTERM)"""
+    global accepting_webhooks, _shutdown_thread, _shutdown_deadline
+    accepting_webhooks = False
+    
+    if _shutdown_thread is None:
+        _shutdown_deadline = time.monotonic() + timeout if timeout is not None else None
+        _shutdown_thread = threading.Thread(target=shutdown, args=(timeout,), name="shutdown", daemon=True)
+        _shutdown_thread.start()
+    return _shutdown_thread
+
+def wait_shutdown(timeout: float = None) -> bool:
+    """Espera el vaciado empezado con begin_shutdown, sin pasarse del plazo que se le dio al empezar"""
+    thread = begin_shutdown(timeout)
+    remaining = max(_shutdown_deadline - time.monotonic(), 0) if _shutdown_deadline is not None else None
+    thread.join(remaining)
+    return not thread.is_alive()
+
+class UnknownTenant(Exception):
+    """?tienda= no corresponde a ninguna tienda configurada"""
+
+def request_tenant():
+    """Tienda del request (?tienda=<id>; sin el parámetro, la predeterminada)"""
+    tenant_id = request.args.get("tienda")
+    if not tenant_id:
+        return default_tenant
+    
+    tenant = tenants.get(tenant_id)
+    if tenant is None:
+        raise UnknownTenant(tenant_id)
+    return tenant
+
+@app.errorhandler(UnknownTenant)
+def unknown_tenant(error):
+    """Tienda inexistente"""
+    return jsonify({"error": f"Store not found: {error}"}), 404
 
 @app.route("/", methods=["GET"])
 def home():
@@ -37,7 +148,7 @@ def verify_webhook():
         token = request.args.get("hub.verify_token")
         challenge = request.args.get("hub.challenge")
         
-        logger.info(f"Verificando webhook: mode={mode}, token={token}")
+        logger.info("Verificando webhook: mode=%s", mode)
         
         # Verificar webhook
         result = whatsapp_api.verify_webhook(mode, token, challenge)
@@ -56,32 +167,53 @@ def verify_webhook():
 @app.route("/webhook", methods=["POST"])
 def webhook():
     """Recibe mensajes de WhatsApp"""
+    with metrics.stage("webhook"):
+        return handle_webhook(time.perf_counter())
+
+def handle_webhook(received_at: float):
+    """Clasifica el payload del webhook y encola los mensajes"""
     try:
-        # Obtener datos del webhook
-        data = request.get_json()
+        if not accepting_webhooks:
+            return "Shutting down", 503
         
-        if not data:
+        raw = request.get_data()
+        
+        if not raw:
             logger.warning("No data received in webhook")
             return "No data", 400
         
-        logger.info(f"Webhook data received: {data}")
-        
-        # Verificar si es un mensaje válido
-        if "entry" in data:
-            for entry in data["entry"]:
-                if "changes" in entry:
-                    for change in entry["changes"]:
-                        if "value" in change and "messages" in change["value"]:
-                            messages = change["value"]["messages"]
-                            
-                            for message in messages:
-                                # Procesar mensaje
-                                success = whatsapp_api.process_message(message)
-                                
-                                if success:
-                                    logger.info("Mensaje procesado exitosamente")
-                                else:
-                                    logger.error("Error procesando mensaje")
+        # Camino rápido: los callbacks de estado son la mayoría del tráfico
+        kind = webhook_events.classify(raw)
+        metrics.WEBHOOK_EVENTS.inc(kind)
+        
+        if kind == webhook_events.KIND_OTHER or (kind == webhook_events.KIND_STATUSES and not record_statuses):
+            return "OK", 200
+        
+        data = webhook_events.parse(raw)
+        
+        if not data:
+            logger.warning("Invalid JSON received in webhook")
+            return "No data", 400
+        
+        # Cada evento va a la tienda dueña del número que lo recibió
+        groups = webhook_events.split_by_number(data)
+        overloaded = False
+        
+        for phone_number_id, (messages, statuses) in groups.items():
+            tenant = tenants.resolve(phone_number_id)
+            
+            # Todos los estados del payload en una sola escritura
+            if statuses and record_statuses:
+                tenant.db.save_estados(statuses)
+            
+            if messages:
+                logger.debug("Webhook data received: %s", data, extra={"event": "webhook_payload"})
+                if not enqueue_messages(tenant, messages, received_at):
+                    overloaded = True
+        
+        # Sin 2xx WhatsApp reintenta: los que sí se encolaron salen como duplicados
+        if overloaded:
+            return "Overloaded", 503
         
         return "OK", 200
         
@@ -89,9 +221,46 @@ def webhook():
         logger.error(f"Error procesando webhook: {str(e)}")
         return "Error", 500
 
+def enqueue_messages(tenant, messages: list, received_at: float) -> bool:
+    """Encola los mensajes en el ejecutor de la tienda (un shard por conversación); False si alguno no entró"""
+    all_queued = True
+    for message in messages:
+        # Ignorar reintentos de mensajes que ya recibimos
+        message_id = message.get("id")
+        if message_id and not tenant.db.mark_message_processed(message_id):
+            logger.info(f"Mensaje duplicado ignorado: {message_id}")
+            continue
+        
+        metrics.TENANT_MESSAGES.inc(tenant.id)
+        
+        # La traza del mensaje arranca al recibir el webhook
+        trace = tracing.new_trace(
+            "mensaje",
+            start=received_at,
+            phone_number=message.get("from"),
+            message_id=message_id,
+            tenant=tenant.id
+        )
+        trace.mark("webhook")
+        
+        # Encolar mensaje en el shard de su conversación
+        queued = tenant.executor.submit(message.get("from", ""), tenant.whatsapp.process_message, message, trace)
+        
+        if queued:
+            logger.debug("Mensaje encolado para procesar")
+        else:
+            logger.error("Error encolando mensaje")
+            # Se desmarca para que el reintento de WhatsApp no se descarte como duplicado
+            if message_id:
+                tenant.db.unmark_message_processed(message_id)
+            all_queued = False
+    
+    return all_queued
+
 @app.route("/send-message", methods=["POST"])
 def send_message():
     """Endpoint para enviar mensajes manualmente (para testing)"""
+    tenant = request_tenant()
     try:
         data = request.get_json()
         
@@ -101,7 +270,7 @@ def send_message():
         to = data["to"]
         message = data["message"]
         
-        success = whatsapp_api.send_message(to, message)
+        success = tenant.whatsapp.send_message(to, message)
         
         if success:
             return jsonify({"status": "success", "message": "Message sent"})
@@ -115,39 +284,74 @@ def send_message():
 @app.route("/products", methods=["GET"])
 def get_products():
     """Endpoint para obtener productos"""
+    tenant = request_tenant()
     try:
-        categoria = request.args.get("categoria")
-        marca = request.args.get("marca")
-        search = request.args.get("search")
-        
-        if search:
-            products = db.buscar_productos(search)
-        else:
-            products = db.get_productos(categoria, marca)
-        
-        return jsonify({
-            "status": "success",
-            "products": products,
-            "count": len(products)
-        })
+        return tenant.catalog_cache.respond(request, PRODUCT_VERSIONS, lambda: build_products_payload(tenant.db))
         
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error obteniendo productos: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def build_products_payload(db):
+    """Arma la respuesta de /products según los parámetros del request"""
+    categoria = request.args.get("categoria")
+    marca = request.args.get("marca")
+    search = request.args.get("search")
+    
+    # Con cualquiera de estos parámetros la respuesta se pagina por cursor
+    if not search and any(name in request.args for name in PAGINATED_PRODUCT_ARGS):
+        page = db.get_productos_pagina(
+            cursor=request.args.get("cursor"),
+            limit=min(request.args.get("limit", 50, type=int), MAX_PAGE_SIZE),
+            sort=request.args.get("sort", "id"),
+            categoria=categoria,
+            marca=marca,
+            precio_min=request.args.get("precio_min", type=float),
+            precio_max=request.args.get("precio_max", type=float),
+            talla=request.args.get("talla"),
+            color=request.args.get("color")
+        )
+        
+        return {
+            "status": "success",
+            "products": page["productos"],
+            "count": len(page["productos"]),
+            "next_cursor": page["next_cursor"]
+        }
+    
+    if search:
+        products = db.buscar_productos(search)
+    else:
+        products = db.get_productos(categoria, marca)
+    
+    return {
+        "status": "success",
+        "products": products,
+        "count": len(products)
+    }
+
 @app.route("/products/<int:product_id>", methods=["GET"])
 def get_product(product_id):
     """Endpoint para obtener un producto específico"""
+    tenant = request_tenant()
     try:
-        product = db.get_producto_por_id(product_id)
-        
-        if product:
-            return jsonify({
+        def build():
+            product = tenant.db.get_producto_por_id(product_id)
+            if not product:
+                return None
+            return {
                 "status": "success",
                 "product": product
-            })
-        else:
+            }
+        
+        response = tenant.catalog_cache.respond(request, PRODUCT_VERSIONS, build)
+        
+        if response is None:
             return jsonify({"error": "Product not found"}), 404
+        
+        return response
             
     except Exception as e:
         logger.error(f"Error obteniendo producto: {str(e)}")
@@ -156,34 +360,219 @@ def get_product(product_id):
 @app.route("/store", methods=["GET"])
 def get_store_info():
     """Endpoint para obtener información de la tienda"""
+    tenant = request_tenant()
     try:
-        store_info = db.get_tienda_info()
+        return tenant.catalog_cache.respond(request, ("tienda",), lambda: {
+            "status": "success",
+            "store": tenant.db.get_tienda_info()
+        })
+        
+    except Exception as e:
+        logger.error(f"Error obteniendo información de la tienda: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/facets", methods=["GET"])
+def get_facets():
+    """Facetas del catálogo: precios y tallas por marca y categoría"""
+    tenant = request_tenant()
+    try:
+        return tenant.catalog_cache.respond(request, ("productos", "facetas"), lambda: {
+            "status": "success",
+            "facets": tenant.db.get_facetas()
+        })
+        
+    except Exception as e:
+        logger.error(f"Error obteniendo facetas: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admin/catalog/import", methods=["POST"])
+def import_catalog():
+    """Importa un feed de productos (CSV o NDJSON) leyendo el cuerpo en streaming"""
+    if not is_admin(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    tenant = request_tenant()
+    try:
+        fmt = request.args.get("format") or ("csv" if "csv" in (request.content_type or "") else "ndjson")
+        importer = CatalogImporter(tenant.db.storage)
+        report = importer.run(
+            text_stream(request.stream),
+            fmt,
+            mode=request.args.get("mode", "upsert"),
+            max_errors=request.args.get("max_errors", type=int),
+            job_id=request.args.get("job_id")
+        )
+        
+        # Las respuestas cacheadas del catálogo quedan viejas
+        tenant.invalidate_caches()
+        
+        status = 200 if report["status"] == "done" else 422
+        return jsonify({"status": "success" if status == 200 else "error", "import": report}), status
+        
+    except CatalogImportError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error importando catálogo: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admin/catalog/import/<job_id>", methods=["GET"])
+def import_catalog_status(job_id):
+    """Progreso de una importación (en curso o reciente)"""
+    if not is_admin(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    report = catalog_import.jobs.get(job_id)
+    if not report:
+        return jsonify({"error": "Import not found"}), 404
+    
+    return jsonify({"status": "success", "import": report})
+
+# Código de error de una reserva → status HTTP
+RESERVATION_STATUS = {
+    "sin_stock": 409,
+    "estado": 409,
+    "vencida": 410,
+    "no_encontrada": 404,
+    "cantidad_invalida": 400
+}
+
+@app.route("/reservations", methods=["POST"])
+def create_reservation():
+    """Reserva stock de un producto en una talla (queda apartado RESERVATION_TTL_MINUTES)"""
+    if not is_admin(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    tenant = request_tenant()
+    try:
+        data = request.get_json(silent=True) or {}
+        missing = [field for field in ("phone", "product_id", "size") if field not in data]
+        if missing:
+            return jsonify({"error": f"Missing required fields: {', '.join(missing)}"}), 400
+        
+        reserva = tenant.reservations.reserve(
+            str(data["phone"]),
+            int(data["product_id"]),
+            str(data["size"]),
+            int(data.get("quantity", 1))
+        )
+        tenant.invalidate_caches()
+        return jsonify({"status": "success", "reservation": reserva}), 201
+        
+    except ReservationError as e:
+        return jsonify({"error": str(e), "code": e.code}), RESERVATION_STATUS.get(e.code, 400)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error reservando stock: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/reservations/<reservation_id>", methods=["GET"])
+def get_reservation(reservation_id):
+    """Estado de una reserva"""
+    if not is_admin(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    reserva = request_tenant().reservations.get(reservation_id)
+    if not reserva:
+        return jsonify({"error": "Reservation not found"}), 404
+    
+    return jsonify({"status": "success", "reservation": reserva})
+
+@app.route("/reservations/<reservation_id>/<action>", methods=["POST"])
+def update_reservation(reservation_id, action):
+    """Confirma (confirm) o libera (release) una reserva activa"""
+    if not is_admin(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    if action not in ("confirm", "release"):
+        return jsonify({"error": "Endpoint not found"}), 404
+    
+    tenant = request_tenant()
+    try:
+        if action == "confirm":
+            reserva = tenant.reservations.confirm(reservation_id)
+        else:
+            reserva = tenant.reservations.release(reservation_id)
+        tenant.invalidate_caches()
+        return jsonify({"status": "success", "reservation": reserva})
+        
+    except ReservationError as e:
+        # Una reserva vencida al confirmar devolvió su stock: el catálogo cambió
+        tenant.invalidate_caches()
+        return jsonify({"error": str(e), "code": e.code}), RESERVATION_STATUS.get(e.code, 400)
+    except Exception as e:
+        logger.error(f"Error actualizando reserva: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admin/usage", methods=["GET"])
+def get_usage():
+    """Tokens y latencia de la IA por hora y modelo, por cliente o por intención"""
+    if not is_admin(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    tenant = request_tenant()
+    try:
+        group = request.args.get("group", "modelo")
+        hours = request.args.get("hours", 24, type=float)
+        
+        usage = tenant.db.get_uso_ia(
+            group=group,
+            desde=int(time.time() - hours * 3600),
+            limit=min(request.args.get("limit", 100, type=int), MAX_PAGE_SIZE)
+        )
         
         return jsonify({
             "status": "success",
-            "store": store_info
+            "group": group,
+            "hours": hours,
+            "usage": usage
         })
         
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logger.error(f"Error obteniendo información de la tienda: {str(e)}")
+        logger.error(f"Error obteniendo uso de la IA: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/conversations/<phone_number>", methods=["GET"])
 def get_conversations(phone_number):
     """Endpoint para obtener historial de conversaciones"""
+    if not is_admin(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    tenant = request_tenant()
     try:
-        limit = request.args.get("limit", 10, type=int)
-        conversations = db.get_conversation_history(phone_number, limit)
+        limit = min(request.args.get("limit", 10, type=int), MAX_PAGE_SIZE)
+        page = tenant.db.get_conversaciones_antes(phone_number, request.args.get("cursor"), limit)
         
         return jsonify({
             "status": "success",
-            "conversations": conversations
+            "conversations": page["conversaciones"],
+            "next_cursor": page["next_cursor"]
         })
         
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error obteniendo conversaciones: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/conversations/<phone_number>/export", methods=["GET"])
+def export_conversations(phone_number):
+    """Exporta el historial completo (archivado + actual) como NDJSON en streaming"""
+    if not is_admin(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    tenant = request_tenant()
+    
+    def generate():
+        for row in tenant.archive.iter_conversation(phone_number):
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename=conversaciones-{phone_number}.ndjson"}
+    )
+
 @app.route("/health", methods=["GET"])
 def health_check():
     """Endpoint de health check"""
@@ -194,7 +583,8 @@ def health_check():
         return jsonify({
             "status": "healthy",
             "database": "connected",
-            "store": "loaded" if store_info else "not_loaded"
+            "store": "loaded" if store_info else "not_loaded",
+            "tenants": [tenant.id for tenant in tenants]
         })
         
     except Exception as e:
@@ -204,6 +594,35 @@ def health_check():
             "error": str(e)
         }), 500
 
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Métricas en formato Prometheus"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/debug/traces", methods=["GET"])
+def get_traces():
+    """Trazas más lentas con el tiempo de cada etapa"""
+    if not is_admin(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        limit = request.args.get("limit", 20, type=int)
+        source = request.args.get("source", "memory")
+        
+        if source == "db":
+            traces = db.get_trazas_lentas(limit)
+        else:
+            traces = tracing.slowest(limit)
+        
+        return jsonify({
+            "status": "success",
+            "source": source,
+            "traces": traces
+        })
+        
+    except Exception as e:
+        logger.error(f"Error obteniendo trazas: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/test-ai", methods=["GET"])
 def test_ai():
     """Endpoint para probar la IA"""
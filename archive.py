@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Archivo comprimido del historial de conversaciones
+
+Los intercambios más viejos que ARCHIVE_AFTER_DAYS salen de la tabla
+conversaciones a archivos JSONL comprimidos con gzip, particionados por mes:
+
+    archivo/2026-09/index.json          segmentos de la partición
+    archivo/2026-09/000001.jsonl.gz     un segmento por corrida del archivador
+    archivo/2026-09/000001.bloom        filtro de Bloom de los teléfonos del segmento
+
+Cada segmento ocupa una entrada de tamaño fijo en index.json: los teléfonos
+van en el filtro de Bloom aparte, así el índice no crece con los clientes y
+reescribirlo en cada corrida sigue siendo barato. La exportación de un
+número abre solo los segmentos cuyo filtro dice que pueden tenerlo.
+
+Una corrida se confirma al escribir archivo/estado.json con el último id
+archivado (reemplazo atómico); recién después se borran las filas de la
+base. Si el proceso se corta a mitad de camino, la próxima corrida no
+duplica filas: salta las que ya están en algún segmento publicado y
+termina el borrado.
+
+La exportación recorre archivo + base con un generador, en memoria constante.
+
+Uso:
+    python archive.py --run                       # archivar ahora
+    python archive.py --export 5491123456789      # NDJSON por stdout
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin lock entre procesos
+    fcntl = None
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 1000
+
+
+class ConversationArchive:
+    """Archivo de conversaciones viejas particionado por mes"""
+
+    def __init__(self, db, archive_dir: str = "archivo"):
+        self.db = db
+        self.archive_dir = archive_dir
+        self._lock = threading.Lock()
+
+    def partitions(self) -> List[str]:
+        """Particiones existentes, de la más vieja a la más nueva"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        return sorted(
+            name for name in os.listdir(self.archive_dir)
+            if os.path.exists(os.path.join(self.archive_dir, name, "index.json"))
+        )
+
+    def read_index(self, partition: str) -> Dict[str, Any]:
+        path = os.path.join(self.archive_dir, partition, "index.json")
+        if not os.path.exists(path):
+            return {"partition": partition, "segments": []}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def archived_up_to(self) -> int:
+        """Mayor id de conversación cuyo archivado está confirmado"""
+        path = os.path.join(self.archive_dir, "estado.json")
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["archived_up_to"]
+
+    def run(self, older_than_days: float) -> int:
+        """Archiva los intercambios anteriores al umbral; devuelve cuántos movió"""
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=older_than_days)).strftime("%Y-%m-%d %H:%M:%S")
+
+        with self._lock, _ProcessLock(os.path.join(self.archive_dir, ".lock")):
+            with metrics.stage("archive"):
+                watermark = self.archived_up_to()
+
+                # Terminar un borrado que quedó a medias en la corrida anterior
+                self.db.delete_conversaciones_hasta(watermark)
+
+                limit_id = self.db.get_ultimo_id_antes(cutoff)
+                if limit_id <= watermark:
+                    return 0
+
+                moved = self._write_segments(watermark, limit_id)
+                _write_json_atomic(os.path.join(self.archive_dir, "estado.json"), {"archived_up_to": limit_id})
+                self.db.delete_conversaciones_hasta(limit_id)
+
+        logger.info("Archivados %s intercambios (hasta id %s)", moved, limit_id)
+        return moved
+
+    def _write_segments(self, desde_id: int, hasta_id: int) -> int:
+        """Escribe un segmento por partición y recién al final los publica en los índices"""
+        writers: Dict[str, _SegmentWriter] = {}
+        moved = 0
+
+        try:
+            last_id = desde_id
+            while True:
+                page = self.db.get_conversaciones_pagina(last_id, hasta_id, limit=PAGE_SIZE)
+                if not page:
+                    break
+
+                for row in page:
+                    partition = (row["timestamp"] or "0000-00")[:7]
+                    writer = writers.get(partition)
+                    if writer is None:
+                        writer = _SegmentWriter(self.archive_dir, partition, self.read_index(partition))
+                        writers[partition] = writer
+                    if writer.write(row):
+                        moved += 1
+
+                last_id = page[-1]["id"]
+
+            for writer in writers.values():
+                writer.close()
+        except Exception:
+            for writer in writers.values():
+                writer.abort()
+            raise
+
+        for writer in writers.values():
+            writer.publish()
+
+        return moved
+
+    def iter_conversation(self, phone_number: str = None) -> Iterator[Dict[str, Any]]:
+        """Historial completo en orden cronológico: primero lo archivado, después lo vivo"""
+        watermark = self.archived_up_to()
+
+        for partition in self.partitions():
+            for segment in self.read_index(partition)["segments"]:
+                if segment["first_id"] > watermark:
+                    continue
+                if phone_number and not self._may_contain(partition, segment, phone_number):
+                    continue
+
+                path = os.path.join(self.archive_dir, partition, segment["file"])
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        row = json.loads(line)
+                        # Lo que pasa del watermark sigue en la base (corrida sin confirmar)
+                        if row["id"] > watermark:
+                            break
+                        if not phone_number or row["phone_number"] == phone_number:
+                            yield row
+
+        # Filas vivas por páginas (las ya archivadas pueden seguir ahí si el borrado se cortó)
+        last_id = watermark
+        while True:
+            page = self.db.get_conversaciones_pagina(last_id, phone_number=phone_number, limit=PAGE_SIZE)
+            if not page:
+                return
+            yield from page
+            last_id = page[-1]["id"]
+
+    def _may_contain(self, partition: str, segment: Dict[str, Any], phone_number: str) -> bool:
+        """Si el segmento puede tener intercambios del número (falsos positivos sí, negativos no)"""
+        # Índices de antes del filtro de Bloom: lista completa de teléfonos
+        if "phones" in segment:
+            return phone_number in segment["phones"]
+        bloom = segment.get("bloom")
+        if not bloom:
+            return True
+        return phone_number in _PhoneBloom.load(os.path.join(self.archive_dir, partition, bloom["file"]), bloom["bits"], bloom["hashes"])
+
+    def start(self, older_than_days: float, interval: float) -> threading.Event:
+        """Corre el archivador periódicamente en un hilo; devuelve el evento para detenerlo"""
+        stop = threading.Event()
+
+        def loop():
+            # Primera corrida con un poco de demora para no competir con el arranque
+            delay = min(interval, 60)
+            while not stop.wait(delay):
+                delay = interval
+                try:
+                    self.run(older_than_days)
+                except Exception as e:
+                    logger.error("Error archivando conversaciones: %s", e)
+                    metrics.ERRORS.inc("archive")
+
+        threading.Thread(target=loop, name="archiver", daemon=True).start()
+        return stop
+
+
+class _SegmentWriter:
+    """Un segmento nuevo de una partición (invisible hasta publish)"""
+
+    def __init__(self, archive_dir: str, partition: str, index: Dict[str, Any]):
+        self.dir = os.path.join(archive_dir, partition)
+        os.makedirs(self.dir, exist_ok=True)
+        self.index = index
+        # Filas que ya están en algún segmento publicado de esta partición
+        self.skip_up_to = max((segment["last_id"] for segment in index["segments"]), default=0)
+        number = len(index["segments"]) + 1
+        self.file = f"{number:06d}.jsonl.gz"
+        self.path = os.path.join(self.dir, self.file)
+        self.bloom_file = f"{number:06d}.bloom"
+        self.bloom_path = os.path.join(self.dir, self.bloom_file)
+        self.bloom = None
+        self._raw = open(self.path, "wb")
+        self._gzip = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        self.rows = 0
+        self.first_id = None
+        self.last_id = None
+        self.phones = set()
+
+    def write(self, row: Dict[str, Any]) -> bool:
+        if row["id"] <= self.skip_up_to:
+            return False
+        self._gzip.write((json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8"))
+        if self.first_id is None:
+            self.first_id = row["id"]
+        self.last_id = row["id"]
+        self.rows += 1
+        self.phones.add(row["phone_number"])
+        return True
+
+    def close(self):
+        self._gzip.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        if self.rows:
+            self.bloom = _PhoneBloom.build(self.phones)
+            self.bloom.save(self.bloom_path)
+
+    def abort(self):
+        try:
+            self._gzip.close()
+            self._raw.close()
+        finally:
+            os.remove(self.path)
+            if os.path.exists(self.bloom_path):
+                os.remove(self.bloom_path)
+
+    def publish(self):
+        """Agrega el segmento al índice con un reemplazo atómico"""
+        if not self.rows:
+            os.remove(self.path)
+            return
+
+        self.index.setdefault("partition", os.path.basename(self.dir))
+        self.index["segments"].append({
+            "file": self.file,
+            "rows": self.rows,
+            "first_id": self.first_id,
+            "last_id": self.last_id,
+            "bloom": {"file": self.bloom_file, "bits": self.bloom.bits, "hashes": self.bloom.hashes},
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
+
+        _write_json_atomic(os.path.join(self.dir, "index.json"), self.index)
+
+
+class _PhoneBloom:
+    """Filtro de Bloom de los teléfonos de un segmento (~1% de falsos positivos con 10 bits por teléfono)"""
+
+    BITS_PER_PHONE = 10
+    HASHES = 7
+
+    def __init__(self, bits: int, hashes: int = HASHES, data: bytes = None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def build(cls, phones: Iterable[str]) -> "_PhoneBloom":
+        phones = list(phones)
+        bloom = cls(max(64, len(phones) * cls.BITS_PER_PHONE))
+        for phone in phones:
+            bloom.add(phone)
+        return bloom
+
+    @classmethod
+    def load(cls, path: str, bits: int, hashes: int) -> "_PhoneBloom":
+        with open(path, "rb") as f:
+            return cls(bits, hashes, f.read())
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _positions(self, phone: str) -> Iterator[int]:
+        # Doble hashing: k posiciones a partir de dos hashes de 64 bits
+        digest = hashlib.blake2b(phone.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, phone: str):
+        for position in self._positions(phone):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, phone: str) -> bool:
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self._positions(phone))
+
+
+def _write_json_atomic(path: str, data: Dict[str, Any]):
+    """Escribe a un temporal y lo reemplaza: nunca queda un JSON a medias"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class _ProcessLock:
+    """Lock de archivo para que dos workers no archiven a la vez"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "w")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archivo comprimido del historial de conversaciones")
+    parser.add_argument("--run", action="store_true", help="archivar ahora")
+    parser.add_argument("--days", type=float, default=float(os.getenv("ARCHIVE_AFTER_DAYS", 90)), help="antigüedad mínima en días")
+    parser.add_argument("--export", nargs="?", const="", metavar="PHONE", help="exportar como NDJSON (todo si no se indica número)")
+    parser.add_argument("--db", help="ruta o URL de la base (por defecto DATABASE_URL)")
+    parser.add_argument("--dir", default=os.getenv("ARCHIVE_DIR", "archivo"))
+    args = parser.parse_args()
+
+    from database import Database
+
+    archive = ConversationArchive(Database(args.db), args.dir)
+
+    if args.run:
+        start = time.perf_counter()
+        moved = archive.run(args.days)
+        print(f"📦 {moved} intercambios archivados en {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+    if args.export is not None:
+        for row in archive.iter_conversation(args.export or None):
+            sys.stdout.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Servidor asyncio alternativo: un proceso atiende cientos de conversaciones
+mientras espera a OpenRouter y a la Graph API.
+
+Uso: python async_app.py
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+
+import metrics
+import tracing
+import webhook_events
+import write_buffer
+from admin_auth import is_admin
+from async_engine import AsyncWhatsAppAPI
+from log_setup import setup_logging
+from tenants import load_tenants
+
+# Cargar variables de entorno
+load_dotenv()
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+RECORD_STATUSES = os.getenv("RECORD_MESSAGE_STATUSES", "true").lower() == "true"
+
+
+def engine_for(app: web.Application, phone_number_id: str = None) -> AsyncWhatsAppAPI:
+    """Motor de la tienda dueña del número (la predeterminada si no es de ninguna)"""
+    return app["engines"][app["tenants"].resolve(phone_number_id).id]
+
+
+async def verify_webhook(request: web.Request) -> web.Response:
+    """Verifica el webhook de WhatsApp"""
+    engine = engine_for(request.app)
+    result = engine.verify_webhook(
+        request.query.get("hub.mode"),
+        request.query.get("hub.verify_token"),
+        request.query.get("hub.challenge")
+    )
+
+    if result:
+        return web.Response(text=result)
+    return web.Response(text="Verification failed", status=403)
+
+
+async def webhook(request: web.Request) -> web.Response:
+    """Recibe mensajes de WhatsApp y los procesa en tareas de fondo"""
+    raw = await request.read()
+
+    if not raw:
+        logger.warning("No data received in webhook")
+        return web.Response(text="No data", status=400)
+
+    # Camino rápido: los callbacks de estado no se parsean salvo que se guarden
+    kind = webhook_events.classify(raw)
+    metrics.WEBHOOK_EVENTS.inc(kind)
+
+    if kind == webhook_events.KIND_OTHER or (kind == webhook_events.KIND_STATUSES and not RECORD_STATUSES):
+        return web.Response(text="OK")
+
+    data = webhook_events.parse(raw)
+
+    if not data:
+        logger.warning("Invalid JSON received in webhook")
+        return web.Response(text="No data", status=400)
+
+    tasks = request.app["tasks"]
+
+    # Cada evento va a la tienda dueña del número que lo recibió (su número, catálogo y base)
+    for phone_number_id, (messages, statuses) in webhook_events.split_by_number(data).items():
+        tenant = request.app["tenants"].resolve(phone_number_id)
+        engine = request.app["engines"][tenant.id]
+
+        if statuses and RECORD_STATUSES:
+            await engine.run_db(engine.whatsapp.ai.db.save_estados, statuses)
+
+        for message in messages:
+            metrics.TENANT_MESSAGES.inc(tenant.id)
+            task = asyncio.create_task(engine.process_message(message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    return web.Response(text="OK")
+
+
+async def health_check(request: web.Request) -> web.Response:
+    """Endpoint de health check"""
+    engine = engine_for(request.app)
+    store_info = await engine.run_db(engine.whatsapp.ai.db.get_tienda_info)
+
+    return web.json_response({
+        "status": "healthy",
+        "mode": "async",
+        "in_flight": len(request.app["tasks"]),
+        "store": "loaded" if store_info else "not_loaded",
+        "tenants": [tenant.id for tenant in request.app["tenants"]]
+    })
+
+
+async def get_metrics(request: web.Request) -> web.Response:
+    """Métricas en formato Prometheus"""
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+async def get_traces(request: web.Request) -> web.Response:
+    """Trazas más lentas con el tiempo de cada etapa"""
+    if not is_admin(request):
+        return web.json_response({"error": "Unauthorized"}, status=401)
+
+    limit = int(request.query.get("limit", 20))
+    return web.json_response({"status": "success", "source": "memory", "traces": tracing.slowest(limit)})
+
+
+async def on_startup(app: web.Application):
+    connector = aiohttp.TCPConnector(limit=int(os.getenv("ASYNC_HTTP_CONNECTIONS", 100)))
+    app["session"] = aiohttp.ClientSession(connector=connector)
+    # Tiendas de TENANTS_FILE (o la única de las variables de entorno), un motor por tienda
+    app["tenants"] = load_tenants(serialize=json.dumps)
+    app["engines"] = {tenant.id: AsyncWhatsAppAPI(app["session"], tenant.whatsapp) for tenant in app["tenants"]}
+    # Barredor de reservas vencidas (las reservas desde el chat también existen en este modo)
+    app["background_stops"] = [
+        tenant.reservations.start(interval=float(os.getenv("RESERVATION_SWEEP_SECONDS", 30)))
+        for tenant in app["tenants"]
+    ]
+    app["tasks"] = set()
+    metrics.QUEUE_DEPTH.set_function(lambda: len(app["tasks"]))
+
+
+async def on_cleanup(app: web.Application):
+    for stop in app["background_stops"]:
+        stop.set()
+
+    # Terminar las respuestas en curso antes de cerrar las conexiones
+    if app["tasks"]:
+        logger.info(f"Esperando {len(app['tasks'])} conversaciones en curso...")
+        await asyncio.gather(*app["tasks"], return_exceptions=True)
+
+    await app["session"].close()
+    for engine in app["engines"].values():
+        engine.close()
+    # Los ejecutores por conversación de las tiendas no se usan en este modo
+    for tenant in app["tenants"]:
+        tenant.executor.shutdown(wait=False)
+    write_buffer.close_all()
+
+
+def create_app() -> web.Application:
+    """Crea la aplicación aiohttp"""
+    app = web.Application()
+    app.router.add_get("/webhook", verify_webhook)
+    app.router.add_post("/webhook", webhook)
+    app.router.add_get("/health", health_check)
+    app.router.add_get("/metrics", get_metrics)
+    app.router.add_get("/debug/traces", get_traces)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    port = int(os.getenv("PORT", 5000))
+    logger.info(f"Starting async server on port {port}")
+    web.run_app(create_app(), host="0.0.0.0", port=port)
@@ -0,0 +1,318 @@
+"""
+Motor asyncio para el camino OpenRouter → WhatsApp (modo de servicio alternativo)
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Any, Optional
+
+import aiohttp
+
+import admission
+import metrics
+import tracing
+from openrouter import detect_intent
+from whatsapp import (
+    WhatsAppAPI, parse_quick_reply, parse_reservation, wants_price_list,
+    PRICE_LIST_PDF_URL, PRICE_LIST_MESSAGE, PRICE_LIST_CAPTION
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncOpenRouterAI:
+    """Misma lógica que OpenRouterAI pero con HTTP asíncrono"""
+
+    def __init__(self, ai, session: aiohttp.ClientSession, run_db):
+        # ai es el OpenRouterAI síncrono: se reutilizan prompt, parsing y fallback
+        self.ai = ai
+        self.session = session
+        self.run_db = run_db
+        self.timeout = aiohttp.ClientTimeout(total=30)
+
+    async def generate_response(self, user_message: str, phone_number: str = None, intent: str = None) -> str:
+        """Genera una respuesta usando OpenRouter AI"""
+        intent = intent or detect_intent(user_message)
+        started = None
+        metrics.INFLIGHT_GENERATIONS.inc()
+        try:
+            if not self.ai.api_key:
+                logger.error("OPENROUTER_API_KEY no está configurada")
+                metrics.FALLBACKS.inc("no_api_key")
+                return await self.run_db(self.ai.get_fallback_response, user_message)
+
+            # El prompt lee la base de datos, se arma en el pool de DB
+            with metrics.stage("prompt_build"):
+                request_data = await self.run_db(self.ai.build_request, user_message, phone_number)
+
+            started = time.perf_counter()
+            with metrics.stage("llm"):
+                async with self.session.post(
+                    request_data["url"],
+                    headers=request_data["headers"],
+                    json=request_data["payload"],
+                    timeout=self.timeout
+                ) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        ai_response = self.ai.parse_response(data)
+                    else:
+                        logger.error(f"Error en OpenRouter API: {response.status} {await response.text()}")
+                        await self.run_db(self.ai.record_usage, phone_number, intent, "http_error", started)
+                        metrics.FALLBACKS.inc("http_error")
+                        return await self.run_db(self.ai.get_fallback_response, user_message)
+
+            await self.run_db(self.ai.record_usage, phone_number, intent, "ok", started, data)
+            started = None  # ya contabilizada: si falla al guardar no se cuenta dos veces
+
+            # Guardar conversación en la base de datos
+            if phone_number:
+                await self.run_db(self.ai.db.save_conversation, phone_number, user_message, ai_response)
+
+            return ai_response
+
+        except Exception as e:
+            logger.error(f"Error generando respuesta: {str(e)}")
+            # Solo cuenta si la petición llegó a salir
+            if started is not None:
+                await self.run_db(self.ai.record_usage, phone_number, intent, "exception", started)
+            metrics.ERRORS.inc("openrouter")
+            metrics.FALLBACKS.inc("exception")
+            return await self.run_db(self.ai.get_fallback_response, user_message)
+        finally:
+            metrics.INFLIGHT_GENERATIONS.dec()
+
+
+class AsyncWhatsAppAPI:
+    """Misma lógica que WhatsAppAPI pero sin bloquear hilos mientras se espera I/O"""
+
+    def __init__(self, session: aiohttp.ClientSession, whatsapp: WhatsAppAPI = None, db_threads: int = None,
+                 max_inflight: int = None):
+        # Los builders de payload, la configuración y la base salen de la versión síncrona (la de la tienda)
+        self.whatsapp = whatsapp or WhatsAppAPI()
+        self.session = session
+        self.timeout = aiohttp.ClientTimeout(total=30)
+
+        # SQLite es bloqueante: se usa desde un pool chico de hilos dedicado
+        self.db_executor = ThreadPoolExecutor(
+            max_workers=db_threads or int(os.getenv("ASYNC_DB_THREADS", 4)),
+            thread_name_prefix="async-db"
+        )
+        self.ai = AsyncOpenRouterAI(self.whatsapp.ai, session, self.run_db)
+
+        self.inflight = asyncio.Semaphore(max_inflight or int(os.getenv("ASYNC_MAX_INFLIGHT", 500)))
+        self.coalesce_window = float(os.getenv("COALESCE_WINDOW_SECONDS", "2"))
+        self.coalesce_max_wait = float(os.getenv("COALESCE_MAX_WAIT_SECONDS", "6"))
+
+        self._bursts: Dict[str, Dict[str, Any]] = {}
+        self._locks: Dict[str, list] = {}
+        self._intake: Dict[str, list] = {}
+
+    async def run_db(self, fn, *args):
+        """Ejecuta una operación de base de datos sin bloquear el loop"""
+        loop = asyncio.get_running_loop()
+        # Copiar el contexto para que los spans de DB caigan en la traza del mensaje
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.db_executor, partial(context.run, fn, *args))
+
+    async def _post(self, payload: Dict[str, Any], to: str) -> bool:
+        """Envía un payload a la Graph API"""
+        try:
+            with metrics.stage("send"):
+                async with self.session.post(
+                    self.whatsapp.base_url,
+                    headers=self.whatsapp.build_headers(),
+                    json=payload,
+                    timeout=self.timeout
+                ) as response:
+                    if response.status == 200:
+                        return True
+                    logger.error(f"Error enviando mensaje a {to}: {response.status} {await response.text()}")
+                    metrics.ERRORS.inc("whatsapp_send")
+                    return False
+
+        except Exception as e:
+            logger.error(f"Error enviando mensaje a {to}: {str(e)}")
+            metrics.ERRORS.inc("whatsapp_send")
+            return False
+
+    async def send_message(self, to: str, message: str) -> bool:
+        """Envía un mensaje de texto a WhatsApp"""
+        return await self._post(self.whatsapp.build_text_payload(to, message), to)
+
+    async def send_document_message(self, to: str, document_url: str, filename: str = "lista_precios.pdf", caption: str = "") -> bool:
+        """Envía un documento PDF a WhatsApp"""
+        return await self._post(self.whatsapp.build_document_payload(to, document_url, filename, caption), to)
+
+    async def send_buttons_message(self, to: str, body: str, buttons: list) -> bool:
+        """Envía un mensaje con botones de respuesta rápida"""
+        return await self._post(self.whatsapp.build_buttons_payload(to, body, buttons), to)
+
+    async def send_price_list_pdf(self, to: str) -> bool:
+        """Envía la lista de precios en PDF"""
+        await self.send_message(to, PRICE_LIST_MESSAGE)
+        return await self.send_document_message(to, PRICE_LIST_PDF_URL, "lista_precios.pdf", PRICE_LIST_CAPTION)
+
+    async def handle_text(self, phone_number: str, message_text: str) -> bool:
+        """Genera y envía la respuesta para el texto de un cliente"""
+        # Pedido de reserva: se resuelve sin la IA, igual que en el modo con hilos
+        pedido = parse_reservation(message_text) if self.whatsapp.reservations else None
+        if pedido:
+            metrics.INTENTS.inc("reserva")
+            body, buttons = await self.run_db(self.whatsapp.reservation_reply, phone_number, *pedido)
+            if buttons:
+                return await self.send_buttons_message(phone_number, body, buttons)
+            return await self.send_message(phone_number, body)
+
+        if wants_price_list(message_text):
+            metrics.INTENTS.inc("lista_precios")
+            return await self.send_price_list_pdf(phone_number)
+
+        intent = detect_intent(message_text)
+        metrics.INTENTS.inc(intent)
+
+        # Mismo límite de uso de la IA que el modo con hilos (sin ejecutor no se difiere)
+        limited = self.whatsapp.rate_limiter.acquire(phone_number) if self.whatsapp.rate_limiter else None
+        if limited:
+            metrics.RATE_LIMITED.inc(limited[0], "fallback")
+            metrics.FALLBACKS.inc("rate_limit")
+            return await self.send_message(phone_number, await self.run_db(self.whatsapp.ai.get_fallback_response, message_text))
+
+        # Mismo control de admisión (acá la espera es el semáforo de mensajes en curso, no una cola)
+        controller = self.whatsapp.admission
+        if controller:
+            history = await self.run_db(self.whatsapp.ai.db.get_recent_turns, phone_number, 1)
+            lane = admission.lane_for(intent, not history)
+            if not controller.admit(lane):
+                metrics.FALLBACKS.inc("shed")
+                return await self.send_message(phone_number, await self.run_db(self.whatsapp.ai.get_fallback_response, message_text))
+
+        try:
+            ai_response = await self.ai.generate_response(message_text, phone_number, intent)
+        finally:
+            if controller:
+                controller.release()
+        return await self.send_message(phone_number, ai_response)
+
+    async def process_quick_reply(self, message_data: Dict[str, Any]) -> bool:
+        """Procesa respuestas rápidas (botones): misma respuesta que el modo con hilos"""
+        phone_number, button_id = parse_quick_reply(message_data)
+        if not phone_number or not button_id:
+            return False
+
+        async with self.inflight:
+            lock = self._acquire_lock(phone_number)
+            try:
+                async with lock[0]:
+                    text = await self.run_db(self.whatsapp.quick_reply_text, phone_number, button_id)
+                    return await self.send_message(phone_number, text)
+            finally:
+                self._release_lock(phone_number, lock)
+
+    async def process_message(self, message_data: Dict[str, Any]) -> bool:
+        """Procesa un mensaje entrante: agrupa ráfagas y respeta el orden por cliente"""
+        # Ignorar reintentos de mensajes que ya recibimos
+        message_id = message_data.get("id")
+        if message_id and not await self._mark_processed(message_data.get("from"), message_id):
+            logger.info(f"Mensaje duplicado ignorado: {message_id}")
+            return True
+
+        # Botones (confirmar/liberar reservas, menú)
+        if message_data.get("type") == "interactive":
+            return await self.process_quick_reply(message_data)
+
+        phone_number = message_data.get("from")
+        message_text = message_data.get("text", {}).get("body", "")
+
+        if not phone_number or not message_text:
+            logger.warning("Mensaje inválido recibido")
+            return False
+
+        trace = tracing.new_trace("mensaje", phone_number=phone_number, message_id=message_id)
+
+        merged_text = await self._coalesce(phone_number, message_text)
+        if merged_text is None:
+            # Otro mensaje más nuevo del mismo cliente se encarga de responder
+            trace.attrs["merged"] = True
+            tracing.finish(trace)
+            return True
+        trace.mark("coalesce_wait")
+
+        async with self.inflight:
+            lock = self._acquire_lock(phone_number)
+            try:
+                async with lock[0]:
+                    trace.mark("queue_wait")
+                    with tracing.activate(trace):
+                        return await self.handle_text(phone_number, merged_text)
+            finally:
+                self._release_lock(phone_number, lock)
+                tracing.finish(trace)
+
+    async def _mark_processed(self, phone_number: Optional[str], message_id: str) -> bool:
+        """Marca el mensaje como recibido sin que los de un mismo cliente se adelanten entre sí"""
+        if not phone_number:
+            return await self.run_db(self.whatsapp.ai.db.mark_message_processed, message_id)
+
+        # La marca va al pool de DB y puede volver en otro orden: de a uno por cliente, en orden de
+        # llegada (el Lock es FIFO). Al soltarlo este mensaje sigue sin ceder el loop hasta entrar a la
+        # ráfaga o al lock del cliente, así el siguiente queda detrás
+        lock = self._acquire_lock(phone_number, self._intake)
+        try:
+            async with lock[0]:
+                return await self.run_db(self.whatsapp.ai.db.mark_message_processed, message_id)
+        finally:
+            self._release_lock(phone_number, lock, self._intake)
+
+    async def _coalesce(self, phone_number: str, message_text: str) -> Optional[str]:
+        """Espera la ventana de agrupación; devuelve el texto unido solo al último mensaje de la ráfaga"""
+        if self.coalesce_window <= 0:
+            return message_text
+
+        burst = self._bursts.get(phone_number)
+        if burst is None:
+            burst = {"texts": [], "first": time.monotonic(), "seq": 0}
+            self._bursts[phone_number] = burst
+
+        burst["texts"].append(message_text)
+        burst["seq"] += 1
+        seq = burst["seq"]
+
+        elapsed = time.monotonic() - burst["first"]
+        await asyncio.sleep(max(min(self.coalesce_window, self.coalesce_max_wait - elapsed), 0))
+
+        if self._bursts.get(phone_number) is not burst:
+            return None
+        if burst["seq"] != seq and time.monotonic() - burst["first"] < self.coalesce_max_wait:
+            return None
+
+        del self._bursts[phone_number]
+        return "\n".join(burst["texts"])
+
+    def _acquire_lock(self, phone_number: str, locks: Dict[str, list] = None) -> list:
+        """Lock por cliente con conteo de referencias para poder liberarlo"""
+        locks = self._locks if locks is None else locks
+        lock = locks.get(phone_number)
+        if lock is None:
+            lock = [asyncio.Lock(), 0]
+            locks[phone_number] = lock
+        lock[1] += 1
+        return lock
+
+    def _release_lock(self, phone_number: str, lock: list, locks: Dict[str, list] = None):
+        lock[1] -= 1
+        if lock[1] == 0:
+            (self._locks if locks is None else locks).pop(phone_number, None)
+
+    def verify_webhook(self, mode: str, token: str, challenge: str) -> Optional[str]:
+        """Verifica el webhook de WhatsApp"""
+        return self.whatsapp.verify_webhook(mode, token, challenge)
+
+    def close(self):
+        """Libera el pool de base de datos"""
+        self.db_executor.shutdown(wait=True)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks de database.py y del armado del prompt
+
+Uso:
+    python benchmark.py                                  # tamaños por defecto
+    python benchmark.py --catalog-sizes 10,1000,100000 --history-sizes 1000,1000000,10000000
+    python benchmark.py --output bench.json              # guardar resultados
+    python benchmark.py --baseline bench.json            # comparar contra una corrida anterior
+
+Sale con código 1 si algún benchmark es más lento que el baseline por encima
+del umbral (--threshold, 20% por defecto).
+
+Los casos de la base corren sin escritura diferida ni cache de historial, así
+miden el SQL. Lo que cuestan esos atajos se mide aparte, con nombre propio:
+save_conversation_encolado (solo encolar) y get_recent_turns_cache_hit.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+MARCAS = ["Nike", "Adidas", "Puma", "Converse", "Vans", "New Balance", "Reebok", "Fila"]
+CATEGORIAS = ["Running", "Casual", "Basketball", "Skate", "Training"]
+COLORES = ["Negro", "Blanco", "Rojo", "Azul", "Gris", "Verde"]
+TALLAS = [str(talla) for talla in range(36, 46)]
+
+HISTORY_PHONES = 1000
+TARGET_PHONE = "5490000000000"
+
+
+def make_productos(count: int, rng: random.Random) -> list:
+    """Catálogo sintético con la misma forma que data/productos.json"""
+    productos = []
+    for producto_id in range(1, count + 1):
+        tallas = rng.sample(TALLAS, 6)
+        productos.append({
+            "id": producto_id,
+            "nombre": f"Modelo {producto_id}",
+            "marca": rng.choice(MARCAS),
+            "categoria": rng.choice(CATEGORIAS),
+            "precio": rng.randrange(20000, 120000, 500),
+            "tallas": tallas,
+            "stock": {talla: rng.randint(0, 10) for talla in tallas},
+            "colores": rng.sample(COLORES, 2),
+            "descripcion": f"Zapatilla sintética número {producto_id} para benchmarks",
+            "imagen": ""
+        })
+    return productos
+
+
+def fill_history(db_path: str, rows: int, rng: random.Random):
+    """Inserta historial sintético directo en SQLite (mucho más rápido que save_conversation)"""
+    conn = sqlite3.connect(db_path)
+    phones = [TARGET_PHONE] + [f"549{index:010d}" for index in range(1, HISTORY_PHONES)]
+    chunk = 50000
+
+    for offset in range(0, rows, chunk):
+        batch = [
+            (rng.choice(phones), f"mensaje {index}", f"respuesta {index}")
+            for index in range(offset, min(offset + chunk, rows))
+        ]
+        conn.executemany(
+            "INSERT INTO conversaciones (phone_number, mensaje, respuesta) VALUES (?, ?, ?)",
+            batch
+        )
+        conn.commit()
+
+    conn.close()
+
+
+def measure(fn, repeat: int, warmup: int = 1) -> dict:
+    """Corre fn varias veces y devuelve estadísticas en milisegundos"""
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    samples.sort()
+    return {
+        "repeat": repeat,
+        "min_ms": round(samples[0], 4),
+        "median_ms": round(statistics.median(samples), 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+        "mean_ms": round(statistics.fmean(samples), 4)
+    }
+
+
+def new_database(workdir: str, name: str, caches: bool = False):
+    """Base de datos aislada con los datos de la tienda del repo (caches: escritura diferida y cache de historial)"""
+    from database import Database
+
+    # Database lee la configuración del entorno al crearse
+    overrides = {"DB_WRITE_BEHIND": "false", "HISTORY_CACHE_CUSTOMERS": "0"}
+    if caches:
+        overrides = {"DB_WRITE_BEHIND": "true", "HISTORY_CACHE_CUSTOMERS": "10000"}
+    previous = {key: os.environ.get(key) for key in overrides}
+    os.environ.update(overrides)
+    try:
+        db = Database(os.path.join(workdir, name))
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    with open(os.path.join(REPO_DIR, "data", "tienda.json"), "r", encoding="utf-8") as f:
+        db.save_tienda_data(json.load(f))
+    return db
+
+
+def new_ai(db):
+    """OpenRouterAI apuntando a la base de benchmark"""
+    from openrouter import OpenRouterAI
+
+    ai = OpenRouterAI()
+    ai.db = db
+    return ai
+
+
+def bench_catalog(workdir: str, size: int, repeat: int, seed: int) -> list:
+    """Benchmarks que dependen del tamaño del catálogo"""
+    # Semilla por caso: los mismos datos aunque cambie la lista de tamaños
+    rng = random.Random(f"{seed}-catalog-{size}")
+    db = new_database(workdir, f"catalog_{size}.db")
+    db.save_productos_data(make_productos(size, rng))
+    ai = new_ai(db)
+
+    producto_id = max(size // 2, 1)
+    talla = TALLAS[0]
+    params = {"catalog": size}
+
+    cases = [
+        ("get_productos", lambda: db.get_productos()),
+        ("get_productos_filtrado", lambda: db.get_productos(marca="Nike")),
+        ("buscar_productos", lambda: db.buscar_productos("nike")),
+        ("get_productos_pagina", lambda: db.get_productos_pagina(limit=50, sort="precio_asc", talla=talla)),
+        ("get_productos_pagina_color", lambda: db.get_productos_pagina(limit=50, color="rojo")),
+        # Ningún producto lo tiene: recorre todo el filtro sin llenar la página
+        ("get_productos_pagina_color_sin_resultados", lambda: db.get_productos_pagina(limit=50, color="Fucsia")),
+        ("verificar_stock", lambda: db.verificar_stock(producto_id, talla)),
+        ("build_system_prompt", lambda: ai.build_system_prompt())
+    ]
+
+    return [dict(name=name, params=params, **measure(fn, repeat)) for name, fn in cases]
+
+
+def bench_history(workdir: str, size: int, repeat: int, seed: int) -> list:
+    """Benchmarks que dependen del tamaño del historial"""
+    rng = random.Random(f"{seed}-history-{size}")
+    db = new_database(workdir, f"history_{size}.db")
+    db.save_productos_data(make_productos(100, rng))
+    fill_history(db.db_path, size, rng)
+    ai = new_ai(db)
+    # Misma base, con la escritura diferida y el cache de historial del servidor
+    cached_db = new_database(workdir, f"history_{size}.db", caches=True)
+
+    params = {"history": size}
+    counter = iter(range(10 ** 9))
+
+    cases = [
+        ("get_conversation_history", lambda: db.get_conversation_history(TARGET_PHONE, 5)),
+        ("get_recent_turns", lambda: db.get_recent_turns(TARGET_PHONE, 5)),
+        ("save_conversation", lambda: db.save_conversation(TARGET_PHONE, f"bench {next(counter)}", "ok")),
+        ("build_messages_con_historial", lambda: ai.build_messages("hola", TARGET_PHONE)),
+        # Después del calentamiento todas son aciertos del cache: no tocan la base
+        ("get_recent_turns_cache_hit", lambda: cached_db.get_recent_turns(TARGET_PHONE, 5)),
+        # Solo encola: el commit lo paga el hilo escritor
+        ("save_conversation_encolado", lambda: cached_db.save_conversation(TARGET_PHONE, f"bench {next(counter)}", "ok"))
+    ]
+
+    return [dict(name=name, params=params, **measure(fn, repeat)) for name, fn in cases]
+
+
+def result_key(result: dict) -> str:
+    params = ",".join(f"{key}={value}" for key, value in sorted(result["params"].items()))
+    return f"{result['name']}[{params}]"
+
+
+def compare(results: list, baseline_path: str, threshold: float) -> list:
+    """Compara medianas contra el baseline; devuelve las regresiones"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {result_key(result): result for result in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if not previous or not previous["median_ms"]:
+            continue
+
+        ratio = result["median_ms"] / previous["median_ms"]
+        result["baseline_median_ms"] = previous["median_ms"]
+        result["ratio"] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append(result)
+
+    return regressions
+
+
+def parse_sizes(value: str) -> list:
+    return [int(size) for size in value.split(",") if size.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks de los caminos calientes")
+    parser.add_argument("--catalog-sizes", default="10,1000,10000", help="tamaños de catálogo, separados por coma")
+    parser.add_argument("--history-sizes", default="1000,100000", help="filas de historial, separadas por coma")
+    parser.add_argument("--repeat", type=int, default=20, help="repeticiones por benchmark")
+    parser.add_argument("--seed", type=int, default=42, help="semilla para los datos sintéticos")
+    parser.add_argument("--output", help="archivo JSON donde guardar los resultados")
+    parser.add_argument("--baseline", help="resultados anteriores para comparar")
+    parser.add_argument("--threshold", type=float, default=0.2, help="regresión tolerada (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    original_cwd = os.getcwd()
+    results = []
+
+    try:
+        # Database() y OpenRouterAI() crean tienda.db en el directorio actual
+        os.chdir(workdir)
+
+        for size in parse_sizes(args.catalog_sizes):
+            print(f"📦 Catálogo de {size} productos...")
+            results.extend(bench_catalog(workdir, size, args.repeat, args.seed))
+
+        for size in parse_sizes(args.history_sizes):
+            print(f"💬 Historial de {size} filas...")
+            results.extend(bench_history(workdir, size, args.repeat, args.seed))
+
+    finally:
+        # Guardar lo que quedó en el buffer de escritura antes de borrar las bases
+        import write_buffer
+        write_buffer.close_all()
+        os.chdir(original_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = compare(results, args.baseline, args.threshold) if args.baseline else []
+
+    print("\n" + "=" * 78)
+    print(f"{'benchmark':55} {'mediana':>10} {'p95':>10}")
+    print("=" * 78)
+    for result in results:
+        line = f"{result_key(result):55} {result['median_ms']:>8.3f}ms {result['p95_ms']:>8.3f}ms"
+        if "ratio" in result:
+            line += f"  x{result['ratio']}"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "seed": args.seed,
+                    "repeat": args.repeat
+                },
+                "results": results
+            }, f, indent=2)
+        print(f"\n💾 Resultados guardados en {args.output}")
+
+    if regressions:
+        print(f"\n❌ {len(regressions)} regresiones contra {args.baseline}:")
+        for result in regressions:
+            print(f"   {result_key(result)}: {result['baseline_median_ms']}ms → {result['median_ms']}ms")
+        return False
+
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,138 @@
+"""
+Respuestas del catálogo pre-serializadas y pre-comprimidas por versión
+
+/products, /products/<id> y /store se consultan seguido desde la web y los
+dashboards. El ETag sale de la versión del catálogo (hash del contenido) y
+de la URL, así un If-None-Match se responde con 304 sin tocar SQLite. Los
+cuerpos se serializan y comprimen (gzip y, si está instalado, brotli) una
+sola vez por versión.
+"""
+
+import collections
+import gzip
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Optional, Tuple
+
+from flask import Request, Response
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional: sin él se sirve gzip
+    brotli = None
+
+# Debajo de este tamaño comprimir no vale la pena
+MIN_COMPRESS_BYTES = 512
+
+
+class CachedBody:
+    """Un cuerpo JSON con sus variantes comprimidas"""
+
+    def __init__(self, etag: str, body: bytes):
+        self.etag = etag
+        self.body = body
+        self.gzip = None
+        self.br = None
+
+        if len(body) >= MIN_COMPRESS_BYTES:
+            self.gzip = gzip.compress(body, compresslevel=9)
+            if brotli is not None:
+                self.br = brotli.compress(body, quality=9)
+
+
+class CatalogCache:
+    """Cache de respuestas por (versión del catálogo, URL)"""
+
+    def __init__(self, db, serialize: Callable[[dict], str], max_entries: int = 512, check_interval: float = 1.0):
+        self.db = db
+        self.serialize = serialize
+        self.max_entries = max_entries
+        # Cada cuánto se relee la versión de la base (otro worker pudo importar un catálogo)
+        self.check_interval = check_interval
+        self._versions: Dict[str, tuple] = {}
+        self._bodies: "collections.OrderedDict[Tuple[str, str], CachedBody]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def version(self, kind: str) -> str:
+        now = time.monotonic()
+        cached = self._versions.get(kind)
+        if cached and now - cached[1] < self.check_interval:
+            return cached[0]
+
+        version = self.db.get_catalog_version(kind)
+        self._versions[kind] = (version, now)
+        return version
+
+    def invalidate(self):
+        """Fuerza a releer las versiones (después de cambiar el catálogo en este proceso)"""
+        self._versions.clear()
+
+    def respond(self, request: Request, kinds: Tuple[str, ...], build: Callable[[], Optional[dict]]) -> Optional[Response]:
+        """Responde 304, un cuerpo cacheado o uno nuevo armado con build() (None si build no encuentra nada)"""
+        key = request.full_path
+        # El ETag combina las versiones de todo lo que muestra la respuesta
+        version = "-".join(self.version(kind) for kind in kinds)
+        # El crc solo acorta el texto del ETag; los cuerpos van por (versión, URL) completa
+        etag = f'W/"{version}-{zlib.crc32(key.encode("utf-8")):08x}"'
+        cache_key = (version, key)
+
+        if _matches(etag, request.headers.get("If-None-Match")):
+            metrics.CATALOG_CACHE.inc("not_modified")
+            return self._response(Response(status=304), etag)
+
+        with self._lock:
+            cached = self._bodies.get(cache_key)
+            if cached is not None:
+                self._bodies.move_to_end(cache_key)
+
+        if cached is None:
+            metrics.CATALOG_CACHE.inc("miss")
+            payload = build()
+            if payload is None:
+                return None
+            cached = CachedBody(etag, self.serialize(payload).encode("utf-8"))
+            with self._lock:
+                self._bodies[cache_key] = cached
+                while len(self._bodies) > self.max_entries:
+                    self._bodies.popitem(last=False)
+        else:
+            metrics.CATALOG_CACHE.inc("hit")
+
+        body, encoding = _pick_encoding(cached, request.headers.get("Accept-Encoding", ""))
+        response = Response(body, mimetype="application/json")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        return self._response(response, etag)
+
+    def _response(self, response: Response, etag: str) -> Response:
+        response.headers["ETag"] = etag
+        response.headers["Vary"] = "Accept-Encoding"
+        # Siempre revalidar: el 304 es barato y el catálogo puede cambiar en cualquier momento
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+
+def _matches(etag: str, if_none_match: Optional[str]) -> bool:
+    """Comparación débil de If-None-Match (ignora el prefijo W/)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == wanted:
+            return True
+    return False
+
+
+def _pick_encoding(cached: CachedBody, accept_encoding: str) -> tuple:
+    accepted = {item.split(";")[0].strip().lower() for item in accept_encoding.split(",")}
+    if cached.br is not None and "br" in accepted:
+        return cached.br, "br"
+    if cached.gzip is not None and "gzip" in accepted:
+        return cached.gzip, "gzip"
+    return cached.body, None
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Importación masiva del catálogo desde feeds de proveedores (CSV o NDJSON)
+
+El archivo se lee en streaming y las filas válidas se cargan de a bloques
+(executemany) en tablas temporales de staging. Al final, una sola
+transacción pasa el staging al catálogo: hasta ese commit los lectores
+siguen viendo la versión anterior. La memoria no depende del tamaño del
+archivo.
+
+Columnas CSV: id, nombre, marca, categoria, precio, stock, colores,
+descripcion, imagen. stock va como "40:5;41:3" y colores como "Negro|Blanco".
+En NDJSON cada línea es un producto con la forma de data/productos.json.
+
+Modos:
+- replace: el archivo es el catálogo completo (lo que no viene se borra)
+- upsert: agrega o actualiza solo los productos del archivo
+
+Uso:
+    python catalog_import.py proveedor.csv --mode replace
+    python catalog_import.py novedades.ndjson --mode upsert --max-errors 100
+"""
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import facets
+import metrics
+import reservations
+import storage
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+MAX_ERROR_SAMPLES = 50
+MAX_JOBS = 20
+
+PRODUCT_COLUMNS = ("id", "nombre", "marca", "categoria", "precio", "tallas", "stock", "colores", "descripcion", "imagen")
+
+# Tablas de staging (temporales: viven solo en la conexión de la importación)
+STAGING_TABLES = [
+    '''
+    CREATE TEMP TABLE productos_import (
+        id INTEGER PRIMARY KEY,
+        nombre TEXT NOT NULL,
+        marca TEXT NOT NULL,
+        categoria TEXT NOT NULL,
+        precio REAL NOT NULL,
+        tallas TEXT NOT NULL,
+        stock TEXT NOT NULL,
+        colores TEXT NOT NULL,
+        descripcion TEXT,
+        imagen TEXT
+    )
+    ''',
+    '''
+    CREATE TEMP TABLE stock_tallas_import (
+        producto_id INTEGER NOT NULL,
+        talla TEXT NOT NULL,
+        cantidad INTEGER NOT NULL,
+        PRIMARY KEY (producto_id, talla)
+    )
+    ''',
+    '''
+    CREATE TEMP TABLE producto_colores_import (
+        producto_id INTEGER NOT NULL,
+        color TEXT NOT NULL,
+        PRIMARY KEY (producto_id, color)
+    )
+    '''
+]
+
+# Importaciones en curso y recientes (para consultar el progreso)
+jobs: Dict[str, Dict[str, Any]] = {}
+_import_lock = threading.Lock()
+
+
+class CatalogImportError(Exception):
+    """La importación se canceló (demasiados errores o formato inválido)"""
+
+
+def parse_csv_row(row: Dict[str, str]) -> Dict[str, Any]:
+    """Fila CSV → producto con la forma de data/productos.json"""
+    stock = {}
+    for item in (row.get("stock") or "").split(";"):
+        if item.strip():
+            talla, _, cantidad = item.partition(":")
+            stock[talla.strip()] = cantidad.strip()
+
+    return {
+        "id": row.get("id"),
+        "nombre": row.get("nombre"),
+        "marca": row.get("marca"),
+        "categoria": row.get("categoria"),
+        "precio": row.get("precio"),
+        "stock": stock,
+        "colores": [color.strip() for color in (row.get("colores") or "").split("|") if color.strip()],
+        "descripcion": row.get("descripcion") or "",
+        "imagen": row.get("imagen") or ""
+    }
+
+
+def validate(producto: Dict[str, Any]) -> Dict[str, Any]:
+    """Normaliza un producto; ValueError con el motivo si no es válido"""
+    if not isinstance(producto, dict):
+        raise ValueError("fila inválida")
+
+    try:
+        producto_id = int(producto.get("id"))
+    except (TypeError, ValueError):
+        raise ValueError("id inválido")
+    if producto_id <= 0:
+        raise ValueError("id inválido")
+
+    for field in ("nombre", "marca", "categoria"):
+        if not str(producto.get(field) or "").strip():
+            raise ValueError(f"falta {field}")
+
+    try:
+        precio = float(producto.get("precio"))
+    except (TypeError, ValueError):
+        raise ValueError("precio inválido")
+    if precio <= 0:
+        raise ValueError("precio inválido")
+
+    stock_raw = producto.get("stock") or {}
+    if not isinstance(stock_raw, dict):
+        raise ValueError("stock inválido")
+    stock = {}
+    for talla, cantidad in stock_raw.items():
+        try:
+            cantidad = int(cantidad)
+        except (TypeError, ValueError):
+            raise ValueError(f"stock inválido para talla {talla}")
+        if cantidad < 0:
+            raise ValueError(f"stock negativo para talla {talla}")
+        stock[str(talla)] = cantidad
+
+    colores = producto.get("colores") or []
+    if not isinstance(colores, list):
+        raise ValueError("colores inválidos")
+
+    return {
+        "id": producto_id,
+        "nombre": str(producto["nombre"]).strip(),
+        "marca": str(producto["marca"]).strip(),
+        "categoria": str(producto["categoria"]).strip(),
+        "precio": precio,
+        "tallas": [str(talla) for talla in producto.get("tallas") or stock.keys()],
+        "stock": stock,
+        "colores": [str(color) for color in colores],
+        "descripcion": producto.get("descripcion") or "",
+        "imagen": producto.get("imagen") or ""
+    }
+
+
+def read_rows(stream: io.TextIOBase, fmt: str) -> Iterator[Tuple[int, Any]]:
+    """Recorre el archivo sin cargarlo: (número de línea, producto o excepción)"""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            try:
+                yield reader.line_num, parse_csv_row(row)
+            except Exception as e:
+                yield reader.line_num, ValueError(str(e))
+    elif fmt == "ndjson":
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except ValueError:
+                yield line_number, ValueError("JSON inválido")
+    else:
+        raise CatalogImportError(f"Formato no soportado: {fmt}")
+
+
+class CatalogImporter:
+    """Carga un feed en staging y lo publica en una sola transacción"""
+
+    def __init__(self, db_path, chunk_size: int = CHUNK_SIZE):
+        # Ruta/URL o un Storage ya abierto
+        self.storage = storage.open_storage(db_path)
+        self.db_path = self.storage.key
+        self.chunk_size = chunk_size
+
+    def run(self, stream: io.TextIOBase, fmt: str, mode: str = "upsert", max_errors: Optional[int] = None,
+            progress: Callable[[Dict[str, Any]], None] = None, job_id: str = None) -> Dict[str, Any]:
+        """Importa el feed y devuelve el reporte"""
+        if mode not in ("replace", "upsert"):
+            raise CatalogImportError(f"Modo inválido: {mode}")
+
+        job_id = job_id or uuid.uuid4().hex[:12]
+        report = {
+            "id": job_id,
+            "status": "running",
+            "mode": mode,
+            "format": fmt,
+            "rows_read": 0,
+            "rows_imported": 0,
+            "errors": 0,
+            "error_samples": [],
+            "started_at": time.time(),
+            "finished_at": None
+        }
+        jobs[job_id] = report
+        while len(jobs) > MAX_JOBS:
+            del jobs[next(iter(jobs))]
+
+        # Una importación a la vez: dos reemplazos simultáneos se pisarían
+        with _import_lock, metrics.stage("catalog_import"):
+            conn = self.storage.connect(timeout=60)
+            try:
+                self._create_staging(conn)
+                digest = hashlib.sha1()
+                chunk: List[Dict[str, Any]] = []
+
+                for line_number, item in read_rows(stream, fmt):
+                    report["rows_read"] += 1
+                    try:
+                        if isinstance(item, Exception):
+                            raise item
+                        producto = validate(item)
+                    except ValueError as e:
+                        self._error(report, line_number, str(e))
+                        if max_errors is not None and report["errors"] > max_errors:
+                            raise CatalogImportError(f"Más de {max_errors} filas con errores")
+                        continue
+
+                    chunk.append(producto)
+                    if len(chunk) >= self.chunk_size:
+                        self._load_chunk(conn, chunk, digest)
+                        report["rows_imported"] += len(chunk)
+                        chunk = []
+                        if progress:
+                            progress(report)
+
+                if chunk:
+                    self._load_chunk(conn, chunk, digest)
+                    report["rows_imported"] += len(chunk)
+
+                if report["rows_imported"] == 0 and mode == "replace":
+                    raise CatalogImportError("El archivo no tiene productos válidos")
+
+                self._publish(conn, mode, digest.hexdigest())
+                report["status"] = "done"
+
+            except Exception as e:
+                report["status"] = "failed"
+                report["error"] = str(e)
+                metrics.ERRORS.inc("catalog_import")
+                logger.error("Importación %s cancelada: %s", job_id, e)
+                if not isinstance(e, (CatalogImportError, ValueError, csv.Error, UnicodeDecodeError)):
+                    raise
+            finally:
+                self._drop_staging(conn)
+                conn.close()
+                report["finished_at"] = time.time()
+                if progress:
+                    progress(report)
+
+        logger.info("Importación %s: %s filas importadas, %s errores", job_id, report["rows_imported"], report["errors"])
+        return report
+
+    def _error(self, report: Dict[str, Any], line_number: int, message: str):
+        report["errors"] += 1
+        if len(report["error_samples"]) < MAX_ERROR_SAMPLES:
+            report["error_samples"].append({"line": line_number, "error": message})
+
+    def _create_staging(self, conn):
+        self._drop_staging(conn)
+        for sql in STAGING_TABLES:
+            conn.execute_ddl(sql)
+        conn.commit()
+
+    def _drop_staging(self, conn):
+        for table in ("productos_import", "stock_tallas_import", "producto_colores_import"):
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.commit()
+
+    def _load_chunk(self, conn, chunk: List[Dict[str, Any]], digest):
+        """Un bloque de productos al staging en una transacción"""
+        ids = [(producto["id"],) for producto in chunk]
+
+        with conn:
+            # Si un id se repite en el archivo gana la última fila
+            conn.executemany("DELETE FROM stock_tallas_import WHERE producto_id = ?", ids)
+            conn.executemany("DELETE FROM producto_colores_import WHERE producto_id = ?", ids)
+            conn.executemany(
+                conn.upsert_sql("productos_import", PRODUCT_COLUMNS, key=("id",)),
+                [
+                    (
+                        producto["id"],
+                        producto["nombre"],
+                        producto["marca"],
+                        producto["categoria"],
+                        producto["precio"],
+                        json.dumps(producto["tallas"]),
+                        json.dumps(producto["stock"]),
+                        json.dumps(producto["colores"]),
+                        producto["descripcion"],
+                        producto["imagen"]
+                    )
+                    for producto in chunk
+                ]
+            )
+            conn.executemany(
+                "INSERT INTO stock_tallas_import (producto_id, talla, cantidad) VALUES (?, ?, ?)",
+                [(producto["id"], talla, cantidad) for producto in chunk for talla, cantidad in producto["stock"].items()]
+            )
+            conn.executemany(
+                conn.insert_ignore_sql("producto_colores_import", ("producto_id", "color")),
+                # En minúsculas, como los filtra get_productos_pagina
+                [(producto["id"], color.lower()) for producto in chunk for color in producto["colores"]]
+            )
+
+        for producto in chunk:
+            digest.update(json.dumps(producto, sort_keys=True).encode("utf-8"))
+
+    def _publish(self, conn, mode: str, content_hash: str):
+        """Pasa el staging al catálogo en una sola transacción"""
+        with conn:
+            if mode == "replace":
+                conn.execute("DELETE FROM productos")
+                conn.execute("DELETE FROM stock_tallas")
+                conn.execute("DELETE FROM producto_colores")
+                version = content_hash[:16]
+            else:
+                # Grupos de facetas que cambian: los de antes y los de después de cada producto
+                groups = facets.affected_groups(conn, "SELECT id FROM productos_import")
+                for marca, categoria in conn.execute("SELECT DISTINCT marca, categoria FROM productos_import"):
+                    groups["marcas"].add(marca)
+                    groups["categorias"].add(categoria)
+
+                conn.execute("DELETE FROM stock_tallas WHERE producto_id IN (SELECT id FROM productos_import)")
+                conn.execute("DELETE FROM producto_colores WHERE producto_id IN (SELECT id FROM productos_import)")
+                row = conn.execute("SELECT version FROM catalogo_version WHERE nombre = 'productos'").fetchone()
+                version = hashlib.sha1(((row[0] if row else "") + content_hash).encode("utf-8")).hexdigest()[:16]
+
+            columns = ", ".join(PRODUCT_COLUMNS)
+            conn.execute(conn.upsert_sql("productos", PRODUCT_COLUMNS, key=("id",), select=f"SELECT {columns} FROM productos_import"))
+            conn.execute("INSERT INTO stock_tallas (producto_id, talla, cantidad) SELECT producto_id, talla, cantidad FROM stock_tallas_import")
+            # Lo reservado sigue apartado: si no, al liberarlo se devolvería encima del feed
+            reservations.subtract_holds(conn, None if mode == "replace" else "SELECT id FROM productos_import")
+            conn.execute(conn.insert_ignore_sql(
+                "producto_colores", ("producto_id", "color"), select="SELECT producto_id, color FROM producto_colores_import"
+            ))
+            conn.execute(
+                conn.upsert_sql("catalogo_version", ("nombre", "version"), key=("nombre",)),
+                ("productos", version)
+            )
+
+            if mode == "replace":
+                facets.refresh(conn)
+            else:
+                facets.refresh(conn, groups["marcas"], groups["categorias"])
+
+
+def text_stream(binary: io.RawIOBase) -> io.TextIOWrapper:
+    """Stream de texto UTF-8 (con o sin BOM) sobre un stream binario"""
+    if not isinstance(binary, io.BufferedIOBase):
+        binary = io.BufferedReader(binary)
+    return io.TextIOWrapper(binary, encoding="utf-8-sig", newline="")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importación masiva del catálogo")
+    parser.add_argument("file", help="archivo CSV o NDJSON (- para stdin)")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="por defecto según la extensión")
+    parser.add_argument("--mode", choices=["replace", "upsert"], default="upsert")
+    parser.add_argument("--max-errors", type=int, help="cancelar si hay más filas con errores")
+    parser.add_argument("--db", help="ruta o URL de la base (por defecto DATABASE_URL)")
+    args = parser.parse_args()
+
+    fmt = args.format or ("csv" if args.file.lower().endswith(".csv") else "ndjson")
+
+    from database import Database
+    Database(args.db)  # crea las tablas si la base es nueva
+
+    def progress(report):
+        print(f"   {report['rows_read']} leídas, {report['rows_imported']} importadas, {report['errors']} errores", file=sys.stderr)
+
+    stream = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+    with text_stream(stream) as text:
+        report = CatalogImporter(args.db).run(text, fmt, args.mode, args.max_errors, progress)
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return report["status"] == "done"
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,73 @@
+"""
+Agrupa los mensajes que un cliente manda seguidos antes de llamar a la IA
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Any
+
+
+class MessageCoalescer:
+    """Junta los mensajes consecutivos de cada número dentro de una ventana corta"""
+
+    def __init__(self, callback: Callable[[str, List[Any]], Any], window: float = 2.0, max_wait: float = 6.0):
+        # callback(phone_number, items) se llama una sola vez por ráfaga, con los items en orden
+        self.callback = callback
+        self.window = window
+        self.max_wait = max(max_wait, window)
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        # Después de flush_all no se junta nada más (no habría quién lo entregue)
+        self._closed = False
+
+    def add(self, phone_number: str, item: Any) -> bool:
+        """Agrega un mensaje al buffer del cliente y reinicia la ventana; False si ya está cerrado"""
+        now = time.monotonic()
+
+        with self._lock:
+            if self._closed:
+                return False
+
+            pending = self._pending.get(phone_number)
+
+            if pending is None:
+                pending = {"items": [], "first": now, "timer": None}
+                self._pending[phone_number] = pending
+            elif pending["timer"] is not None:
+                pending["timer"].cancel()
+
+            pending["items"].append(item)
+
+            # Nunca esperar más de max_wait desde el primer mensaje de la ráfaga
+            delay = min(self.window, self.max_wait - (now - pending["first"]))
+            timer = threading.Timer(max(delay, 0), self._flush, args=(phone_number,))
+            timer.daemon = True
+            pending["timer"] = timer
+            timer.start()
+        return True
+
+    def _flush(self, phone_number: str):
+        """Entrega los mensajes acumulados de un cliente"""
+        with self._lock:
+            pending = self._pending.pop(phone_number, None)
+
+        if pending and pending["items"]:
+            self.callback(phone_number, pending["items"])
+
+    def flush_all(self):
+        """Entrega ya mismo todo lo pendiente y deja de juntar mensajes (al apagar el servidor)"""
+        with self._lock:
+            self._closed = True
+            pending = self._pending
+            self._pending = {}
+
+        for phone_number, entry in pending.items():
+            if entry["timer"] is not None:
+                entry["timer"].cancel()
+            if entry["items"]:
+                self.callback(phone_number, entry["items"])
+
+    def pending_count(self) -> int:
+        """Cantidad de clientes con mensajes esperando"""
+        with self._lock:
+            return len(self._pending)
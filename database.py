@@ -1,21 +1,115 @@
-import sqlite3
+import base64
+import hashlib
 import json
 import os
+import time
+from datetime import datetime, timezone
 from typing import Dict, List, Any
+import facets
+import metrics
+import reservations
+import storage
+import tracing
+import turn_cache
+import write_buffer
+
+# Órdenes de /products: columnas del keyset (siempre terminan en id) y si es descendente
+PRODUCT_SORTS = {
+    "id": (("id",), False),
+    "precio_asc": (("precio", "id"), False),
+    "precio_desc": (("precio", "id"), True),
+}
+
+# Agrupaciones del uso de la IA: columnas del GROUP BY y orden del resultado
+USAGE_GROUPS = {
+    "modelo": ((("hora", "ts - ts % 3600"), ("modelo", "modelo")), "1 DESC, 2"),
+    "cliente": ((("phone_number", "phone_number"),), "tokens DESC"),
+    "intencion": ((("intencion", "intencion"),), "tokens DESC"),
+}
+
+def select_productos(dialect) -> str:
+    """SELECT de productos (alias p) con el stock al día: sale de stock_tallas, que es lo que tocan las reservas"""
+    stock = dialect.json_object_sql("s.talla", "s.cantidad")
+    return f"SELECT p.*, (SELECT {stock} FROM stock_tallas s WHERE s.producto_id = p.id) FROM productos p"
+
+def producto_from_row(row: tuple) -> Dict[str, Any]:
+    """Producto de una fila de select_productos (productos.stock es el del último import; no se usa)"""
+    tallas = json.loads(row[5])
+    stock = json.loads(row[10]) if row[10] else {}
+    # En el orden de tallas; negativo es "apartado de más" (el feed trajo menos de lo reservado): sin stock
+    ordenado = {talla: max(stock.pop(talla), 0) for talla in tallas if talla in stock}
+    ordenado.update((talla, max(cantidad, 0)) for talla, cantidad in stock.items())
+    return {
+        "id": row[0],
+        "nombre": row[1],
+        "marca": row[2],
+        "categoria": row[3],
+        "precio": row[4],
+        "tallas": tallas,
+        "stock": ordenado,
+        "colores": json.loads(row[7]),
+        "descripcion": row[8],
+        "imagen": row[9]
+    }
+
+def encode_cursor(kind: str, values: List[Any]) -> str:
+    """Cursor opaco con los valores de la última fila de la página"""
+    raw = json.dumps({"k": kind, "v": values}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, kind: str) -> List[Any]:
+    """Valida y decodifica un cursor; ValueError si no corresponde a este listado"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("Cursor inválido")
+    
+    if not isinstance(data, dict) or data.get("k") != kind or not isinstance(data.get("v"), list):
+        raise ValueError("Cursor inválido para este listado")
+    return data["v"]
 
 class Database:
-    def __init__(self, db_path: str = "tienda.db"):
-        self.db_path = db_path
+    def __init__(self, db_path: str = None, data_dir: str = "data"):
+        # SQLite (ruta o sqlite:///) o PostgreSQL (postgresql://); por defecto DATABASE_URL
+        self.storage = storage.open_storage(db_path)
+        self.db_path = self.storage.key
+        # Carpeta con tienda.json y productos.json de esta tienda
+        self.data_dir = data_dir
         self.init_database()
         self.load_initial_data()
+        
+        # Historial y estados se guardan en lotes desde un único hilo escritor
+        self.writer = None
+        if os.getenv("DB_WRITE_BEHIND", "true").lower() == "true":
+            self.writer = write_buffer.get_writer(
+                self.storage,
+                max_batch=int(os.getenv("DB_FLUSH_BATCH", 500)),
+                flush_interval=float(os.getenv("DB_FLUSH_INTERVAL_MS", 50)) / 1000,
+                spill_dir=os.getenv("DB_SPILL_DIR", "spill")
+            )
+        
+        # Últimos intercambios de las conversaciones activas, en memoria. Solo si este proceso es
+        # el único que escribe el historial: lo que guarda otro worker (WEB_CONCURRENCY) u otra
+        # instancia contra la misma base no llega a este cache y el contexto quedaría incompleto
+        self.turns = None
+        single_writer = not self.storage.shared and int(os.getenv("WEB_CONCURRENCY", 1)) <= 1
+        if single_writer and int(os.getenv("HISTORY_CACHE_CUSTOMERS", 10000)) > 0:
+            self.turns = turn_cache.get_cache(
+                self.db_path,
+                max_customers=int(os.getenv("HISTORY_CACHE_CUSTOMERS", 10000)),
+                max_turns=int(os.getenv("HISTORY_CACHE_TURNS", 10))
+            )
     
     def init_database(self):
         """Inicializa la base de datos con las tablas necesarias"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self.storage.connect()
+        
+        # WAL (solo SQLite): los lectores siguen viendo el catálogo anterior mientras se escribe uno nuevo
+        conn.execute_ddl("PRAGMA journal_mode=WAL")
         
         # Tabla de productos
-        cursor.execute('''
+        conn.execute_ddl('''
             CREATE TABLE IF NOT EXISTS productos (
                 id INTEGER PRIMARY KEY,
                 nombre TEXT NOT NULL,
@@ -31,7 +125,7 @@ class Database:
         ''')
         
         # Tabla de tienda
-        cursor.execute('''
+        conn.execute_ddl('''
             CREATE TABLE IF NOT EXISTS tienda (
                 id INTEGER PRIMARY KEY,
                 nombre TEXT NOT NULL,
@@ -48,7 +142,7 @@ class Database:
         ''')
         
         # Tabla de conversaciones (opcional, para historial)
-        cursor.execute('''
+        conn.execute_ddl('''
             CREATE TABLE IF NOT EXISTS conversaciones (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 phone_number TEXT NOT NULL,
@@ -58,26 +152,156 @@ class Database:
             )
         ''')
         
+        # Tabla de mensajes ya recibidos (evita responder dos veces a reintentos del webhook)
+        conn.execute_ddl('''
+            CREATE TABLE IF NOT EXISTS mensajes_procesados (
+                message_id TEXT PRIMARY KEY,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Tabla de estados de entrega de los mensajes enviados (sent/delivered/read)
+        conn.execute_ddl('''
+            CREATE TABLE IF NOT EXISTS estados_mensajes (
+                message_id TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                destinatario TEXT,
+                timestamp INTEGER,
+                PRIMARY KEY (message_id, estado)
+            )
+        ''')
+        
+        # Tabla de trazas muestreadas (tiempos por etapa de cada respuesta)
+        conn.execute_ddl('''
+            CREATE TABLE IF NOT EXISTS trazas (
+                id TEXT PRIMARY KEY,
+                nombre TEXT NOT NULL,
+                inicio REAL NOT NULL,
+                duracion_ms REAL NOT NULL,
+                atributos TEXT NOT NULL,
+                spans TEXT NOT NULL
+            )
+        ''')
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_trazas_duracion ON trazas (duracion_ms)")
+        
+        # Uso de la IA: una fila chica por generación (tokens, latencia y resultado)
+        conn.execute_ddl('''
+            CREATE TABLE IF NOT EXISTS uso_ia (
+                ts INTEGER NOT NULL,
+                modelo TEXT NOT NULL,
+                phone_number TEXT,
+                intencion TEXT NOT NULL,
+                resultado TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                cached_tokens INTEGER NOT NULL,
+                latencia_ms INTEGER NOT NULL
+            )
+        ''')
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_uso_ia_ts ON uso_ia (ts)")
+        
+        # Versión de cada parte del catálogo (hash del contenido, para ETags)
+        conn.execute_ddl('''
+            CREATE TABLE IF NOT EXISTS catalogo_version (
+                nombre TEXT PRIMARY KEY,
+                version TEXT NOT NULL
+            )
+        ''')
+        
+        # Facetas materializadas (precios y tallas por marca/categoría)
+        conn.execute_ddl('''
+            CREATE TABLE IF NOT EXISTS facetas (
+                tipo TEXT NOT NULL,
+                valor TEXT NOT NULL,
+                productos INTEGER NOT NULL,
+                precio_min REAL NOT NULL,
+                precio_max REAL NOT NULL,
+                precio_mediana REAL NOT NULL,
+                tallas TEXT NOT NULL,
+                PRIMARY KEY (tipo, valor)
+            )
+        ''')
+        
+        # Stock y colores normalizados (para filtrar sin leer el JSON de cada producto)
+        conn.execute_ddl('''
+            CREATE TABLE IF NOT EXISTS stock_tallas (
+                producto_id INTEGER NOT NULL,
+                talla TEXT NOT NULL,
+                cantidad INTEGER NOT NULL,
+                PRIMARY KEY (producto_id, talla)
+            )
+        ''')
+        conn.execute_ddl('''
+            CREATE TABLE IF NOT EXISTS producto_colores (
+                producto_id INTEGER NOT NULL,
+                color TEXT NOT NULL,
+                PRIMARY KEY (color, producto_id)
+            )
+        ''')
+        # Los colores se guardan en minúsculas para que el filtro use la PK (bases de antes: se normalizan una vez)
+        conn.execute(
+            conn.insert_ignore_sql(
+                "producto_colores", ("producto_id", "color"),
+                select="SELECT producto_id, lower(color) FROM producto_colores WHERE color <> lower(color)"
+            )
+        )
+        conn.execute("DELETE FROM producto_colores WHERE color <> lower(color)")
+        conn.commit()
+        
+        # Reservas de stock desde el chat (ver reservations.py)
+        conn.execute_ddl('''
+            CREATE TABLE IF NOT EXISTS reservas (
+                id TEXT PRIMARY KEY,
+                phone_number TEXT NOT NULL,
+                producto_id INTEGER NOT NULL,
+                talla TEXT NOT NULL,
+                cantidad INTEGER NOT NULL,
+                estado TEXT NOT NULL,
+                creada TIMESTAMP NOT NULL,
+                vence TIMESTAMP NOT NULL,
+                actualizada TIMESTAMP NOT NULL
+            )
+        ''')
+        # Índices parciales: solo las reservas activas (las que busca el barredor)
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_reservas_vence ON reservas (vence) WHERE estado = 'reservada'")
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_reservas_talla ON reservas (producto_id, talla, vence) WHERE estado = 'reservada'")
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_reservas_phone ON reservas (phone_number, producto_id, talla) WHERE estado = 'reservada'")
+        
+        # Índices compuestos para la paginación por cursor (orden + desempate por id)
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_productos_precio ON productos (precio, id)")
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_productos_marca_precio ON productos (marca, precio, id)")
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_productos_categoria_precio ON productos (categoria, precio, id)")
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_stock_tallas_talla ON stock_tallas (talla, cantidad, producto_id)")
+        conn.execute_ddl("CREATE INDEX IF NOT EXISTS idx_conversaciones_phone ON conversaciones (phone_number, id)")
+        
         conn.commit()
         conn.close()
     
     def load_initial_data(self):
         """Carga los datos iniciales desde los archivos JSON"""
+        tienda_path = os.path.join(self.data_dir, "tienda.json")
+        productos_path = os.path.join(self.data_dir, "productos.json")
+        
         # Cargar datos de la tienda
-        if os.path.exists("data/tienda.json"):
-            with open("data/tienda.json", "r", encoding="utf-8") as f:
+        if os.path.exists(tienda_path):
+            with open(tienda_path, "r", encoding="utf-8") as f:
                 tienda_data = json.load(f)
                 self.save_tienda_data(tienda_data)
         
-        # Cargar datos de productos
-        if os.path.exists("data/productos.json"):
-            with open("data/productos.json", "r", encoding="utf-8") as f:
-                productos_data = json.load(f)
+        # Cargar datos de productos (solo si el archivo cambió: no pisar un catálogo importado)
+        if os.path.exists(productos_path):
+            with open(productos_path, "rb") as f:
+                raw = f.read()
+            
+            file_version = hashlib.sha1(raw).hexdigest()[:16]
+            if file_version != self.get_catalog_version("archivo_productos"):
+                productos_data = json.loads(raw.decode("utf-8"))
                 self.save_productos_data(productos_data["productos"])
+                self.set_catalog_version("archivo_productos", file_version)
     
     def save_tienda_data(self, tienda_data: Dict[str, Any]):
         """Guarda los datos de la tienda en la base de datos"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.storage.connect()
         cursor = conn.cursor()
         
         # Limpiar datos existentes
@@ -101,16 +325,20 @@ class Database:
             tienda_data.get("descripcion", "")
         ))
         
+        self._set_version(conn, "tienda", tienda_data)
+        
         conn.commit()
         conn.close()
     
     def save_productos_data(self, productos_data: List[Dict[str, Any]]):
         """Guarda los datos de productos en la base de datos"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.storage.connect()
         cursor = conn.cursor()
         
         # Limpiar datos existentes
         cursor.execute("DELETE FROM productos")
+        cursor.execute("DELETE FROM stock_tallas")
+        cursor.execute("DELETE FROM producto_colores")
         
         # Insertar nuevos datos
         for producto in productos_data:
@@ -131,17 +359,71 @@ class Database:
                 producto.get("imagen", "")
             ))
         
+        cursor.executemany(
+            "INSERT INTO stock_tallas (producto_id, talla, cantidad) VALUES (?, ?, ?)",
+            [
+                (producto["id"], talla, cantidad)
+                for producto in productos_data
+                for talla, cantidad in producto["stock"].items()
+            ]
+        )
+        cursor.executemany(
+            conn.insert_ignore_sql("producto_colores", ("producto_id", "color")),
+            [
+                (producto["id"], color.lower())
+                for producto in productos_data
+                for color in producto["colores"]
+            ]
+        )
+        reservations.subtract_holds(conn)
+        
+        self._set_version(conn, "productos", productos_data)
+        facets.refresh(conn)
+        
         conn.commit()
         conn.close()
     
-    def get_tienda_info(self) -> Dict[str, Any]:
-        """Obtiene la información de la tienda"""
-        conn = sqlite3.connect(self.db_path)
+    def _set_version(self, conn, nombre: str, data: Any):
+        """Guarda el hash del contenido: mismo catálogo, misma versión (aunque se reinicie)"""
+        version = hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        conn.execute(
+            conn.upsert_sql("catalogo_version", ("nombre", "version"), key=("nombre",)),
+            (nombre, version)
+        )
+    
+    def set_catalog_version(self, nombre: str, version: str):
+        """Registra la versión de una parte del catálogo"""
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            conn.upsert_sql("catalogo_version", ("nombre", "version"), key=("nombre",)),
+            (nombre, version)
+        )
+        
+        conn.commit()
+        conn.close()
+    
+    def get_catalog_version(self, nombre: str) -> str:
+        """Versión actual de "productos", "tienda", "stock" o "facetas" ("" si todavía no se cargó)"""
+        conn = self.storage.connect()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT * FROM tienda LIMIT 1")
+        cursor.execute("SELECT version FROM catalogo_version WHERE nombre = ?", (nombre,))
         row = cursor.fetchone()
         
+        conn.close()
+        return row[0] if row else ""
+    
+    def get_tienda_info(self) -> Dict[str, Any]:
+        """Obtiene la información de la tienda"""
+        with tracing.span("db.get_tienda_info"):
+            conn = self.storage.connect()
+            cursor = conn.cursor()
+            
+            cursor.execute("SELECT * FROM tienda LIMIT 1")
+            row = cursor.fetchone()
+        
         if row:
             tienda_info = {
                 "nombre": row[1],
@@ -163,97 +445,166 @@ class Database:
     
     def get_productos(self, categoria: str = None, marca: str = None) -> List[Dict[str, Any]]:
         """Obtiene la lista de productos con filtros opcionales"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.storage.connect()
         cursor = conn.cursor()
         
-        query = "SELECT * FROM productos WHERE 1=1"
+        query = select_productos(self.storage) + " WHERE 1=1"
         params = []
         
         if categoria:
-            query += " AND categoria = ?"
+            query += " AND p.categoria = ?"
             params.append(categoria)
         
         if marca:
-            query += " AND marca = ?"
+            query += " AND p.marca = ?"
             params.append(marca)
         
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
+        with tracing.span("db.get_productos"):
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
         
-        productos = []
-        for row in rows:
-            producto = {
-                "id": row[0],
-                "nombre": row[1],
-                "marca": row[2],
-                "categoria": row[3],
-                "precio": row[4],
-                "tallas": json.loads(row[5]),
-                "stock": json.loads(row[6]),
-                "colores": json.loads(row[7]),
-                "descripcion": row[8],
-                "imagen": row[9]
-            }
-            productos.append(producto)
+        productos = [producto_from_row(row) for row in rows]
         
         conn.close()
         return productos
     
+    def get_productos_pagina(self, cursor: str = None, limit: int = 50, sort: str = "id",
+                             categoria: str = None, marca: str = None, precio_min: float = None,
+                             precio_max: float = None, talla: str = None, color: str = None) -> Dict[str, Any]:
+        """Página de productos filtrada con paginación por cursor (costo estable por página)"""
+        if sort not in PRODUCT_SORTS:
+            raise ValueError(f"Orden inválido: {sort}")
+        
+        columns, descending = PRODUCT_SORTS[sort]
+        after = decode_cursor(cursor, sort) if cursor else None
+        if after is not None and len(after) != len(columns):
+            raise ValueError("Cursor inválido para este listado")
+        
+        query = select_productos(self.storage) + " WHERE 1=1"
+        params = []
+        
+        if categoria:
+            query += " AND p.categoria = ?"
+            params.append(categoria)
+        
+        if marca:
+            query += " AND p.marca = ?"
+            params.append(marca)
+        
+        if precio_min is not None:
+            query += " AND p.precio >= ?"
+            params.append(precio_min)
+        
+        if precio_max is not None:
+            query += " AND p.precio <= ?"
+            params.append(precio_max)
+        
+        if talla:
+            query += " AND EXISTS (SELECT 1 FROM stock_tallas s WHERE s.producto_id = p.id AND s.talla = ? AND s.cantidad > 0)"
+            params.append(talla)
+        
+        if color:
+            # Los ids salen de la PK (color, producto_id), sin recorrer productos: los colores están en minúsculas
+            query += " AND p.id IN (SELECT c.producto_id FROM producto_colores c WHERE c.color = ?)"
+            params.append(color.lower())
+        
+        # Keyset: seguir después de la última fila de la página anterior
+        key = ", ".join(f"p.{column}" for column in columns)
+        if after is not None:
+            query += f" AND ({key}) {'<' if descending else '>'} ({', '.join('?' for _ in columns)})"
+            params.extend(after)
+        
+        direction = " DESC" if descending else ""
+        query += " ORDER BY " + ", ".join(f"p.{column}{direction}" for column in columns) + " LIMIT ?"
+        # Una fila de más para saber si hay otra página
+        params.append(limit + 1)
+        
+        conn = self.storage.connect()
+        db_cursor = conn.cursor()
+        
+        with tracing.span("db.get_productos_pagina"):
+            db_cursor.execute(query, params)
+            rows = db_cursor.fetchall()
+        
+        conn.close()
+        
+        productos = [producto_from_row(row) for row in rows[:limit]]
+        
+        next_cursor = None
+        if len(rows) > limit:
+            last = productos[-1]
+            next_cursor = encode_cursor(sort, [last[column] for column in columns])
+        
+        return {"productos": productos, "next_cursor": next_cursor}
+    
+    def get_facetas(self) -> Dict[str, Any]:
+        """Facetas del catálogo: total, por marca y por categoría"""
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        with tracing.span("db.get_facetas"):
+            cursor.execute('''
+                SELECT tipo, valor, productos, precio_min, precio_max, precio_mediana, tallas
+                FROM facetas
+                ORDER BY tipo, productos DESC, valor
+            ''')
+            rows = cursor.fetchall()
+        
+            # Base creada antes de las facetas: se calculan una vez
+            if not rows and cursor.execute("SELECT 1 FROM productos LIMIT 1").fetchone():
+                facets.refresh(conn)
+                conn.commit()
+                cursor.execute("SELECT tipo, valor, productos, precio_min, precio_max, precio_mediana, tallas FROM facetas ORDER BY tipo, productos DESC, valor")
+                rows = cursor.fetchall()
+        
+        conn.close()
+        
+        facetas = {"total": None, "marcas": {}, "categorias": {}}
+        for row in rows:
+            faceta = {
+                "productos": row[2],
+                "precio_min": row[3],
+                "precio_max": row[4],
+                "precio_mediana": row[5],
+                "tallas": json.loads(row[6])
+            }
+            if row[0] == "marca":
+                facetas["marcas"][row[1]] = faceta
+            elif row[0] == "categoria":
+                facetas["categorias"][row[1]] = faceta
+            else:
+                facetas["total"] = faceta
+        
+        return facetas
+    
     def get_producto_por_id(self, producto_id: int) -> Dict[str, Any]:
         """Obtiene un producto específico por ID"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.storage.connect()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT * FROM productos WHERE id = ?", (producto_id,))
+        cursor.execute(select_productos(self.storage) + " WHERE p.id = ?", (producto_id,))
         row = cursor.fetchone()
         
-        if row:
-            producto = {
-                "id": row[0],
-                "nombre": row[1],
-                "marca": row[2],
-                "categoria": row[3],
-                "precio": row[4],
-                "tallas": json.loads(row[5]),
-                "stock": json.loads(row[6]),
-                "colores": json.loads(row[7]),
-                "descripcion": row[8],
-                "imagen": row[9]
-            }
-        else:
-            producto = {}
+        producto = producto_from_row(row) if row else {}
         
         conn.close()
         return producto
     
     def buscar_productos(self, termino: str) -> List[Dict[str, Any]]:
         """Busca productos por nombre, marca o descripción"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.storage.connect()
         cursor = conn.cursor()
         
-        query = '''
-            SELECT * FROM productos 
-            WHERE nombre LIKE ? OR marca LIKE ? OR descripcion LIKE ?
+        # LIKE de SQLite ya ignora mayúsculas; en PostgreSQL es ILIKE
+        query = f'''
+            {select_productos(self.storage)}
+            WHERE p.nombre {conn.like} ? OR p.marca {conn.like} ? OR p.descripcion {conn.like} ?
         '''
         termino_busqueda = f"%{termino}%"
         cursor.execute(query, (termino_busqueda, termino_busqueda, termino_busqueda))
         rows = cursor.fetchall()
         
-        productos = []
-        for row in rows:
-            producto = {
-                "id": row[0],
-                "nombre": row[1],
-                "marca": row[2],
-                "categoria": row[3],
-                "precio": row[4],
-                "tallas": json.loads(row[5]),
-                "stock": json.loads(row[6]),
-                "colores": json.loads(row[7]),
-                "descripcion": row[8],
-                "imagen": row[9]
-            }
-            productos.append(producto)
+        productos = [producto_from_row(row) for row in rows]
         
         conn.close()
         return productos
@@ -277,31 +628,49 @@ class Database:
     
     def save_conversation(self, phone_number: str, mensaje: str, respuesta: str):
         """Guarda una conversación en el historial"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO conversaciones (phone_number, mensaje, respuesta)
-            VALUES (?, ?, ?)
-        ''', (phone_number, mensaje, respuesta))
-        
-        conn.commit()
-        conn.close()
+        with metrics.stage("db_write"):
+            # Mismo formato que CURRENT_TIMESTAMP, pero con la hora real del mensaje
+            timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            sql = '''
+                INSERT INTO conversaciones (phone_number, mensaje, respuesta, timestamp)
+                VALUES (?, ?, ?, ?)
+            '''
+            params = (phone_number, mensaje, respuesta, timestamp)
+            
+            if self.turns is not None:
+                self.turns.append(phone_number, {"mensaje": mensaje, "respuesta": respuesta, "timestamp": timestamp})
+            
+            if self.writer:
+                self.writer.add(sql, params, key=phone_number)
+                return
+            
+            conn = self.storage.connect()
+            cursor = conn.cursor()
+            
+            cursor.execute(sql, params)
+            
+            conn.commit()
+            conn.close()
     
     def get_conversation_history(self, phone_number: str, limit: int = 10) -> List[Dict[str, Any]]:
         """Obtiene el historial de conversaciones de un número"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT mensaje, respuesta, timestamp 
-            FROM conversaciones 
-            WHERE phone_number = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        ''', (phone_number, limit))
-        
-        rows = cursor.fetchall()
+        with metrics.stage("history_query"):
+            # Lo último que respondimos a este cliente puede estar en el buffer
+            if self.writer:
+                self.writer.wait_for(phone_number)
+            
+            conn = self.storage.connect()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT mensaje, respuesta, timestamp 
+                FROM conversaciones 
+                WHERE phone_number = ? 
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (phone_number, limit))
+            
+            rows = cursor.fetchall()
         conversaciones = []
         
         for row in rows:
@@ -314,3 +683,294 @@ class Database:
         
         conn.close()
         return conversaciones
+    
+    def get_conversaciones_pagina(self, desde_id: int = 0, hasta_id: int = None, phone_number: str = None, limit: int = 1000) -> List[Dict[str, Any]]:
+        """Página de conversaciones con id > desde_id, en orden de id (paginación por clave)"""
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        query = "SELECT id, phone_number, mensaje, respuesta, timestamp FROM conversaciones WHERE id > ?"
+        params = [desde_id]
+        
+        if hasta_id is not None:
+            query += " AND id <= ?"
+            params.append(hasta_id)
+        
+        if phone_number:
+            query += " AND phone_number = ?"
+            params.append(phone_number)
+        
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+        
+        cursor.execute(query, params)
+        
+        conversaciones = [
+            {
+                "id": row[0],
+                "phone_number": row[1],
+                "mensaje": row[2],
+                "respuesta": row[3],
+                "timestamp": row[4]
+            }
+            for row in cursor.fetchall()
+        ]
+        
+        conn.close()
+        return conversaciones
+    
+    def get_ultimo_id_antes(self, timestamp: str) -> int:
+        """Mayor id de conversación anterior a un timestamp (0 si no hay)"""
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT MAX(id) FROM conversaciones WHERE timestamp < ?", (timestamp,))
+        ultimo_id = cursor.fetchone()[0] or 0
+        
+        conn.close()
+        return ultimo_id
+    
+    def delete_conversaciones_hasta(self, ultimo_id: int, chunk: int = 5000) -> int:
+        """Borra las conversaciones con id <= ultimo_id, de a bloques para no trabar a los escritores"""
+        borradas = 0
+        
+        while True:
+            conn = self.storage.connect(timeout=30)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                DELETE FROM conversaciones
+                WHERE id IN (SELECT id FROM conversaciones WHERE id <= ? LIMIT ?)
+            ''', (ultimo_id, chunk))
+            count = cursor.rowcount
+            
+            conn.commit()
+            conn.close()
+            
+            borradas += count
+            if count < chunk:
+                return borradas
+    
+    def get_conversaciones_antes(self, phone_number: str, cursor: str = None, limit: int = 10) -> Dict[str, Any]:
+        """Historial de un número del más nuevo al más viejo, paginado por cursor"""
+        before = decode_cursor(cursor, "conversaciones")[0] if cursor else None
+        
+        if self.writer:
+            self.writer.wait_for(phone_number)
+        
+        conn = self.storage.connect()
+        db_cursor = conn.cursor()
+        
+        query = "SELECT id, mensaje, respuesta, timestamp FROM conversaciones WHERE phone_number = ?"
+        params = [phone_number]
+        
+        if before is not None:
+            query += " AND id < ?"
+            params.append(before)
+        
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit + 1)
+        
+        db_cursor.execute(query, params)
+        rows = db_cursor.fetchall()
+        conn.close()
+        
+        conversaciones = [
+            {
+                "id": row[0],
+                "mensaje": row[1],
+                "respuesta": row[2],
+                "timestamp": row[3]
+            }
+            for row in rows[:limit]
+        ]
+        
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor("conversaciones", [conversaciones[-1]["id"]])
+        
+        return {"conversaciones": conversaciones, "next_cursor": next_cursor}
+    
+    def get_recent_turns(self, phone_number: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """Últimos intercambios de un número, desde memoria si la conversación está activa"""
+        if self.turns is not None:
+            cached = self.turns.get(phone_number, limit)
+            if cached is not None:
+                return cached
+        
+        if self.turns is None or limit > self.turns.max_turns:
+            return self.get_conversation_history(phone_number, limit)
+        
+        # Miss: se trae el tope del cache para que los próximos mensajes no consulten la base
+        history = self.get_conversation_history(phone_number, self.turns.max_turns)
+        self.turns.load(phone_number, history)
+        return history[:limit]
+    
+    def mark_message_processed(self, message_id: str) -> bool:
+        """Registra un mensaje entrante; devuelve False si ya se había recibido"""
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute(conn.insert_ignore_sql("mensajes_procesados", ("message_id",)), (message_id,))
+        is_new = cursor.rowcount == 1
+        
+        conn.commit()
+        conn.close()
+        return is_new
+    
+    def unmark_message_processed(self, message_id: str):
+        """Olvida un mensaje entrante que no se llegó a procesar (su reintento vuelve a entrar)"""
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute("DELETE FROM mensajes_procesados WHERE message_id = ?", (message_id,))
+        
+        conn.commit()
+        conn.close()
+    
+    def save_estados(self, estados: List[tuple]):
+        """Guarda en bloque estados de entrega (message_id, estado, destinatario, timestamp)"""
+        # Los reintentos del webhook repiten estados: se ignoran
+        sql = self.storage.insert_ignore_sql("estados_mensajes", ("message_id", "estado", "destinatario", "timestamp"))
+        
+        if self.writer:
+            self.writer.add_many(sql, estados)
+            return
+        
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        cursor.executemany(sql, estados)
+        
+        conn.commit()
+        conn.close()
+    
+    def flush(self, timeout: float = None) -> bool:
+        """Espera a que se guarden las escrituras diferidas"""
+        return self.writer.flush(timeout) if self.writer else True
+    
+    def save_trazas(self, trazas: List[Dict[str, Any]]):
+        """Guarda un lote de trazas"""
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        cursor.executemany(conn.upsert_sql(
+            "trazas", ("id", "nombre", "inicio", "duracion_ms", "atributos", "spans"), key=("id",)
+        ), [
+            (
+                traza["id"],
+                traza["name"],
+                traza["started_at"],
+                traza["duration_ms"],
+                json.dumps(traza["attrs"]),
+                json.dumps(traza["spans"])
+            )
+            for traza in trazas
+        ])
+        
+        conn.commit()
+        conn.close()
+    
+    def save_uso_ia(self, modelo: str, phone_number: str, intencion: str, resultado: str,
+                    prompt_tokens: int = 0, completion_tokens: int = 0, cached_tokens: int = 0, latencia_ms: int = 0):
+        """Registra el uso de una generación de la IA"""
+        sql = '''
+            INSERT INTO uso_ia (ts, modelo, phone_number, intencion, resultado,
+                                prompt_tokens, completion_tokens, cached_tokens, latencia_ms)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''
+        params = (int(time.time()), modelo, phone_number, intencion, resultado,
+                  prompt_tokens, completion_tokens, cached_tokens, latencia_ms)
+        
+        if self.writer:
+            self.writer.add(sql, params)
+            return
+        
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute(sql, params)
+        
+        conn.commit()
+        conn.close()
+    
+    def get_uso_ia(self, group: str = "modelo", desde: int = None, hasta: int = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Uso de la IA agregado por hora y modelo, por cliente o por intención (desde/hasta en epoch)"""
+        if group not in USAGE_GROUPS:
+            raise ValueError(f"Agrupación inválida: {group}")
+        
+        columns, order = USAGE_GROUPS[group]
+        select = ", ".join(f"{expr} AS {name}" for name, expr in columns)
+        group_by = ", ".join(str(index) for index in range(1, len(columns) + 1))
+        
+        query = f'''
+            SELECT {select},
+                   COUNT(*) AS generaciones,
+                   SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens),
+                   SUM(prompt_tokens + completion_tokens) AS tokens,
+                   SUM(CASE WHEN resultado = 'ok' THEN 0 ELSE 1 END),
+                   AVG(latencia_ms), MAX(latencia_ms)
+            FROM uso_ia
+            WHERE ts >= ?
+        '''
+        params = [desde or 0]
+        
+        if hasta is not None:
+            query += " AND ts < ?"
+            params.append(hasta)
+        
+        query += f" GROUP BY {group_by} ORDER BY {order} LIMIT ?"
+        params.append(limit)
+        
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute(query, params)
+        
+        uso = []
+        for row in cursor.fetchall():
+            fila = {name: value for (name, _), value in zip(columns, row)}
+            generaciones, prompt, completion, cached, tokens, errores, latencia_media, latencia_max = row[len(columns):]
+            fila.update({
+                "generaciones": generaciones,
+                "prompt_tokens": int(prompt),
+                "completion_tokens": int(completion),
+                "cached_tokens": int(cached),
+                # Parte del prompt que el proveedor sirvió desde su cache
+                "cache_ratio": round(int(cached) / int(prompt), 3) if prompt else 0.0,
+                "tokens": int(tokens),
+                "errores": int(errores),
+                "latencia_media_ms": round(float(latencia_media), 1),
+                "latencia_max_ms": latencia_max
+            })
+            uso.append(fila)
+        
+        conn.close()
+        return uso
+    
+    def get_trazas_lentas(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Obtiene las trazas guardadas más lentas"""
+        conn = self.storage.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, nombre, inicio, duracion_ms, atributos, spans
+            FROM trazas
+            ORDER BY duracion_ms DESC
+            LIMIT ?
+        ''', (limit,))
+        
+        trazas = [
+            {
+                "id": row[0],
+                "name": row[1],
+                "started_at": row[2],
+                "duration_ms": row[3],
+                "attrs": json.loads(row[4]),
+                "spans": json.loads(row[5])
+            }
+            for row in cursor.fetchall()
+        ]
+        
+        conn.close()
+        return trazas
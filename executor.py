@@ -0,0 +1,90 @@
+"""
+Ejecutor por conversación: orden estricto por cliente y paralelismo entre clientes
+"""
+
+import logging
+import queue
+import threading
+import time
+import zlib
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedExecutor:
+    """Reparte tareas en shards por clave; cada shard tiene un solo worker y una cola acotada"""
+
+    def __init__(self, shards: int = 8, max_queue: int = 100, put_timeout: float = 1.0, name: str = "conversation"):
+        self.put_timeout = put_timeout
+        self._closed = False
+        # Se activa al apagar: corta las esperas de los workers (ver sleep)
+        self._stopping = threading.Event()
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=max_queue) for _ in range(max(shards, 1))]
+        self._workers: List[threading.Thread] = []
+
+        for index, shard_queue in enumerate(self._queues):
+            worker = threading.Thread(
+                target=self._run,
+                args=(shard_queue,),
+                name=f"{name}-shard-{index}",
+                daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _shard_for(self, key: str) -> queue.Queue:
+        """Elige siempre el mismo shard para la misma clave"""
+        return self._queues[zlib.crc32(key.encode("utf-8")) % len(self._queues)]
+
+    def submit(self, key: str, fn: Callable, *args, **kwargs) -> bool:
+        """Encola una tarea; devuelve False si el shard está lleno o cerrado"""
+        if self._closed:
+            logger.error(f"Ejecutor cerrado, descartando tarea para {key}")
+            return False
+
+        try:
+            self._shard_for(key or "").put((fn, args, kwargs), timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            logger.error(f"Cola del shard llena, descartando tarea para {key}")
+            return False
+
+    def _run(self, shard_queue: queue.Queue):
+        """Loop del worker de un shard"""
+        while True:
+            task = shard_queue.get()
+            try:
+                if task is None:
+                    return
+                fn, args, kwargs = task
+                fn(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"Error ejecutando tarea: {str(e)}")
+            finally:
+                shard_queue.task_done()
+
+    def sleep(self, seconds: float) -> bool:
+        """Espera dentro de una tarea sin soltar el shard; False si se cortó porque el ejecutor se apaga"""
+        return not self._stopping.wait(seconds)
+
+    def queue_depth(self) -> int:
+        """Cantidad total de tareas esperando en todos los shards"""
+        return sum(shard_queue.qsize() for shard_queue in self._queues)
+
+    def shutdown(self, wait: bool = True, timeout: float = None) -> bool:
+        """Termina los workers después de procesar lo que ya estaba encolado"""
+        self._closed = True
+        self._stopping.set()
+        for shard_queue in self._queues:
+            shard_queue.put(None)
+
+        if not wait:
+            return False
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for worker in self._workers:
+            remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+            worker.join(remaining)
+
+        return not any(worker.is_alive() for worker in self._workers)
@@ -0,0 +1,101 @@
+"""
+Facetas materializadas del catálogo
+
+Cantidad de productos, precio mínimo/máximo/mediana y tallas con stock, por
+marca, por categoría y del catálogo completo. Se guardan en la tabla
+facetas y se recalculan solo los grupos que tocó cada escritura, dentro de
+la misma transacción; leerlas cuesta una consulta a una tabla de pocas filas.
+"""
+
+import json
+from typing import Dict, Iterable, Optional
+
+# Tipo de faceta → columna de productos que agrupa (None = catálogo completo)
+GROUPS = {
+    "marca": "marca",
+    "categoria": "categoria",
+    "total": None,
+}
+
+TOTAL = "total"
+
+
+def refresh(conn, marcas: Optional[Iterable[str]] = None, categorias: Optional[Iterable[str]] = None):
+    """Recalcula las facetas (todas si no se indican grupos) usando la conexión/transacción dada"""
+    if marcas is None and categorias is None:
+        conn.execute("DELETE FROM facetas")
+        marcas = [row[0] for row in conn.execute("SELECT DISTINCT marca FROM productos")]
+        categorias = [row[0] for row in conn.execute("SELECT DISTINCT categoria FROM productos")]
+
+    for valor in set(marcas or ()):
+        _refresh_group(conn, "marca", valor)
+    for valor in set(categorias or ()):
+        _refresh_group(conn, "categoria", valor)
+    _refresh_group(conn, TOTAL, "")
+
+
+def affected_groups(conn, producto_ids_query: str, params: tuple = ()) -> Dict[str, set]:
+    """Marcas y categorías actuales de los productos que se van a modificar"""
+    rows = conn.execute(
+        f"SELECT marca, categoria FROM productos WHERE id IN ({producto_ids_query})",
+        params
+    ).fetchall()
+    return {
+        "marcas": {row[0] for row in rows},
+        "categorias": {row[1] for row in rows}
+    }
+
+
+def _refresh_group(conn, tipo: str, valor: str):
+    column = GROUPS[tipo]
+    where = f"WHERE {column} = ?" if column else ""
+    params = (valor,) if column else ()
+
+    count, precio_min, precio_max = conn.execute(
+        f"SELECT COUNT(*), MIN(precio), MAX(precio) FROM productos {where}", params
+    ).fetchone()
+
+    if not count:
+        conn.execute("DELETE FROM facetas WHERE tipo = ? AND valor = ?", (tipo, valor))
+        return
+
+    # Mediana recorriendo el índice (columna, precio, id) hasta la mitad del grupo
+    middle = conn.execute(
+        f"SELECT precio FROM productos {where} ORDER BY precio LIMIT ? OFFSET ?",
+        params + (2 - count % 2, (count - 1) // 2)
+    ).fetchall()
+    mediana = sum(row[0] for row in middle) / len(middle)
+
+    tallas_where = f"AND p.{column} = ?" if column else ""
+    tallas = sorted(
+        (row[0] for row in conn.execute(
+            f'''
+            SELECT DISTINCT s.talla FROM stock_tallas s
+            JOIN productos p ON p.id = s.producto_id
+            WHERE s.cantidad > 0 {tallas_where}
+            ''',
+            params
+        )),
+        key=_talla_key
+    )
+
+    conn.execute(
+        conn.upsert_sql(
+            "facetas",
+            ("tipo", "valor", "productos", "precio_min", "precio_max", "precio_mediana", "tallas"),
+            key=("tipo", "valor")
+        ),
+        (tipo, valor, count, precio_min, precio_max, mediana, json.dumps(tallas))
+    )
+
+
+def _talla_key(talla: str):
+    try:
+        return (0, float(talla), talla)
+    except ValueError:
+        return (1, 0, talla)
+
+
+def format_price(value: float) -> str:
+    """45000 → "45.000" (formato argentino)"""
+    return f"{int(round(value)):,}".replace(",", ".")
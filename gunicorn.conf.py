@@ -0,0 +1,60 @@
+"""
+Configuración de Gunicorn para producción
+
+Uso: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# Cada worker tiene su propio ejecutor por conversación; con más de un worker
+# el orden por cliente solo se garantiza dentro de cada proceso
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+
+# Tiempo que tiene un worker para terminar lo pendiente después de SIGTERM
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 90))
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+
+# Margen dentro de graceful_timeout para cerrar el proceso antes del SIGKILL del master
+SHUTDOWN_MARGIN = 5
+
+
+def post_worker_init(worker):
+    """Con SIGTERM el worker corta los webhooks nuevos y empieza a vaciar las colas enseguida"""
+    import signal
+    import sys
+
+    app_module = sys.modules.get("app")
+    if app_module is None:
+        return
+
+    # gunicorn solo llama a worker_exit después de esperar las conexiones abiertas:
+    # el vaciado arranca con la señal y las dos esperas comparten el mismo plazo
+    handle_exit = worker.handle_exit
+
+    def on_sigterm(sig, frame):
+        app_module.begin_shutdown(timeout=max(graceful_timeout - SHUTDOWN_MARGIN, 1))
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+
+def worker_exit(server, worker):
+    """Al salir el worker, esperar lo que quede del vaciado"""
+    import sys
+
+    # Si el worker ya había muerto esto corre en el master: no hay nada que vaciar
+    app_module = sys.modules.get("app")
+    if os.getpid() != worker.pid or app_module is None:
+        return
+
+    app_module.wait_shutdown(timeout=max(graceful_timeout - SHUTDOWN_MARGIN, 1))
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga de punta a punta sin gastar cuota real
+
+Levanta dos stubs locales (OpenRouter /chat/completions y Graph /messages)
+con latencia y tasa de error configurables, arranca el bot apuntando a
+ellos y le manda webhooks sintéticos a una tasa fija.
+
+Cada mensaje lleva un token único (lt-N). El stub de OpenRouter lo repite
+en la respuesta y el stub de Graph registra cuándo llega, así se mide la
+latencia de punta a punta y se cuentan respuestas perdidas o duplicadas.
+Las de respaldo (límite de uso, carga, error de la IA) no llevan token: se
+cuentan aparte y cubren los mensajes sin respuesta de ese cliente. Los
+límites de uso y la admisión del bot arrancan desactivados; se prenden con
+--rate-limit-per-minute / --admission-max-inflight.
+
+Uso:
+    python loadtest.py --rate 50 --duration 30 --customers 200
+    python loadtest.py --llm-latency lognormal:800,0.5 --llm-error-rate 0.02
+    python loadtest.py --app-url http://localhost:5000   # bot ya levantado
+    python loadtest.py --rate-limit-per-minute 6 --admission-max-inflight 16
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TOKEN_RE = re.compile(r"lt-\d+")
+
+# Textos sin palabras de la lista de precios, para que todos pasen por la IA
+SAMPLE_TEXTS = [
+    "hola", "tenés nike?", "en 42", "para correr qué me recomendás",
+    "hay en negro?", "hacen envíos a mar del plata?", "qué horario tienen",
+    "me gustan las adidas", "busco algo para el gym", "tenés talle 38?"
+]
+
+
+class LatencyModel:
+    """Distribución de latencia: fixed:MS, uniform:MIN,MAX o lognormal:MEDIANA_MS,SIGMA"""
+
+    def __init__(self, spec: str):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(value) for value in params.split(",") if value]
+
+    def sample(self) -> float:
+        """Latencia en segundos"""
+        if self.kind == "fixed":
+            return self.params[0] / 1000
+        if self.kind == "uniform":
+            return random.uniform(self.params[0], self.params[1]) / 1000
+        if self.kind == "lognormal":
+            median_ms, sigma = self.params
+            return random.lognormvariate(0, sigma) * median_ms / 1000
+        raise ValueError(f"Distribución desconocida: {self.kind}")
+
+
+class StubState:
+    """Lo que registran los stubs durante la prueba"""
+
+    def __init__(self, llm_latency: LatencyModel, llm_error_rate: float,
+                 send_latency: LatencyModel, send_error_rate: float):
+        self.llm_latency = llm_latency
+        self.llm_error_rate = llm_error_rate
+        self.send_latency = send_latency
+        self.send_error_rate = send_error_rate
+        self.lock = threading.Lock()
+        self.replies = {}
+        # Respuestas sin token (de respaldo: límite de uso, carga o error de la IA) por teléfono
+        self.untracked_replies = {}
+        self.llm_calls = 0
+        self.llm_errors = 0
+        self.send_errors = 0
+
+
+def make_handler(state: StubState):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+
+            if self.path.endswith("/chat/completions"):
+                self._chat(body)
+            elif self.path.endswith("/messages"):
+                self._message(body)
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def _chat(self, body: dict):
+            time.sleep(state.llm_latency.sample())
+            with state.lock:
+                state.llm_calls += 1
+                failed = random.random() < state.llm_error_rate
+                if failed:
+                    state.llm_errors += 1
+            if failed:
+                self._reply(500, {"error": "stub error"})
+                return
+
+            # Solo los tokens del último mensaje del cliente, no los del historial
+            content = "".join(message["content"] for message in body["messages"])
+            tokens = TOKEN_RE.findall(body["messages"][-1]["content"])
+
+            self._reply(200, {
+                "choices": [{"message": {"role": "assistant", "content": "respuesta " + " ".join(tokens)}}],
+                "usage": {"prompt_tokens": len(content) // 4, "completion_tokens": 12, "total_tokens": len(content) // 4 + 12}
+            })
+
+        def _message(self, body: dict):
+            time.sleep(state.send_latency.sample())
+            received = time.time()
+            with state.lock:
+                if random.random() < state.send_error_rate:
+                    state.send_errors += 1
+                    failed = True
+                else:
+                    failed = False
+                    text = body.get("text", {}).get("body", "")
+                    tokens = TOKEN_RE.findall(text)
+                    if not tokens:
+                        phone = body.get("to", "")
+                        state.untracked_replies[phone] = state.untracked_replies.get(phone, 0) + 1
+                    for token in tokens:
+                        state.replies.setdefault(token, []).append(received)
+            if failed:
+                self._reply(500, {"error": "stub error"})
+            else:
+                self._reply(200, {"messages": [{"id": "wamid.stub"}]})
+
+    return StubHandler
+
+
+def start_stub(state: StubState) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_app(args, stub_url: str) -> subprocess.Popen:
+    """Arranca el bot en un directorio temporal apuntando a los stubs"""
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    shutil.copytree(os.path.join(REPO_DIR, "data"), os.path.join(workdir, "data"))
+
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": REPO_DIR,
+        "PORT": str(args.app_port),
+        "OPENROUTER_API_KEY": "stub-key",
+        "OPENROUTER_BASE_URL": stub_url,
+        "WHATSAPP_GRAPH_URL": stub_url,
+        "WHATSAPP_TOKEN": "stub-token",
+        "WHATSAPP_PHONE_NUMBER_ID": "123456",
+        "WHATSAPP_VERIFY_TOKEN": "stub-verify",
+        "FLASK_ENV": "production",
+        "COALESCE_WINDOW_SECONDS": str(args.coalesce_window),
+        # Límites de uso y admisión desactivados salvo que se pidan: si no, se mide la respuesta de respaldo
+        "RATE_LIMIT_CUSTOMER_PER_MINUTE": str(args.rate_limit_per_minute),
+        "RATE_LIMIT_GLOBAL_PER_MINUTE": str(args.rate_limit_global_per_minute),
+        "ADMISSION_MAX_INFLIGHT": str(args.admission_max_inflight),
+        "LOG_LEVEL": "WARNING"
+    })
+
+    command = args.server_cmd.split() + ["-c", os.path.join(REPO_DIR, "gunicorn.conf.py"), "app:app"]
+    process = subprocess.Popen(command, cwd=workdir, env=env)
+    process.workdir = workdir
+
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{app_url}/", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError("El bot no arrancó")
+
+
+def message_payload(phone: str, text: str, message_id: str) -> dict:
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{
+            "id": "loadtest",
+            "changes": [{
+                "field": "messages",
+                "value": {
+                    "messaging_product": "whatsapp",
+                    "metadata": {"display_phone_number": "5490000000000", "phone_number_id": "123456"},
+                    "contacts": [{"profile": {"name": "Load Test"}, "wa_id": phone}],
+                    "messages": [{
+                        "from": phone,
+                        "id": message_id,
+                        "timestamp": str(int(time.time())),
+                        "type": "text",
+                        "text": {"body": text}
+                    }]
+                }
+            }]
+        }]
+    }
+
+
+def status_payload(phone: str, message_id: str) -> dict:
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{
+            "id": "loadtest",
+            "changes": [{
+                "field": "messages",
+                "value": {
+                    "messaging_product": "whatsapp",
+                    "metadata": {"display_phone_number": "5490000000000", "phone_number_id": "123456"},
+                    "statuses": [{
+                        "id": message_id,
+                        "status": random.choice(["sent", "delivered", "read"]),
+                        "timestamp": str(int(time.time())),
+                        "recipient_id": phone
+                    }]
+                }
+            }]
+        }]
+    }
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_load(args, app_url: str, state: StubState) -> dict:
+    """Manda webhooks a tasa fija (loop abierto) y espera las respuestas"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+
+    sent = {}
+    post_errors = [0]
+    lock = threading.Lock()
+    run_id = int(time.time())
+
+    def post(payload: dict, token: str = None, phone: str = None):
+        try:
+            sent_at = time.time()
+            response = session.post(f"{app_url}/webhook", json=payload, timeout=30)
+            if token:
+                with lock:
+                    sent[token] = (sent_at, phone)
+            if response.status_code != 200:
+                with lock:
+                    post_errors[0] += 1
+        except requests.RequestException:
+            with lock:
+                post_errors[0] += 1
+
+    total = int(args.rate * args.duration)
+    phones = [f"549{9000000000 + index}" for index in range(args.customers)]
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for index in range(total):
+            delay = start + index / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            phone = random.choice(phones)
+            token = f"lt-{index}"
+            text = f"{random.choice(SAMPLE_TEXTS)} {token}"
+            pool.submit(post, message_payload(phone, text, f"wamid.{run_id}.{index}"), token, phone)
+
+            for status_index in range(args.status_ratio):
+                pool.submit(post, status_payload(phone, f"wamid.out.{run_id}.{index}.{status_index}"))
+
+    send_window = time.time() - start
+
+    # Esperar a que lleguen las respuestas pendientes
+    deadline = time.time() + args.drain
+    while time.time() < deadline:
+        with state.lock:
+            if len(state.replies) + sum(state.untracked_replies.values()) >= len(sent):
+                break
+        time.sleep(0.2)
+
+    with state.lock:
+        replies = {token: list(times) for token, times in state.replies.items()}
+        untracked = dict(state.untracked_replies)
+
+    latencies = [
+        (replies[token][0] - sent_at) * 1000
+        for token, (sent_at, _) in sent.items() if token in replies
+    ]
+
+    # Un mensaje sin respuesta con token cuenta como respondido si su cliente recibió una de respaldo
+    unanswered = {}
+    for token, (_, phone) in sent.items():
+        if token not in replies:
+            unanswered[phone] = unanswered.get(phone, 0) + 1
+    lost = sum(max(count - untracked.get(phone, 0), 0) for phone, count in unanswered.items())
+    last_reply = max((times[0] for times in replies.values()), default=start)
+
+    return {
+        "messages_sent": len(sent),
+        "webhook_errors": post_errors[0],
+        "replies_received": len(replies),
+        "lost_replies": lost,
+        "duplicate_replies": sum(len(times) - 1 for times in replies.values()),
+        "fallback_replies": sum(untracked.values()),
+        "llm_calls": state.llm_calls,
+        "llm_errors": state.llm_errors,
+        "send_errors": state.send_errors,
+        "offered_rate": args.rate,
+        "sustained_throughput": round(len(replies) / max(last_reply - start, send_window), 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 1),
+            "p95": round(percentile(latencies, 0.95), 1),
+            "p99": round(percentile(latencies, 0.99), 1),
+            "max": round(max(latencies, default=0), 1)
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga con stubs locales de OpenRouter y Graph API")
+    parser.add_argument("--rate", type=float, default=20, help="mensajes por segundo")
+    parser.add_argument("--duration", type=float, default=30, help="segundos enviando mensajes")
+    parser.add_argument("--customers", type=int, default=100, help="cantidad de clientes distintos")
+    parser.add_argument("--status-ratio", type=int, default=0, help="webhooks de estado por cada mensaje")
+    parser.add_argument("--concurrency", type=int, default=64, help="conexiones simultáneas del generador")
+    parser.add_argument("--drain", type=float, default=60, help="segundos máximos esperando respuestas al final")
+    parser.add_argument("--llm-latency", default="lognormal:800,0.4", help="fixed:MS | uniform:MIN,MAX | lognormal:MEDIANA,SIGMA")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--send-latency", default="uniform:20,80")
+    parser.add_argument("--send-error-rate", type=float, default=0.0)
+    parser.add_argument("--coalesce-window", type=float, default=0, help="COALESCE_WINDOW_SECONDS del bot")
+    parser.add_argument("--rate-limit-per-minute", type=float, default=0,
+                        help="RATE_LIMIT_CUSTOMER_PER_MINUTE del bot (0 = sin límite por cliente)")
+    parser.add_argument("--rate-limit-global-per-minute", type=float, default=0,
+                        help="RATE_LIMIT_GLOBAL_PER_MINUTE del bot (0 = sin límite global)")
+    parser.add_argument("--admission-max-inflight", type=int, default=0,
+                        help="ADMISSION_MAX_INFLIGHT del bot (0 = sin control de admisión)")
+    parser.add_argument("--app-url", help="usar un bot ya levantado (debe apuntar a --stub-port)")
+    parser.add_argument("--app-port", type=int, default=5099)
+    parser.add_argument("--server-cmd", default="gunicorn", help="comando para levantar el bot")
+    parser.add_argument("--output", help="archivo JSON con el reporte")
+    args = parser.parse_args()
+
+    state = StubState(
+        LatencyModel(args.llm_latency), args.llm_error_rate,
+        LatencyModel(args.send_latency), args.send_error_rate
+    )
+    stub = start_stub(state)
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    print(f"🧪 Stubs escuchando en {stub_url}")
+
+    process = None
+    try:
+        if args.app_url:
+            app_url = args.app_url
+        else:
+            process = start_app(args, stub_url)
+            app_url = f"http://127.0.0.1:{args.app_port}"
+
+        print(f"🚀 Enviando {args.rate} msg/s durante {args.duration}s a {app_url}...")
+        report = run_load(args, app_url, state)
+
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=120)
+            shutil.rmtree(process.workdir, ignore_errors=True)
+        stub.shutdown()
+
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "report": report}, f, indent=2)
+
+    return report["lost_replies"] == 0 and report["duplicate_replies"] == 0
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,164 @@
+"""
+Logging estructurado y no bloqueante
+
+Los hilos de los requests solo encolan el LogRecord; el formateo, la
+redacción y la escritura los hace un único hilo (QueueListener).
+
+Variables de entorno:
+- LOG_LEVEL: nivel general (INFO por defecto)
+- LOG_LEVELS: niveles por categoría, ej. "whatsapp=WARNING,openrouter=DEBUG"
+- LOG_SAMPLE_RATES: muestreo por evento, ej. "webhook_payload=0.01,ai_reply=0.1"
+- LOG_FORMAT: "json" (por defecto) o "text"
+- LOG_REDACT_PHONES: "true" (por defecto) oculta los números de teléfono
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+from datetime import datetime, timezone
+from typing import Dict
+
+_listener = None
+
+# Atributos estándar de LogRecord: lo demás se considera campo estructurado
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_PHONE_RE = re.compile(r"\b(\d{4,})(\d{4})\b")
+_BEARER_RE = re.compile(r"(Bearer\s+)[A-Za-z0-9._\-]+")
+_OPENROUTER_KEY_RE = re.compile(r"sk-or-[A-Za-z0-9\-_]+")
+
+
+def _parse_pairs(value: str) -> Dict[str, str]:
+    """Convierte "a=1,b=2" en un dict"""
+    pairs = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            key, val = item.split("=", 1)
+            pairs[key.strip()] = val.strip()
+    return pairs
+
+
+class SamplingFilter(logging.Filter):
+    """Deja pasar solo una fracción de los eventos de alto volumen"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "event", None))
+        return rate is None or random.random() < rate
+
+
+class RedactionFilter(logging.Filter):
+    """Oculta tokens, API keys y números de teléfono"""
+
+    def __init__(self, secrets=None, redact_phones: bool = True):
+        super().__init__()
+        self.secrets = [s for s in (secrets or []) if s and len(s) >= 6]
+        self.redact_phones = redact_phones
+
+    def redact(self, text: str) -> str:
+        for secret in self.secrets:
+            text = text.replace(secret, "[REDACTED]")
+        text = _BEARER_RE.sub(r"\1[REDACTED]", text)
+        text = _OPENROUTER_KEY_RE.sub("[REDACTED]", text)
+        if self.redact_phones:
+            text = _PHONE_RE.sub(lambda m: "*" * len(m.group(1)) + m.group(2), text)
+        return text
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = self.redact(record.getMessage())
+        record.args = None
+        for key, value in list(vars(record).items()):
+            if key not in _RESERVED_ATTRS and isinstance(value, str):
+                setattr(record, key, self.redact(value))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por evento"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "category": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS:
+                data[key] = value
+
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Encola el record sin formatearlo y descarta si la cola está llena"""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # El formateo se hace en el hilo del listener, no en el del request
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+def setup_logging():
+    """Configura el logging de la aplicación (idempotente)"""
+    global _listener
+    if _listener is not None:
+        return
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    for category, level in _parse_pairs(os.getenv("LOG_LEVELS", "")).items():
+        logging.getLogger(category).setLevel(level.upper())
+
+    output = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "json") == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    output.addFilter(RedactionFilter(
+        secrets=[os.getenv("OPENROUTER_API_KEY"), os.getenv("WHATSAPP_TOKEN"), os.getenv("WHATSAPP_VERIFY_TOKEN")],
+        redact_phones=os.getenv("LOG_REDACT_PHONES", "true").lower() == "true"
+    ))
+
+    log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    rates = {event: float(rate) for event, rate in _parse_pairs(os.getenv("LOG_SAMPLE_RATES", "")).items()}
+    queue_handler.addFilter(SamplingFilter(rates))
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Vacía la cola de logs (al apagar)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
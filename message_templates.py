@@ -0,0 +1,219 @@
+"""
+Mensajes salientes con plantillas fijas y cache de lo renderizado
+
+Cada tipo de mensaje (tarjeta de producto, catálogo, info de la tienda,
+horarios, contacto) es una plantilla definida una sola vez acá. Lo
+renderizado se guarda por versión del catálogo: los mensajes de la tienda se
+arman todos juntos cuando cambia la versión "tienda" y las tarjetas de
+producto se cachean por id mientras no cambie "productos". El stock no es
+parte de lo cacheado (se completa al enviar), así las reservas no vacían el
+cache. Los mensajes más enviados cuestan una búsqueda en un dict, sin tocar
+la base.
+"""
+
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+
+STORE_DEFAULTS = {
+    "nombre": "Zapatillas Dolores",
+    "ubicacion": "Dolores, Buenos Aires, Argentina",
+    "direccion": "Calle Principal 123, Dolores, Buenos Aires",
+    "telefono": "+54 9 11 1234-5678",
+    "email": "info@zapatillasdolores.com",
+}
+
+STORE_INFO = """🏪 *{nombre}*
+
+📍 *Ubicación:* {ubicacion}
+🏠 *Dirección:* {direccion}
+📞 *Teléfono:* {telefono}
+📧 *Email:* {email}
+
+🕒 *Horarios de Atención:*
+{horarios}
+
+💳 *Métodos de Pago:*
+{metodos_pago}
+
+🚚 *Envíos:*
+{envios}
+
+¡Te esperamos en nuestra tienda! 🛍️"""
+
+STORE_HOURS = "🕒 *Horarios de Atención:*\n\n{horarios}"
+
+STORE_CONTACT = """📞 *Información de Contacto:*
+
+🏠 *Dirección:* {direccion}
+📞 *Teléfono:* {telefono}
+📧 *Email:* {email}"""
+
+PRODUCT_CARD = """🛍️ *{marca} {nombre}*
+
+💰 *Precio:* ${precio:,}
+📏 *Tallas disponibles:* {tallas}
+🎨 *Colores:* {colores}
+📦 *Stock total:* {stock} unidades
+
+📝 *Descripción:*
+{descripcion}
+
+¿Te interesa este producto? ¿Qué talla necesitas?"""
+
+CATALOG_ENTRY = """*{marca} {nombre}*
+   💰 ${precio:,}
+   📏 Tallas: {tallas}
+   🎨 Colores: {colores}"""
+
+CATALOG_HEADER = "🛍️ *Catálogo de Productos*\n\n"
+CATALOG_MORE = "... y {resto} productos más.\n\n"
+CATALOG_FOOTER = "¿Te interesa algún producto específico? Puedo darte más detalles."
+CATALOG_EMPTY = "No encontré productos que coincidan con tu búsqueda. ¿Podrías ser más específico?"
+CATALOG_SIZE = 5
+
+# Lugar del stock en la tarjeta cacheada
+STOCK_MARK = "\0"
+
+# Mensajes de la tienda que se arman juntos (los botones de respuesta rápida)
+STORE_MESSAGES = ("tienda_info", "horarios", "contacto")
+
+
+def render_store(tienda_info: Dict[str, Any]) -> Dict[str, str]:
+    """Todos los mensajes de la tienda a partir de su info"""
+    values = {name: tienda_info.get(name) or default for name, default in STORE_DEFAULTS.items()}
+    horarios = "\n".join(
+        f"• {dia.replace('_', ' ').title()}: {horario}" for dia, horario in tienda_info.get("horarios", {}).items()
+    )
+
+    return {
+        "tienda_info": STORE_INFO.format(
+            horarios=horarios,
+            metodos_pago="\n".join(f"• {metodo}" for metodo in tienda_info.get("metodos_pago", [])),
+            envios="\n".join(f"• {tipo.title()}: {precio}" for tipo, precio in tienda_info.get("envios", {}).items()),
+            **values
+        ),
+        "horarios": STORE_HOURS.format(horarios=horarios),
+        "contacto": STORE_CONTACT.format(**values),
+    }
+
+
+def render_product(product: Dict[str, Any]) -> Tuple[str, str]:
+    """Tarjeta partida donde va el stock (cambia con cada reserva): (antes, después)"""
+    card = PRODUCT_CARD.format(
+        marca=product["marca"],
+        nombre=product["nombre"],
+        precio=product["precio"],
+        tallas=", ".join(product["tallas"]),
+        colores=", ".join(product["colores"]),
+        stock=STOCK_MARK,
+        descripcion=product["descripcion"]
+    )
+    head, _, tail = card.partition(STOCK_MARK)
+    return head, tail
+
+
+def render_catalog_entry(product: Dict[str, Any]) -> str:
+    return CATALOG_ENTRY.format(
+        marca=product["marca"],
+        nombre=product["nombre"],
+        precio=product["precio"],
+        tallas=", ".join(product["tallas"]),
+        colores=", ".join(product["colores"])
+    )
+
+
+class MessageCache:
+    """Mensajes renderizados de una tienda, descartados cuando cambia la versión del catálogo"""
+
+    def __init__(self, db, check_interval: float = 1.0, max_entries: int = 4096):
+        self.db = db
+        # Cada cuánto se relee la versión de la base (otro worker pudo cambiar el catálogo)
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+        self._versions: Dict[str, tuple] = {}
+        self._rendered: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def version(self, kind: str) -> str:
+        now = time.monotonic()
+        cached = self._versions.get(kind)
+        if cached and now - cached[1] < self.check_interval:
+            return cached[0]
+
+        version = self.db.get_catalog_version(kind)
+        self._versions[kind] = (version, now)
+        return version
+
+    def invalidate(self):
+        """Fuerza a releer las versiones (después de cambiar el catálogo en este proceso)"""
+        self._versions.clear()
+
+    def _entries(self, kind: str) -> Dict[Any, str]:
+        """Lo renderizado con la versión actual de kind (vacío si la versión cambió)"""
+        version = self.version(kind)
+        with self._lock:
+            rendered = self._rendered.get(kind)
+            if rendered is None or rendered[0] != version or len(rendered[1]) > self.max_entries:
+                rendered = (version, {})
+                self._rendered[kind] = rendered
+            return rendered[1]
+
+    def store(self, name: str) -> str:
+        """Mensaje de la tienda ("tienda_info", "horarios" o "contacto")"""
+        entries = self._entries("tienda")
+        message = entries.get(name)
+        if message is None:
+            metrics.MESSAGE_CACHE.inc("miss")
+            # Un solo viaje a la base arma los tres
+            entries.update(render_store(self.db.get_tienda_info()))
+            return entries[name]
+
+        metrics.MESSAGE_CACHE.inc("hit")
+        return message
+
+    def product(self, product: Dict[str, Any]) -> str:
+        """Tarjeta de un producto"""
+        head, tail = self._cached_product(("producto", product.get("id")), product, render_product)
+        return f"{head}{sum(product['stock'].values())}{tail}"
+
+    def catalog(self, products: Optional[List[Dict[str, Any]]] = None) -> str:
+        """Catálogo con los primeros productos (sin products: el catálogo completo de la tienda)"""
+        if products is None:
+            entries = self._entries("productos")
+            message = entries.get("catalogo")
+            if message is None:
+                metrics.MESSAGE_CACHE.inc("miss")
+                message = self.catalog(self.db.get_productos())
+                entries["catalogo"] = message
+            else:
+                metrics.MESSAGE_CACHE.inc("hit")
+            return message
+
+        if not products:
+            return CATALOG_EMPTY
+
+        message = CATALOG_HEADER + "".join(
+            f"{index}. {self._cached_product(('catalogo', product.get('id')), product, render_catalog_entry)}\n\n"
+            for index, product in enumerate(products[:CATALOG_SIZE], 1)
+        )
+        if len(products) > CATALOG_SIZE:
+            message += CATALOG_MORE.format(resto=len(products) - CATALOG_SIZE)
+        return message + CATALOG_FOOTER
+
+    def _cached_product(self, key: tuple, product: Dict[str, Any], render) -> Any:
+        # Productos sin id (armados a mano) no se cachean
+        if key[1] is None:
+            return render(product)
+
+        entries = self._entries("productos")
+        message = entries.get(key)
+        if message is None:
+            metrics.MESSAGE_CACHE.inc("miss")
+            message = render(product)
+            entries[key] = message
+        else:
+            metrics.MESSAGE_CACHE.inc("hit")
+        return message
@@ -0,0 +1,196 @@
+"""
+Métricas estilo Prometheus con agregación por hilo
+
+Cada hilo escribe en su propia celda (sin locks en el camino caliente);
+el endpoint /metrics suma las celdas al momento de exponerlas.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+import tracing
+
+_registry: List["_Metric"] = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    """Base: una celda por hilo, registrada la primera vez que el hilo escribe"""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cells: List[Tuple[threading.Thread, Dict]] = []
+        # Valores de hilos que ya terminaron
+        self._retired: Dict = {}
+        _registry.append(self)
+
+    def _cell(self) -> Dict:
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = {}
+            self._local.cell = cell
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+        return cell
+
+    def _merge(self, into: Dict, cell: Dict):
+        raise NotImplementedError
+
+    def _collect(self) -> Dict:
+        """Suma las celdas de todos los hilos"""
+        with self._lock:
+            alive = []
+            for thread, cell in self._cells:
+                if thread.is_alive():
+                    alive.append((thread, cell))
+                else:
+                    self._merge(self._retired, cell)
+            self._cells = alive
+
+            total: Dict = {}
+            self._merge(total, self._retired)
+            for _, cell in alive:
+                self._merge(total, dict(cell))
+        return total
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self._collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        cell = self._cell()
+        cell[labels] = cell.get(labels, 0) + amount
+
+    def _merge(self, into: Dict, cell: Dict):
+        for labels, value in cell.items():
+            into[labels] = into.get(labels, 0) + value
+
+
+class Gauge(Counter):
+    """Gauge con inc/dec por hilo o calculado con una función al exponer"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def _collect(self) -> Dict:
+        if self._function is not None:
+            return {(): self._function()}
+        return super()._collect()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str):
+        cell = self._cell()
+        entry = cell.get(labels)
+        if entry is None:
+            entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            cell[labels] = entry
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def _merge(self, into: Dict, cell: Dict):
+        for labels, (counts, total, count) in cell.items():
+            target = into.get(labels)
+            if target is None:
+                target = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                into[labels] = target
+            for index, bucket_count in enumerate(list(counts)):
+                target[0][index] += bucket_count
+            target[1] += total
+            target[2] += count
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, (counts, total, count) in sorted(self._collect().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                le_label = 'le="' + le + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+def render() -> str:
+    """Texto en formato de exposición de Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Métricas de la aplicación
+STAGE_SECONDS = Histogram(
+    "bot_stage_duration_seconds",
+    "Duración de cada etapa del procesamiento de un mensaje",
+    ("stage",)
+)
+FALLBACKS = Counter("bot_fallback_responses_total", "Respuestas de respaldo enviadas", ("reason",))
+ERRORS = Counter("bot_errors_total", "Errores por componente", ("component",))
+INTENTS = Counter("bot_intents_total", "Mensajes recibidos por intención detectada", ("intent",))
+WEBHOOK_EVENTS = Counter("bot_webhook_events_total", "Eventos recibidos por el webhook por tipo", ("kind",))
+HISTORY_CACHE = Counter("bot_history_cache_total", "Lecturas del historial reciente por resultado del cache", ("result",))
+MESSAGE_CACHE = Counter("bot_message_cache_total", "Mensajes salientes por resultado del cache de plantillas", ("result",))
+CATALOG_CACHE = Counter("bot_catalog_cache_total", "Respuestas del catálogo por resultado del cache", ("result",))
+RESERVATIONS = Counter("bot_reservations_total", "Operaciones de reserva de stock por resultado", ("result",))
+TENANT_MESSAGES = Counter("bot_tenant_messages_total", "Mensajes recibidos por tienda", ("tenant",))
+RATE_LIMITED = Counter("bot_rate_limited_total", "Mensajes que superaron el límite de uso de la IA", ("scope", "action"))
+ADMISSION = Counter("bot_admission_total", "Decisiones del control de admisión a la IA por carril", ("lane", "decision"))
+LLM_TOKENS = Counter("bot_llm_tokens_total", "Tokens de la IA por modelo y tipo (prompt, completion, cached)", ("model", "kind"))
+INFLIGHT_GENERATIONS = Gauge("bot_inflight_generations", "Generaciones de IA en curso")
+DB_WRITE_PENDING = Gauge("bot_db_write_pending", "Lotes de escritura esperando el group commit")
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Mensajes esperando en el ejecutor por conversación")
+
+
+@contextmanager
+def stage(name: str):
+    """Mide la duración de una etapa (histograma y span de la traza actual)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        STAGE_SECONDS.observe(end - start, name)
+        # La misma medición queda como span en la traza del mensaje, si hay una
+        tracing.record(name, start, end)
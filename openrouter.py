@@ -1,24 +1,82 @@
 import requests
 import json
 import os
+import time
+import logging
 from typing import Dict, List, Any
 from database import Database
+from facets import format_price
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Intenciones detectadas por palabras clave (en orden de prioridad)
+INTENT_KEYWORDS = [
+    ("precio", ["precio", "cuesta", "vale", "costo"]),
+    ("horario", ["horario", "abierto", "cerrado", "atención"]),
+    ("ubicacion", ["ubicación", "dirección", "donde", "ubicado"]),
+    ("marca", ["nike", "adidas", "puma", "converse", "vans"]),
+    ("talla", ["talla", "tallas", "talle", "número", "calzado", "stock"]),
+    ("envio", ["envío", "envios", "delivery", "entrega"]),
+    ("pago", ["pago", "pagar", "tarjeta", "efectivo"])
+]
+
+FALLBACK_RESPONSES = {
+    "precio": "Los precios dependen del modelo. ¿Te interesa alguna marca específica? Te paso los precios y más detalles.",
+    "horario": "Estamos abiertos de lunes a viernes de 9 a 18, y sábados de 9 a 13. Los domingos cerramos. ¿Te viene bien algún día?",
+    "ubicacion": "Estamos en Calle Principal 123, Dolores. También nos podés llamar al +54 9 11 1234-5678.",
+    "marca": "Buenísimo, tenemos Nike, Adidas, Puma, Converse y Vans. ¿Te interesa alguna marca en particular? Te puedo contar más sobre precios y tallas.",
+    "talla": "Tenemos desde la 36 hasta la 45. ¿Qué talla necesitás? También te puedo ayudar a encontrar el modelo perfecto.",
+    "envio": "Hacemos envíos:\n• Local (Dolores): Gratis\n• Provincia: Desde $500\n• Nacional: Desde $800\n\n¿Te interesa algún producto?",
+    "pago": "Aceptamos efectivo, tarjeta de débito, crédito, transferencia bancaria y Mercado Pago. ¿En qué más te puedo ayudar?",
+    "general": "Hola, soy María de Zapatillas Dolores. ¿Cómo va? ¿Buscás algo en particular? Te puedo ayudar con información sobre productos, precios, horarios y más."
+}
+
+FACETS_TTL = float(os.getenv("FACETS_TTL_SECONDS", 5))
+
+def detect_intent(user_message: str) -> str:
+    """Detecta la intención del mensaje por palabras clave"""
+    user_message_lower = user_message.lower()
+    for intent, keywords in INTENT_KEYWORDS:
+        if any(word in user_message_lower for word in keywords):
+            return intent
+    return "general"
 
 class OpenRouterAI:
-    def __init__(self):
+    def __init__(self, db: Database = None):
         self.api_key = os.getenv("OPENROUTER_API_KEY")
         # Usar modelo específico como respaldo
         self.model = "meta-llama/llama-3.2-3b-instruct:free"
-        self.base_url = "https://openrouter.ai/api/v1"
-        self.db = Database()
+        self.base_url = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+        # Base de la tienda que atiende (cada tienda tiene la suya)
+        self.db = db if db is not None else Database()
+        # Facetas del catálogo cacheadas unos segundos (se consultan en cada prompt)
+        self._facetas = None
+        self._facetas_at = 0.0
+        # Prompt de sistema de la versión actual del catálogo
+        self._system_prompt = None
+        self._system_version = None
+        self._system_prompt_at = 0.0
         
-    def get_context_prompt(self, phone_number: str = None) -> str:
-        """Genera el prompt de contexto con información de la tienda y historial de conversación"""
+    def get_system_prompt(self) -> str:
+        """Prompt de sistema de la tienda, armado una vez por versión del catálogo"""
+        now = time.monotonic()
+        if self._system_prompt is None or now - self._system_prompt_at > FACETS_TTL:
+            # Sin "stock": las reservas no lo invalidan (los talles agotados cambian "facetas")
+            version = tuple(self.db.get_catalog_version(kind) for kind in ("tienda", "productos", "facetas"))
+            if self._system_prompt is None or version != self._system_version:
+                self._system_prompt = self.build_system_prompt()
+                self._system_version = version
+            self._system_prompt_at = now
+        return self._system_prompt
+    
+    def build_system_prompt(self) -> str:
+        """Persona, tienda, catálogo e instrucciones (sin nada del cliente: igual byte a byte para todos)"""
         tienda_info = self.db.get_tienda_info()
         productos = self.db.get_productos()
         
         # Crear contexto más argentino e informal
-        contexto = f"""Sos María, vendedora de {tienda_info.get('nombre', 'Zapatillas Dolores')} en Dolores, Buenos Aires.
+        contexto = f"""Sos María, vendedora de {tienda_info.get('nombre', 'Zapatillas Dolores')} en {tienda_info.get('ubicacion', 'Dolores, Buenos Aires')}.
 
 INFORMACIÓN DE LA TIENDA:
 - Nombre: {tienda_info.get('nombre', 'Zapatillas Dolores')}
@@ -37,9 +95,32 @@ PRODUCTOS DISPONIBLES:
 """
         
         for producto in productos[:5]:  # Solo los primeros 5 productos
-            contexto += f"- {producto['marca']} {producto['nombre']} - ${producto['precio']:,}\n"
+            contexto += f"- {producto['marca']} {producto['nombre']} (código {producto['id']}) - ${producto['precio']:,}\n"
+        
+        # Rangos reales del catálogo (facetas materializadas, sin recorrer productos)
+        # Se releen: el prompt queda cacheado hasta la próxima versión
+        self._facetas = None
+        facetas = self.get_facetas()
+        marcas_ejemplo = "Nike, Adidas, Puma, Converse"
+        
+        # El ejemplo de precios sale del catálogo real (sin catálogo, sin números)
+        ejemplo_precios = ", ".join(f"las {producto['nombre']} están {format_price(producto['precio'])}" for producto in productos[:3])
+        respuesta_precios = f"{ejemplo_precios[0].upper()}{ejemplo_precios[1:]}. ¿Cuál te llama?" if ejemplo_precios else "Depende del modelo. ¿Qué marca te interesa así te paso los precios?"
+        
+        if facetas["total"]:
+            total = facetas["total"]
+            respuesta_precios = f"Los precios van desde {format_price(total['precio_min'])} hasta {format_price(total['precio_max'])}. {respuesta_precios}"
+            marcas_ejemplo = ", ".join(list(facetas["marcas"])[:4])
+            
+            contexto += f"""
+RESUMEN DEL CATÁLOGO:
+- {total['productos']} modelos, precios desde ${format_price(total['precio_min'])} hasta ${format_price(total['precio_max'])} (la mayoría cerca de ${format_price(total['precio_mediana'])})
+"""
+            for marca, faceta in facetas["marcas"].items():
+                tallas = f", talles {faceta['tallas'][0]} al {faceta['tallas'][-1]}" if faceta["tallas"] else ", sin stock"
+                contexto += f"- {marca}: {faceta['productos']} modelos, de ${format_price(faceta['precio_min'])} a ${format_price(faceta['precio_max'])}{tallas}\n"
         
-        contexto += """
+        contexto += f"""
 INSTRUCCIONES IMPORTANTES:
 - Sos argentina, hablá como tal (vos, che, boludo, etc.)
 - NO uses exclamaciones al principio de las frases
@@ -58,16 +139,18 @@ INSTRUCCIONES IMPORTANTES:
 - Si el cliente ya te dijo algo, no lo preguntes de nuevo
 - Evitá respuestas genéricas como "¿En qué puedo ayudarte?"
 - Sé específica y útil en tus respuestas
+- Si el cliente quiere comprar, decile que escriba "reservar <código> talle <talle>" y se lo apartamos
+- Los mensajes anteriores de la conversación son intercambios reales con este cliente: si hay, no te presentes de nuevo y seguí desde ahí
 
 EJEMPLOS DE RESPUESTAS:
 Cliente: "Hola"
 María: "Hola, che. ¿Qué onda? ¿Buscás algo en particular o solo quieres hacer una visita a la tienda?"
 
 Cliente: "¿Qué productos tienen?"
-María: "Tenemos de todo, Nike, Adidas, Puma, Converse... ¿Te interesa alguna marca? También tenemos las Air Force 1 que están buenísimas"
+María: "Tenemos de todo, {marcas_ejemplo}... ¿Te interesa alguna marca? También tenemos las Air Force 1 que están buenísimas"
 
 Cliente: "¿Cuánto cuestan?"
-María: "Los precios van desde 25.000 hasta 75.000. Las Converse están 25.000, las Nike Air Force 1 45.000, y las Air Jordan 1 75.000. ¿Cuál te llama?"
+María: "{respuesta_precios}"
 
 Cliente: "Quiero algo para el gym"
 María: "Perfecto, para el gym te recomiendo las Adidas Ultraboost 22, son re cómodas. También tenemos las Nike Air Max 270. ¿Hacés más cardio o pesas?"
@@ -78,76 +161,108 @@ María: "Amo el estilo retro, las Puma Suede Classic están buenísimas para eso
 IMPORTANTE: Hablá como argentina, súper informal, natural. NO uses exclamaciones al principio. Solo al final si es necesario. NO repitas información ya dada.
 """
         
-        # Agregar historial de conversación si existe
+        return contexto
+    
+    def build_messages(self, user_message: str, phone_number: str = None) -> List[Dict[str, str]]:
+        """Sistema fijo, los últimos intercambios como turnos reales y el mensaje nuevo"""
+        messages = [{"role": "system", "content": self.get_system_prompt()}]
+        
+        # Todo lo que varía va después del prefijo fijo (el proveedor lo cachea)
         if phone_number:
-            history = self.db.get_conversation_history(phone_number, 5)
-            if history:
-                contexto += "\n\nCONTEXTO DE LA CONVERSACIÓN:\n"
-                contexto += "Recordá que ya hablaste con este cliente antes. No te presentes de nuevo.\n"
-                contexto += "Últimos intercambios:\n"
-                for msg in reversed(history):  # Orden cronológico
-                    contexto += f"- Cliente: {msg['mensaje']}\n"
-                    contexto += f"- Vos: {msg['respuesta']}\n"
-                contexto += "\nIMPORTANTE: Continuá la conversación naturalmente, sin repetir lo que ya dijiste. Si el cliente ya te dijo algo específico, no lo preguntes de nuevo. Mantené el contexto y sé útil."
+            for msg in reversed(self.db.get_recent_turns(phone_number, 5)):  # Orden cronológico
+                messages.append({"role": "user", "content": msg["mensaje"]})
+                messages.append({"role": "assistant", "content": msg["respuesta"]})
         
-        return contexto
+        messages.append({"role": "user", "content": user_message})
+        return messages
+    
+    def build_request(self, user_message: str, phone_number: str = None) -> Dict[str, Any]:
+        """Arma headers y payload de la petición a OpenRouter"""
+        messages = self.build_messages(user_message, phone_number)
+        logger.debug("Prompt armado: %d mensajes, %d caracteres", len(messages),
+                     sum(len(message["content"]) for message in messages), extra={"event": "prompt_size"})
+        
+        # Configurar headers
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://zapatillasdolores.com",
+            "X-Title": "Bot WhatsApp Zapatillas Dolores"
+        }
+        
+        # Configurar payload con modelo específico
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": 200,
+            "temperature": 0.8,
+            "top_p": 0.9
+        }
+        
+        return {
+            "url": f"{self.base_url}/chat/completions",
+            "headers": headers,
+            "payload": payload
+        }
     
-    def generate_response(self, user_message: str, phone_number: str = None) -> str:
+    def parse_response(self, data: Dict[str, Any]) -> str:
+        """Extrae el texto de la respuesta de OpenRouter"""
+        return data["choices"][0]["message"]["content"].strip()
+    
+    def record_usage(self, phone_number: str, intent: str, outcome: str, started: float, data: Dict[str, Any] = None):
+        """Registra tokens, latencia, modelo y resultado de una generación"""
+        latency_ms = int((time.perf_counter() - started) * 1000)
+        data = data or {}
+        usage = data.get("usage") or {}
+        # OpenRouter informa el modelo que respondió (puede no ser el pedido)
+        model = data.get("model") or self.model
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        completion_tokens = usage.get("completion_tokens") or 0
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        
+        metrics.LLM_TOKENS.inc(model, "prompt", amount=prompt_tokens)
+        metrics.LLM_TOKENS.inc(model, "completion", amount=completion_tokens)
+        metrics.LLM_TOKENS.inc(model, "cached", amount=cached_tokens)
+        
+        # La contabilidad nunca corta una respuesta
+        try:
+            self.db.save_uso_ia(model, phone_number, intent, outcome,
+                                prompt_tokens, completion_tokens, cached_tokens, latency_ms)
+        except Exception as e:
+            logger.error("Error guardando uso de la IA: %s", e)
+            metrics.ERRORS.inc("usage")
+    
+    def generate_response(self, user_message: str, phone_number: str = None, intent: str = None) -> str:
         """Genera una respuesta usando OpenRouter AI"""
+        intent = intent or detect_intent(user_message)
+        started = None
+        metrics.INFLIGHT_GENERATIONS.inc()
         try:
             # Verificar que la API key esté configurada
             if not self.api_key:
-                print("Error: OPENROUTER_API_KEY no está configurada")
+                logger.error("OPENROUTER_API_KEY no está configurada")
+                metrics.FALLBACKS.inc("no_api_key")
                 return self.get_fallback_response(user_message)
             
-            print(f"🔑 API Key configurada: {self.api_key[:10]}...")
-            
-            # Obtener contexto de la tienda con historial
-            context_prompt = self.get_context_prompt(phone_number)
-            print(f"📝 Contexto generado: {len(context_prompt)} caracteres")
-            
-            # Preparar el mensaje completo
-            full_prompt = f"{context_prompt}\n\nCliente pregunta: {user_message}\n\nRespuesta:"
-            print(f"📤 Prompt completo: {len(full_prompt)} caracteres")
-            
-            # Configurar headers
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://zapatillasdolores.com",
-                "X-Title": "Bot WhatsApp Zapatillas Dolores"
-            }
-            
-            # Configurar payload con modelo específico
-            payload = {
-                "model": self.model,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": full_prompt
-                    }
-                ],
-                "max_tokens": 200,
-                "temperature": 0.8,
-                "top_p": 0.9
-            }
-            
-            print(f"🚀 Enviando petición a OpenRouter con modelo: {self.model}")
+            with metrics.stage("prompt_build"):
+                request_data = self.build_request(user_message, phone_number)
             
             # Realizar la petición
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
-            print(f"📡 Respuesta de OpenRouter: {response.status_code}")
+            started = time.perf_counter()
+            with metrics.stage("llm"):
+                response = requests.post(
+                    request_data["url"],
+                    headers=request_data["headers"],
+                    json=request_data["payload"],
+                    timeout=30
+                )
             
             if response.status_code == 200:
                 data = response.json()
-                ai_response = data["choices"][0]["message"]["content"].strip()
-                print(f"✅ IA respuesta: {ai_response}")
+                ai_response = self.parse_response(data)
+                self.record_usage(phone_number, intent, "ok", started, data)
+                started = None  # ya contabilizada: si falla al guardar no se cuenta dos veces
+                logger.debug("IA respuesta: %s", ai_response, extra={"event": "ai_reply"})
                 
                 # Guardar conversación en la base de datos
                 if phone_number:
@@ -155,42 +270,61 @@ IMPORTANTE: Hablá como argentina, súper informal, natural. NO uses exclamacion
                 
                 return ai_response
             else:
-                print(f"❌ Error en OpenRouter API: {response.status_code}")
-                print(f"❌ Respuesta completa: {response.text}")
+                logger.error("Error en OpenRouter API: %s %s", response.status_code, response.text)
+                self.record_usage(phone_number, intent, "http_error", started)
+                metrics.FALLBACKS.inc("http_error")
                 return self.get_fallback_response(user_message)
                 
         except Exception as e:
-            print(f"❌ Error generando respuesta: {str(e)}")
+            logger.error("Error generando respuesta: %s", e)
+            # Solo cuenta si la petición llegó a salir
+            if started is not None:
+                self.record_usage(phone_number, intent, "exception", started)
+            metrics.ERRORS.inc("openrouter")
+            metrics.FALLBACKS.inc("exception")
             return self.get_fallback_response(user_message)
+        finally:
+            metrics.INFLIGHT_GENERATIONS.dec()
+    
+    def get_facetas(self) -> Dict[str, Any]:
+        """Facetas del catálogo (cacheadas FACETS_TTL_SECONDS)"""
+        now = time.monotonic()
+        if self._facetas is None or now - self._facetas_at > FACETS_TTL:
+            try:
+                self._facetas = self.db.get_facetas()
+            except Exception as e:
+                logger.error("Error leyendo facetas: %s", e)
+                self._facetas = self._facetas or {"total": None, "marcas": {}, "categorias": {}}
+            self._facetas_at = now
+        return self._facetas
     
     def get_fallback_response(self, user_message: str) -> str:
         """Respuesta de respaldo cuando falla la IA"""
-        user_message_lower = user_message.lower()
-        
         # Respuestas básicas basadas en palabras clave
-        if any(word in user_message_lower for word in ["precio", "cuesta", "vale", "costo"]):
-            return "Los precios van desde 25.000 hasta 75.000. ¿Te interesa alguna marca específica? Te puedo dar más detalles."
+        intent = detect_intent(user_message)
         
-        elif any(word in user_message_lower for word in ["horario", "abierto", "cerrado", "atención"]):
-            return "Estamos abiertos de lunes a viernes de 9 a 18, y sábados de 9 a 13. Los domingos cerramos. ¿Te viene bien algún día?"
-        
-        elif any(word in user_message_lower for word in ["ubicación", "dirección", "donde", "ubicado"]):
-            return "Estamos en Calle Principal 123, Dolores. También nos podés llamar al +54 9 11 1234-5678."
-        
-        elif any(word in user_message_lower for word in ["nike", "adidas", "puma", "converse", "vans"]):
-            return "Buenísimo, tenemos Nike, Adidas, Puma, Converse y Vans. ¿Te interesa alguna marca en particular? Te puedo contar más sobre precios y tallas."
-        
-        elif any(word in user_message_lower for word in ["talla", "tallas", "número", "calzado"]):
-            return "Tenemos desde la 36 hasta la 45. ¿Qué talla necesitás? También te puedo ayudar a encontrar el modelo perfecto."
+        # Precios y marcas salen del catálogo real cuando hay facetas
+        facetas = self.get_facetas()
+        if intent == "precio" and facetas["total"]:
+            total = facetas["total"]
+            return (
+                f"Los precios van desde {format_price(total['precio_min'])} hasta {format_price(total['precio_max'])}. "
+                "¿Te interesa alguna marca específica? Te puedo dar más detalles."
+            )
         
-        elif any(word in user_message_lower for word in ["envío", "envios", "delivery", "entrega"]):
-            return "Hacemos envíos:\n• Local (Dolores): Gratis\n• Provincia: Desde $500\n• Nacional: Desde $800\n\n¿Te interesa algún producto?"
+        # La dirección es la de la tienda que atiende, no la de la casa central
+        if intent == "ubicacion":
+            tienda_info = self.db.get_tienda_info()
+            if tienda_info.get("direccion"):
+                telefono = f" También nos podés llamar al {tienda_info['telefono']}." if tienda_info.get("telefono") else ""
+                return f"Estamos en {tienda_info['direccion']}.{telefono}"
         
-        elif any(word in user_message_lower for word in ["pago", "pagar", "tarjeta", "efectivo"]):
-            return "Aceptamos efectivo, tarjeta de débito, crédito, transferencia bancaria y Mercado Pago. ¿En qué más te puedo ayudar?"
+        if intent == "marca" and facetas["marcas"]:
+            marcas = list(facetas["marcas"])
+            lista = ", ".join(marcas[:-1]) + f" y {marcas[-1]}" if len(marcas) > 1 else marcas[0]
+            return f"Buenísimo, tenemos {lista}. ¿Te interesa alguna marca en particular? Te puedo contar más sobre precios y tallas."
         
-        else:
-            return "Hola, soy María de Zapatillas Dolores. ¿Cómo va? ¿Buscás algo en particular? Te puedo ayudar con información sobre productos, precios, horarios y más."
+        return FALLBACK_RESPONSES[intent]
     
     def search_products(self, query: str) -> List[Dict[str, Any]]:
         """Busca productos basado en la consulta del usuario"""
@@ -0,0 +1,121 @@
+"""
+Límites de uso de la IA con token buckets (por cliente y global)
+
+Cada mensaje que va a la IA gasta una ficha del balde del cliente y una del
+balde global (la cuota de OpenRouter es una sola para todo el proceso). Los
+baldes se recargan a ritmo constante hasta su capacidad (la ráfaga
+permitida). Un cliente que manda mensajes en cadena agota su balde sin tocar
+el de los demás; si el que se agota es el global, la ficha del cliente se
+devuelve.
+
+Los baldes por cliente se reparten en franjas con su propio lock (por hash
+del teléfono), así los hilos de distintas conversaciones casi nunca se
+esperan entre sí. Cada franja es un LRU acotado: un cliente que no escribe
+hace rato tiene el balde lleno y olvidarlo no cambia nada.
+"""
+
+import collections
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+SCOPE_CUSTOMER = "cliente"
+SCOPE_GLOBAL = "global"
+
+_shared: Optional["RateLimiter"] = None
+_shared_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Balde de capacity fichas que se recarga a rate fichas por segundo (el lock lo pone quien lo usa)"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now: float, cost: float = 1) -> float:
+        """Gasta cost fichas; devuelve 0 si alcanzaron o los segundos hasta que alcancen"""
+        # Otro hilo pudo haberlo usado con un now posterior: el tiempo no va para atrás
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def refund(self, cost: float = 1):
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+
+class RateLimiter:
+    """Baldes por teléfono (en franjas con lock propio) más un balde global"""
+
+    def __init__(self, customer_rate: float, customer_burst: float, global_rate: float = 0,
+                 global_burst: float = 0, max_customers: int = 10000, stripes: int = 16):
+        self.customer_rate = customer_rate
+        self.customer_burst = customer_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self._global_lock = threading.Lock()
+        self._stripes: List[Tuple[threading.Lock, "collections.OrderedDict[str, TokenBucket]"]] = [
+            (threading.Lock(), collections.OrderedDict()) for _ in range(stripes)
+        ]
+        self._per_stripe = max(1, max_customers // stripes)
+
+    def acquire(self, phone_number: str) -> Optional[Tuple[str, float]]:
+        """None si el mensaje puede ir a la IA; si no, (scope, segundos hasta que haya ficha)"""
+        now = time.monotonic()
+        bucket = None
+
+        if self.customer_rate > 0:
+            lock, buckets = self._stripes[hash(phone_number) % len(self._stripes)]
+            with lock:
+                bucket = buckets.get(phone_number)
+                if bucket is None:
+                    bucket = TokenBucket(self.customer_rate, self.customer_burst)
+                    buckets[phone_number] = bucket
+                    while len(buckets) > self._per_stripe:
+                        buckets.popitem(last=False)
+                else:
+                    buckets.move_to_end(phone_number)
+                wait = bucket.take(now)
+            if wait:
+                return SCOPE_CUSTOMER, wait
+
+        if self.global_bucket is not None:
+            with self._global_lock:
+                wait = self.global_bucket.take(now)
+            if wait:
+                # El cliente no pierde su ficha por un límite que no es suyo
+                if bucket is not None:
+                    with lock:
+                        bucket.refund()
+                return SCOPE_GLOBAL, wait
+
+        return None
+
+
+def get_limiter() -> Optional[RateLimiter]:
+    """Limitador del proceso según las variables de entorno (None si está desactivado)"""
+    global _shared
+
+    customer_per_minute = float(os.getenv("RATE_LIMIT_CUSTOMER_PER_MINUTE", 6))
+    global_per_minute = float(os.getenv("RATE_LIMIT_GLOBAL_PER_MINUTE", 0))
+    if customer_per_minute <= 0 and global_per_minute <= 0:
+        return None
+
+    # Uno solo para todas las tiendas: la cuota de la IA es una sola
+    with _shared_lock:
+        if _shared is None:
+            _shared = RateLimiter(
+                customer_rate=customer_per_minute / 60,
+                customer_burst=float(os.getenv("RATE_LIMIT_CUSTOMER_BURST", 4)),
+                global_rate=global_per_minute / 60,
+                global_burst=float(os.getenv("RATE_LIMIT_GLOBAL_BURST", 20))
+            )
+        return _shared
@@ -0,0 +1,356 @@
+"""
+Reservas de stock desde el chat
+
+Una reserva aparta (producto, talla, cantidad) durante un tiempo mientras el
+cliente confirma. Cada paso es un UPDATE condicional por clave primaria
+dentro de una transacción corta (BEGIN IMMEDIATE en SQLite; en PostgreSQL el
+UPDATE bloquea la fila y vuelve a evaluar el WHERE):
+
+    reservar   stock_tallas.cantidad -= n   WHERE ... AND cantidad >= n
+    confirmar  reservas 'reservada' → 'confirmada'   si no venció
+    liberar    reservas 'reservada' → 'liberada'     y devuelve el stock
+
+Si el UPDATE no toca ninguna fila es que no alcanza el stock: aunque muchos
+clientes pidan la misma talla a la vez no se vende de más. Las reservas
+vencidas las devuelve un hilo barredor (y también una reserva que encuentra
+la talla agotada, antes de rendirse).
+
+stock_tallas es la fuente del stock: las lecturas arman el stock de cada
+producto desde ahí y la fila de productos no se toca, así una reserva no
+reescribe el JSON del producto. En la misma transacción se cambian la
+versión "stock" del catálogo y, si la talla se agotó o volvió a haber, las
+facetas de la marca y la categoría del producto con su versión "facetas".
+La versión "productos" no cambia: el prompt de la IA y los mensajes armados
+no dependen del stock y sobreviven a las reservas.
+
+Un import o un seed reescriben stock_tallas con las cantidades del feed, que
+cuentan también lo reservado: subtract_holds les descuenta las reservas
+activas para que liberarlas después vuelva a la cantidad del feed y no a
+más.
+"""
+
+import contextlib
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import facets
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = "reservada"
+CONFIRMED = "confirmada"
+RELEASED = "liberada"
+EXPIRED = "vencida"
+
+# Reservas vencidas que se devuelven por transacción del barredor
+SWEEP_BATCH = 500
+
+COLUMNS = ("id", "phone_number", "producto_id", "talla", "cantidad", "estado", "creada", "vence", "actualizada")
+SELECT = f"SELECT {', '.join(COLUMNS)} FROM reservas"
+
+
+class ReservationError(Exception):
+    """La operación no se pudo hacer; code dice por qué (sin_stock, no_encontrada, vencida...)"""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class StockReservations:
+    """Reservar, confirmar y liberar stock con UPDATEs condicionales"""
+
+    def __init__(self, db_path, ttl: float = 900, busy_timeout: float = 10.0):
+        # Ruta/URL o un Storage ya abierto
+        self.storage = storage.open_storage(db_path)
+        self.db_path = self.storage.key
+        self.ttl = ttl
+        self.busy_timeout = busy_timeout
+
+    def _connect(self):
+        return self.storage.connect(timeout=self.busy_timeout)
+
+    def reserve(self, phone_number: str, producto_id: int, talla: str, cantidad: int = 1) -> Dict[str, Any]:
+        """Aparta stock; si el cliente ya tiene una reserva activa de esa talla, devuelve esa"""
+        if cantidad < 1:
+            raise ReservationError("cantidad_invalida", "La cantidad tiene que ser al menos 1")
+
+        talla = str(talla)
+        now = time.time()
+        conn = self._connect()
+        try:
+            with metrics.stage("reservation"), _immediate(conn):
+                existing = conn.execute(
+                    f'''
+                    {SELECT}
+                    WHERE phone_number = ? AND producto_id = ? AND talla = ? AND estado = '{ACTIVE}' AND vence > ?
+                    ''',
+                    (phone_number, producto_id, talla, _ts(now))
+                ).fetchone()
+                if existing:
+                    metrics.RESERVATIONS.inc("existente")
+                    return _to_dict(existing)
+
+                before = self._take(conn, producto_id, talla, cantidad)
+                # Agotada: recuperar las reservas vencidas de esa talla antes de rendirse
+                if before is None and self._expire(conn, now, producto_id, talla):
+                    before = self._take(conn, producto_id, talla, cantidad)
+
+                if before is None:
+                    metrics.RESERVATIONS.inc("sin_stock")
+                    raise ReservationError("sin_stock", "No hay stock suficiente en esa talla")
+
+                reserva_id = uuid.uuid4().hex[:12]
+                conn.execute(
+                    '''
+                    INSERT INTO reservas (id, phone_number, producto_id, talla, cantidad, estado, creada, vence, actualizada)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''',
+                    (reserva_id, phone_number, producto_id, talla, cantidad, ACTIVE, _ts(now), _ts(now + self.ttl), _ts(now))
+                )
+                self._stock_changed(conn, [(producto_id, talla, before, before - cantidad)], reserva_id)
+
+                row = conn.execute(f"{SELECT} WHERE id = ?", (reserva_id,)).fetchone()
+        finally:
+            conn.close()
+
+        metrics.RESERVATIONS.inc("reservada")
+        return _to_dict(row)
+
+    def confirm(self, reserva_id: str, phone_number: str = None) -> Dict[str, Any]:
+        """Confirma una reserva activa (el stock ya estaba descontado)"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with metrics.stage("reservation"), _immediate(conn):
+                updated = conn.execute(
+                    f'''
+                    UPDATE reservas SET estado = '{CONFIRMED}', actualizada = ?
+                    WHERE id = ? AND estado = '{ACTIVE}' AND vence > ? {"AND phone_number = ?" if phone_number else ""}
+                    ''',
+                    (_ts(now), reserva_id, _ts(now)) + ((phone_number,) if phone_number else ())
+                ).rowcount
+
+                row = self._get(conn, reserva_id, phone_number)
+                # Venció pero el barredor todavía no pasó: se devuelve el stock ahora
+                expired = not updated and row["estado"] == ACTIVE
+                if expired:
+                    self._finish(conn, [row], EXPIRED, now)
+        finally:
+            conn.close()
+
+        if expired:
+            metrics.RESERVATIONS.inc("vencida")
+            raise ReservationError("vencida", "La reserva venció")
+        if not updated:
+            raise ReservationError("estado", f"La reserva está {row['estado']}")
+
+        metrics.RESERVATIONS.inc("confirmada")
+        return self.get(reserva_id)
+
+    def release(self, reserva_id: str, phone_number: str = None) -> Dict[str, Any]:
+        """Cancela una reserva activa y devuelve el stock"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with metrics.stage("reservation"), _immediate(conn):
+                row = self._get(conn, reserva_id, phone_number)
+                if row["estado"] != ACTIVE or not self._finish(conn, [row], RELEASED, now):
+                    raise ReservationError("estado", f"La reserva está {row['estado']}")
+        finally:
+            conn.close()
+
+        metrics.RESERVATIONS.inc("liberada")
+        return self.get(reserva_id)
+
+    def get(self, reserva_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        try:
+            row = conn.execute(f"{SELECT} WHERE id = ?", (reserva_id,)).fetchone()
+        finally:
+            conn.close()
+        return _to_dict(row) if row else None
+
+    def sweep(self) -> int:
+        """Devuelve el stock de todas las reservas vencidas; devuelve cuántas liberó"""
+        total = 0
+        conn = self._connect()
+        try:
+            while True:
+                with metrics.stage("reservation_sweep"), _immediate(conn):
+                    expired = self._expire(conn, time.time())
+                total += expired
+                if expired < SWEEP_BATCH:
+                    break
+        finally:
+            conn.close()
+
+        if total:
+            metrics.RESERVATIONS.inc("vencida", amount=total)
+            logger.info("Reservas vencidas liberadas: %s", total)
+        return total
+
+    def start(self, interval: float) -> threading.Event:
+        """Corre el barredor periódicamente en un hilo; devuelve el evento para detenerlo"""
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error("Error liberando reservas vencidas: %s", e)
+                    metrics.ERRORS.inc("reservations")
+
+        threading.Thread(target=loop, name="reservation-sweeper", daemon=True).start()
+        return stop
+
+    def _get(self, conn, reserva_id: str, phone_number: str = None) -> Dict[str, Any]:
+        row = conn.execute(f"{SELECT} WHERE id = ?", (reserva_id,)).fetchone()
+        # Desde el chat solo se tocan las reservas propias
+        if not row or (phone_number and row[1] != phone_number):
+            raise ReservationError("no_encontrada", "Reserva no encontrada")
+        return _to_dict(row)
+
+    def _take(self, conn, producto_id: int, talla: str, cantidad: int) -> Optional[int]:
+        """Descuenta stock si alcanza; devuelve la cantidad anterior (None si no alcanzó)"""
+        updated = conn.execute(
+            '''
+            UPDATE stock_tallas SET cantidad = cantidad - ?
+            WHERE producto_id = ? AND talla = ? AND cantidad >= ?
+            ''',
+            (cantidad, producto_id, talla, cantidad)
+        ).rowcount
+        if not updated:
+            return None
+
+        row = conn.execute(
+            "SELECT cantidad FROM stock_tallas WHERE producto_id = ? AND talla = ?",
+            (producto_id, talla)
+        ).fetchone()
+        return row[0] + cantidad
+
+    def _expire(self, conn, now: float, producto_id: int = None, talla: str = None) -> int:
+        """Marca como vencidas (un lote de) las reservas activas que pasaron su vencimiento"""
+        where = "AND producto_id = ? AND talla = ?" if producto_id is not None else ""
+        params = (producto_id, talla) if producto_id is not None else ()
+
+        rows = conn.execute(
+            f'''
+            {SELECT}
+            WHERE estado = '{ACTIVE}' AND vence <= ? {where}
+            ORDER BY vence
+            LIMIT ?
+            ''',
+            (_ts(now),) + params + (SWEEP_BATCH,)
+        ).fetchall()
+
+        return self._finish(conn, [_to_dict(row) for row in rows], EXPIRED, now)
+
+    def _finish(self, conn, rows: Iterable[Dict[str, Any]], estado: str, now: float) -> int:
+        """Cierra reservas activas (liberada/vencida) y devuelve su stock; devuelve cuántas cerró"""
+        returned: Dict[Tuple[int, str], int] = {}
+        closed = 0
+
+        for row in rows:
+            updated = conn.execute(
+                f"UPDATE reservas SET estado = ?, actualizada = ? WHERE id = ? AND estado = '{ACTIVE}'",
+                (estado, _ts(now), row["id"])
+            ).rowcount
+            if updated:
+                key = (row["producto_id"], row["talla"])
+                returned[key] = returned.get(key, 0) + row["cantidad"]
+                closed += 1
+
+        changes = []
+        # Siempre en el mismo orden: dos barredores no se bloquean mutuamente en PostgreSQL
+        for (producto_id, talla), cantidad in sorted(returned.items()):
+            current = conn.execute(
+                "SELECT cantidad FROM stock_tallas WHERE producto_id = ? AND talla = ?",
+                (producto_id, talla)
+            ).fetchone()
+            # El producto o la talla ya no están en el catálogo (se reimportó): no hay a dónde devolver
+            if current is None:
+                continue
+            conn.execute(
+                "UPDATE stock_tallas SET cantidad = cantidad + ? WHERE producto_id = ? AND talla = ?",
+                (cantidad, producto_id, talla)
+            )
+            changes.append((producto_id, talla, current[0], current[0] + cantidad))
+
+        if changes:
+            self._stock_changed(conn, changes, f"{estado}:{now}")
+        return closed
+
+    def _stock_changed(self, conn, changes: List[Tuple[int, str, int, int]], event: str):
+        """Actualiza las versiones de stock/facetas y las facetas afectadas"""
+        marcas, categorias = set(), set()
+
+        for producto_id, talla, before, after in changes:
+            # Las facetas solo listan tallas con stock: cambian si la talla se agotó o volvió
+            if (before > 0) != (after > 0):
+                row = conn.execute("SELECT marca, categoria FROM productos WHERE id = ?", (producto_id,)).fetchone()
+                if row:
+                    marcas.add(row[0])
+                    categorias.add(row[1])
+
+        # Versión propia del stock: los caches que no muestran stock ("productos") no se invalidan
+        _bump_version(conn, "stock", event)
+
+        if marcas:
+            facets.refresh(conn, marcas, categorias)
+            _bump_version(conn, "facetas", event)
+
+
+def subtract_holds(conn, producto_ids_sql: str = None):
+    """Descuenta las reservas activas del stock recién importado (producto_ids_sql: solo esos productos)"""
+    holds = f'''
+        FROM reservas r
+        WHERE r.producto_id = stock_tallas.producto_id AND r.talla = stock_tallas.talla AND r.estado = '{ACTIVE}'
+    '''
+    where = f"AND producto_id IN ({producto_ids_sql})" if producto_ids_sql else ""
+    # Puede quedar negativo (el feed trae menos que lo reservado): las lecturas lo muestran como 0
+    conn.execute(
+        f'''
+        UPDATE stock_tallas SET cantidad = cantidad - (SELECT SUM(r.cantidad) {holds})
+        WHERE EXISTS (SELECT 1 {holds}) {where}
+        '''
+    )
+
+
+def _bump_version(conn, nombre: str, event: str):
+    """Encadena una versión nueva de una parte del catálogo a partir de la anterior"""
+    row = conn.execute("SELECT version FROM catalogo_version WHERE nombre = ?", (nombre,)).fetchone()
+    version = hashlib.sha1(((row[0] if row else "") + event).encode("utf-8")).hexdigest()[:16]
+    conn.execute(
+        conn.upsert_sql("catalogo_version", ("nombre", "version"), key=("nombre",)),
+        (nombre, version)
+    )
+
+
+@contextlib.contextmanager
+def _immediate(conn):
+    """Transacción que toma el lock de escritura al empezar (sin deadlocks al pasar de leer a escribir)"""
+    conn.begin(immediate=True)
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def _ts(epoch: float) -> str:
+    """Mismo formato que CURRENT_TIMESTAMP (UTC)"""
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _to_dict(row: tuple) -> Dict[str, Any]:
+    return dict(zip(COLUMNS, row))
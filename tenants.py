@@ -0,0 +1,179 @@
+"""
+Varias tiendas (sucursales) atendidas por un mismo proceso
+
+Cada tienda tiene su número de WhatsApp (phone_number_id) y sus
+credenciales, su base (catálogo, historial, reservas, facetas) y su
+propio ejecutor por conversación. El webhook se rutea por
+metadata.phone_number_id. Todo lo que se cachea o encola cuelga de la base o
+del ejecutor de la tienda, así que una sucursal con mucho tráfico no llena
+las colas ni pisa los caches de otra. max_concurrency limita cuántas
+conversaciones de esa tienda se procesan a la vez.
+
+TENANTS_FILE apunta a un JSON con las tiendas (los tokens van en variables
+de entorno, nunca en el archivo):
+
+    {"tiendas": [
+        {"id": "dolores", "phone_number_id": "1234", "token_env": "WHATSAPP_TOKEN_DOLORES",
+         "db_path": "tienda.db", "data_dir": "data", "archive_dir": "archivo", "max_concurrency": 8},
+        {"id": "chascomus", "phone_number_id": "5678", "max_concurrency": 4}
+    ]}
+
+Por defecto token_env es WHATSAPP_TOKEN_<ID>, db_path tienda-<id>.db,
+data_dir data/<id> y archive_dir <ARCHIVE_DIR>/<id>. db_path también puede
+ser una URL postgresql:// (una base por tienda).
+
+Sin TENANTS_FILE hay una sola tienda armada con las variables de siempre
+(WHATSAPP_PHONE_NUMBER_ID, WHATSAPP_TOKEN, DATABASE_URL, data/). La primera
+tienda es la predeterminada: recibe los eventos sin phone_number_id
+conocido y los requests REST sin ?tienda=.
+"""
+
+import json
+import logging
+import os
+from typing import Callable, Iterator, List, Optional
+
+import admission
+from archive import ConversationArchive
+from catalog_cache import CatalogCache
+from database import Database
+from executor import ShardedExecutor
+from reservations import StockReservations
+from whatsapp import WhatsAppAPI
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "default"
+
+
+class Tenant:
+    """Una tienda con sus servicios propios"""
+
+    def __init__(self, tenant_id: str, phone_number_id: Optional[str], access_token: Optional[str],
+                 serialize: Callable[[dict], str], db_path: str = None, data_dir: str = "data",
+                 archive_dir: str = "archivo", max_concurrency: int = 8, max_queue: int = 100,
+                 reservation_ttl: float = 900):
+        self.id = tenant_id
+        self.phone_number_id = phone_number_id
+        self.max_concurrency = max_concurrency
+
+        self.db = Database(db_path, data_dir)
+        self.whatsapp = WhatsAppAPI(phone_number_id=phone_number_id, access_token=access_token, db=self.db)
+
+        # Orden estricto por cliente; los shards son el límite de concurrencia de la tienda
+        self.executor = ShardedExecutor(shards=max_concurrency, max_queue=max_queue, name=f"{tenant_id}-conversation")
+        self.whatsapp.executor = self.executor
+
+        self.reservations = StockReservations(self.db.storage, ttl=reservation_ttl)
+        self.whatsapp.reservations = self.reservations
+
+        self.archive = ConversationArchive(self.db, archive_dir)
+        self.catalog_cache = CatalogCache(self.db, serialize=serialize)
+
+    def invalidate_caches(self):
+        """Relee la versión del catálogo en los caches (después de cambiarlo en este proceso)"""
+        self.catalog_cache.invalidate()
+        self.whatsapp.messages.invalidate()
+
+
+class TenantRegistry:
+    """Tiendas por id y por phone_number_id"""
+
+    def __init__(self, tenants: List[Tenant]):
+        if not tenants:
+            raise ValueError("Hay que configurar al menos una tienda")
+
+        self._tenants = tenants
+        self._by_id = {}
+        self._by_number = {}
+
+        for tenant in tenants:
+            if tenant.id in self._by_id:
+                raise ValueError(f"Tienda repetida: {tenant.id}")
+            self._by_id[tenant.id] = tenant
+
+            if tenant.phone_number_id:
+                if tenant.phone_number_id in self._by_number:
+                    raise ValueError(f"phone_number_id repetido: {tenant.phone_number_id}")
+                self._by_number[tenant.phone_number_id] = tenant
+
+    @property
+    def default(self) -> Tenant:
+        return self._tenants[0]
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(self._tenants)
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+    def get(self, tenant_id: str) -> Optional[Tenant]:
+        return self._by_id.get(tenant_id)
+
+    def resolve(self, phone_number_id: Optional[str]) -> Tenant:
+        """Tienda dueña del número; la predeterminada si el número no es de ninguna"""
+        tenant = self._by_number.get(phone_number_id)
+        if tenant is None:
+            if phone_number_id and len(self._tenants) > 1:
+                logger.warning("phone_number_id desconocido %s, se atiende como %s", phone_number_id, self.default.id)
+            return self.default
+        return tenant
+
+    def queue_depth(self) -> int:
+        return sum(tenant.executor.queue_depth() for tenant in self._tenants)
+
+
+def load_tenants(serialize: Callable[[dict], str], path: str = None) -> TenantRegistry:
+    """Arma las tiendas desde TENANTS_FILE (o la tienda única de las variables de entorno)"""
+    path = path or os.getenv("TENANTS_FILE")
+    shared = {
+        "serialize": serialize,
+        "max_queue": int(os.getenv("SHARD_QUEUE_SIZE", 100)),
+        "reservation_ttl": float(os.getenv("RESERVATION_TTL_MINUTES", 15)) * 60
+    }
+    archive_root = os.getenv("ARCHIVE_DIR", "archivo")
+
+    if not path:
+        return _registry([
+            Tenant(
+                DEFAULT_TENANT,
+                os.getenv("WHATSAPP_PHONE_NUMBER_ID"),
+                os.getenv("WHATSAPP_TOKEN"),
+                archive_dir=archive_root,
+                max_concurrency=int(os.getenv("CONVERSATION_SHARDS", 8)),
+                **shared
+            )
+        ])
+
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    tenants = []
+    for item in config["tiendas"]:
+        tenant_id = item["id"]
+        token_env = item.get("token_env", f"WHATSAPP_TOKEN_{tenant_id.upper()}")
+        tenants.append(Tenant(
+            tenant_id,
+            str(item["phone_number_id"]),
+            os.getenv(token_env),
+            db_path=item.get("db_path", f"tienda-{tenant_id}.db"),
+            data_dir=item.get("data_dir", os.path.join("data", tenant_id)),
+            archive_dir=item.get("archive_dir", os.path.join(archive_root, tenant_id)),
+            max_concurrency=int(item.get("max_concurrency", os.getenv("CONVERSATION_SHARDS", 8))),
+            **shared
+        ))
+
+        if not os.getenv(token_env):
+            logger.warning("Tienda %s sin token de WhatsApp (%s)", tenant_id, token_env)
+
+    logger.info("Tiendas configuradas: %s", ", ".join(tenant.id for tenant in tenants))
+    return _registry(tenants)
+
+
+def _registry(tenants: List[Tenant]) -> TenantRegistry:
+    registry = TenantRegistry(tenants)
+    # El control de admisión es uno por proceso (las tiendas comparten la IA): su cola es la de todas
+    controller = admission.get_controller()
+    if controller:
+        controller.set_queue_function(registry.queue_depth)
+    return registry
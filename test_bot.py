@@ -80,6 +80,846 @@ def test_whatsapp():
         print(f"❌ Error en WhatsApp: {str(e)}")
         return False
 
+def test_coalescer():
+    """Prueba que los mensajes seguidos se agrupen en uno solo"""
+    print("\n🧩 Probando agrupación de mensajes...")
+    try:
+        import time
+        from coalescer import MessageCoalescer
+        
+        entregas = []
+        coalescer = MessageCoalescer(lambda phone, texts: entregas.append((phone, texts)), window=0.05)
+        
+        for texto in ["hola", "tenés nike?", "en 42"]:
+            coalescer.add("5491100000000", texto)
+        coalescer.add("5491199999999", "hola")
+        
+        time.sleep(0.3)
+        
+        if sorted(entregas) == [("5491100000000", ["hola", "tenés nike?", "en 42"]), ("5491199999999", ["hola"])]:
+            print("✅ Mensajes agrupados por cliente")
+            return True
+        else:
+            print(f"❌ Entregas inesperadas: {entregas}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en agrupación: {str(e)}")
+        return False
+
+def test_executor():
+    """Prueba el orden por cliente del ejecutor por conversación"""
+    print("\n🧵 Probando ejecutor por conversación...")
+    try:
+        import time
+        from executor import ShardedExecutor
+        
+        executor = ShardedExecutor(shards=4, max_queue=50)
+        resultados = {}
+        
+        def tarea(phone, i):
+            time.sleep(0.001)
+            resultados.setdefault(phone, []).append(i)
+        
+        for i in range(20):
+            for phone in ["5491100000001", "5491100000002", "5491100000003"]:
+                executor.submit(phone, tarea, phone, i)
+        
+        executor.shutdown(wait=True, timeout=5)
+        
+        if all(orden == list(range(20)) for orden in resultados.values()) and len(resultados) == 3:
+            print("✅ Orden por cliente respetado")
+            return True
+        else:
+            print(f"❌ Orden inesperado: {resultados}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en ejecutor: {str(e)}")
+        return False
+
+def test_drain():
+    """Prueba que al apagar no se pierdan los mensajes que seguían en cola"""
+    print("\n🛑 Probando vaciado al apagar...")
+    import tempfile
+    import time
+    from coalescer import MessageCoalescer
+    from database import Database
+    from executor import ShardedExecutor
+    from whatsapp import WhatsAppAPI
+    
+    whatsapp = WhatsAppAPI(db=Database(os.path.join(tempfile.mkdtemp(), "vaciado.db")))
+    whatsapp.coalescer = MessageCoalescer(whatsapp._process_coalesced, window=0.05)
+    whatsapp.executor = ShardedExecutor(shards=1)
+    respondidos = []
+    whatsapp.handle_text = lambda phone, text: respondidos.append((phone, text)) or True
+    
+    # El shard está ocupado: el mensaje de "b" sigue en cola cuando empieza el apagado
+    whatsapp.executor.submit("a", time.sleep, 0.2)
+    whatsapp.executor.submit("b", whatsapp.process_message, {"from": "b", "text": {"body": "hola"}})
+    whatsapp.coalescer.flush_all()
+    assert whatsapp.executor.shutdown(wait=True, timeout=5)
+    assert respondidos == [("b", "hola")], respondidos
+    
+    # Con el shard lleno la ráfaga se responde en el hilo del timer en vez de perderse
+    whatsapp.coalescer = MessageCoalescer(whatsapp._process_coalesced, window=0.05)
+    whatsapp.executor = ShardedExecutor(shards=1, max_queue=1, put_timeout=0.01)
+    whatsapp.executor.submit("a", time.sleep, 0.5)
+    time.sleep(0.05)
+    whatsapp.executor.submit("a", time.sleep, 0)
+    whatsapp.process_message({"from": "c", "text": {"body": "chau"}})
+    time.sleep(0.3)
+    assert ("c", "chau") in respondidos, respondidos
+    whatsapp.executor.shutdown(wait=True, timeout=5)
+    print("✅ Mensajes en cola respondidos durante el apagado")
+
+def test_webhook_events():
+    """Prueba la clasificación rápida de payloads del webhook"""
+    print("\n📬 Probando clasificación del webhook...")
+    try:
+        import json
+        import webhook_events
+        
+        estado = {"entry": [{"changes": [{"value": {"statuses": [
+            {"id": "wamid.1", "status": "delivered", "recipient_id": "5491100000000", "timestamp": "1700000000"}
+        ]}}]}]}
+        mensajes = {"entry": [{"changes": [{"value": {"messages": [
+            {"id": "wamid.2", "from": "5491100000000", "text": {"body": "hola"}},
+            {"id": "wamid.3", "from": "5491100000001", "text": {"body": "tenés nike?"}}
+        ]}}]}]}
+        
+        raw_estado = json.dumps(estado).encode()
+        raw_mensajes = json.dumps(mensajes).encode()
+        
+        if webhook_events.classify(raw_estado) != webhook_events.KIND_STATUSES:
+            print("❌ Payload de estado mal clasificado")
+            return False
+        
+        if webhook_events.classify(raw_mensajes) != webhook_events.KIND_MESSAGES:
+            print("❌ Payload de mensajes mal clasificado")
+            return False
+        
+        messages, statuses = webhook_events.split(webhook_events.parse(raw_mensajes))
+        _, estados = webhook_events.split(estado)
+        
+        # Dos sucursales en el mismo payload: se agrupan por phone_number_id
+        sucursales = {"entry": [{"changes": [
+            {"value": {"metadata": {"phone_number_id": "111"}, "messages": [{"id": "wamid.4"}]}},
+            {"value": {"metadata": {"phone_number_id": "222"}, "messages": [{"id": "wamid.5"}]}}
+        ]}]}
+        por_numero = webhook_events.split_by_number(sucursales)
+        if sorted(por_numero) != ["111", "222"] or por_numero["222"][0] != [{"id": "wamid.5"}]:
+            print(f"❌ Agrupación por número inesperada: {por_numero}")
+            return False
+        
+        if len(messages) == 2 and not statuses and estados == [("wamid.1", "delivered", "5491100000000", 1700000000)]:
+            print("✅ Payloads clasificados y separados")
+            return True
+        else:
+            print(f"❌ Separación inesperada: {messages} {estados}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en clasificación del webhook: {str(e)}")
+        return False
+
+def test_write_buffer():
+    """Prueba el group commit y la lectura de lo propio"""
+    print("\n💾 Probando escritura diferida...")
+    try:
+        import sqlite3
+        import tempfile
+        import time
+        from write_buffer import WriteBehindBuffer
+        
+        db_path = os.path.join(tempfile.mkdtemp(), "buffer.db")
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE filas (clave TEXT, valor INTEGER)")
+        conn.close()
+        
+        writer = WriteBehindBuffer(db_path, max_batch=50, flush_interval=0.5)
+        for i in range(120):
+            writer.add("INSERT INTO filas VALUES (?, ?)", ("a" if i % 2 else "b", i), key="a" if i % 2 else "b")
+        
+        # Leer lo propio: wait_for no espera al intervalo completo
+        writer.wait_for("a", timeout=5)
+        conn = sqlite3.connect(db_path)
+        guardadas_a = conn.execute("SELECT COUNT(*) FROM filas WHERE clave = 'a'").fetchone()[0]
+        conn.close()
+        
+        writer.add("INSERT INTO filas VALUES (?, ?)", ("c", 0))
+        writer.close(timeout=5)
+        conn = sqlite3.connect(db_path)
+        total = conn.execute("SELECT COUNT(*) FROM filas").fetchone()[0]
+        conn.close()
+        
+        if guardadas_a == 60 and total == 121:
+            print("✅ Escrituras agrupadas sin pérdidas")
+        else:
+            print(f"❌ Filas inesperadas: a={guardadas_a} total={total}")
+            return False
+        
+        # Un lote que falla se informa a quien espera y se reintenta (la tabla todavía no existe)
+        spill_dir = tempfile.mkdtemp()
+        writer = WriteBehindBuffer(db_path, flush_interval=0.01, max_retries=1, retry_interval=0.05, spill_dir=spill_dir)
+        writer.add("INSERT INTO tardias VALUES (?)", (1,), key="x")
+        fallo_informado = not writer.wait_for("x", timeout=5) and not writer.flush(timeout=5)
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE tardias (valor INTEGER)")
+        conn.commit()
+        conn.close()
+        deadline = time.monotonic() + 5
+        while writer.pending() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        reintentada = writer.wait_for("x", timeout=5)
+        
+        # Si al cerrar la base sigue fallando, las filas van al archivo de derrame y el próximo escritor las guarda
+        writer.add("INSERT INTO derramadas VALUES (?)", (1,))
+        cerrado_limpio = writer.close(timeout=5)
+        derramadas = len(os.listdir(spill_dir)) == 1
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE derramadas (valor INTEGER)")
+        conn.commit()
+        conn.close()
+        writer = WriteBehindBuffer(db_path, flush_interval=0.01, spill_dir=spill_dir)
+        writer.flush(timeout=5)
+        writer.close(timeout=5)
+        conn = sqlite3.connect(db_path)
+        recuperadas = conn.execute("SELECT COUNT(*) FROM derramadas").fetchone()[0]
+        conn.close()
+        
+        if fallo_informado and reintentada and not cerrado_limpio and derramadas and recuperadas == 1 and not os.listdir(spill_dir):
+            print("✅ Lotes fallidos informados, reintentados y derramados sin pérdidas")
+            return True
+        else:
+            print(f"❌ Fallas: informado={fallo_informado} reintentada={reintentada} cierre={cerrado_limpio} derrame={derramadas} recuperadas={recuperadas}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en escritura diferida: {str(e)}")
+        return False
+
+def test_turn_cache():
+    """Prueba que el cache de últimos intercambios siga a la base y se desactive con varios escritores"""
+    print("\n🧠 Probando cache de intercambios recientes...")
+    import sqlite3
+    import tempfile
+    from database import Database
+    from turn_cache import RecentTurnsCache
+    
+    # LRU por cliente y tope de intercambios
+    cache = RecentTurnsCache(max_customers=2, max_turns=3)
+    cache.load("a", [{"mensaje": "a1"}])
+    cache.load("b", [{"mensaje": "b1"}])
+    assert cache.get("a", 1) == [{"mensaje": "a1"}]
+    cache.load("c", [])
+    assert cache.get("b", 1) is None and cache.get("a", 1) is not None
+    for i in range(2, 6):
+        cache.append("a", {"mensaje": f"a{i}"})
+    assert [turn["mensaje"] for turn in cache.get("a", 3)] == ["a5", "a4", "a3"]
+    assert cache.get("a", 4) is None
+    # Solo se actualizan clientes en memoria: un append no crea uno a medias
+    cache.append("z", {"mensaje": "z1"})
+    assert cache.get("z", 1) is None
+    
+    # Con la base: los guardados pasan por el cache y coinciden con leer de la base
+    db_path = os.path.join(tempfile.mkdtemp(), "turnos.db")
+    db = Database(db_path)
+    assert db.turns is not None
+    phone = "5491100000000"
+    db.save_conversation(phone, "hola", "r1")
+    assert [turn["mensaje"] for turn in db.get_recent_turns(phone)] == ["hola"]
+    db.save_conversation(phone, "talle 40", "r2")
+    assert [turn["mensaje"] for turn in db.get_recent_turns(phone)] == ["talle 40", "hola"]
+    assert [turn["mensaje"] for turn in db.get_recent_turns(phone)] == [turn["mensaje"] for turn in db.get_conversation_history(phone, 5)]
+    
+    # Otra instancia sobre la misma base comparte el cache
+    assert Database(db_path).get_recent_turns(phone, 1)[0]["mensaje"] == "talle 40"
+    
+    # Con varios workers otro proceso escribe el historial: sin cache, se lee siempre la base
+    previous = os.environ.get("WEB_CONCURRENCY")
+    os.environ["WEB_CONCURRENCY"] = "2"
+    try:
+        db = Database(os.path.join(tempfile.mkdtemp(), "workers.db"))
+    finally:
+        if previous is None:
+            os.environ.pop("WEB_CONCURRENCY", None)
+        else:
+            os.environ["WEB_CONCURRENCY"] = previous
+    assert db.turns is None
+    db.save_conversation(phone, "hola", "r1")
+    db.flush(timeout=5)
+    conn = sqlite3.connect(db.db_path)
+    conn.execute("INSERT INTO conversaciones (phone_number, mensaje, respuesta, timestamp) VALUES (?, 'desde otro worker', 'r', '2999-01-01 00:00:00')", (phone,))
+    conn.commit()
+    conn.close()
+    assert db.get_recent_turns(phone, 1)[0]["mensaje"] == "desde otro worker"
+    print("✅ Cache al día con los guardados y desactivado con varios escritores")
+
+def test_pagination():
+    """Prueba que los cursores recorran cada listado sin repetir ni saltear filas, con filtros"""
+    print("\n📄 Probando paginación por cursor...")
+    import tempfile
+    from database import Database, encode_cursor
+    
+    db = Database(os.path.join(tempfile.mkdtemp(), "paginas.db"))
+    # Precios repetidos: el desempate por id es lo que hace estable el cursor
+    productos = [
+        {"id": i, "nombre": f"Zapatilla {i}", "marca": "Nike" if i % 2 else "Adidas",
+         "categoria": "Running" if i % 3 else "Urbana", "precio": 1000 + (i % 5) * 100,
+         "tallas": ["40", "41"], "stock": {"40": i % 4, "41": 1}, "colores": ["Negro"]}
+        for i in range(1, 26)
+    ]
+    db.save_productos_data(productos)
+    
+    def recorrer(**filtros):
+        ids, cursor = [], None
+        while True:
+            page = db.get_productos_pagina(cursor=cursor, limit=4, **filtros)
+            ids += [p["id"] for p in page["productos"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return ids
+    
+    assert recorrer() == list(range(1, 26))
+    assert recorrer(sort="precio_asc") == [p["id"] for p in sorted(productos, key=lambda p: (p["precio"], p["id"]))]
+    assert recorrer(sort="precio_desc") == [p["id"] for p in sorted(productos, key=lambda p: (p["precio"], p["id"]), reverse=True)]
+    
+    # Filtros combinados, también a través de las páginas
+    esperados = [p["id"] for p in productos if p["marca"] == "Nike" and p["categoria"] == "Running"
+                 and 1100 <= p["precio"] <= 1300 and p["stock"]["40"] > 0]
+    assert esperados and recorrer(marca="Nike", categoria="Running", precio_min=1100, precio_max=1300, talla="40") == esperados
+    
+    # Cursores inválidos o de otro orden se rechazan (la API responde 400)
+    cursor = db.get_productos_pagina(limit=4)["next_cursor"]
+    for kwargs in ({"cursor": cursor, "sort": "precio_asc"}, {"cursor": "basura"}, {"sort": "nombre"},
+                   {"cursor": encode_cursor("conversaciones", [1])}):
+        try:
+            db.get_productos_pagina(**kwargs)
+            assert False, kwargs
+        except ValueError:
+            pass
+    
+    # Historial del más nuevo al más viejo
+    for i in range(7):
+        db.save_conversation("5491100000000", f"mensaje {i}", "ok")
+    db.flush(timeout=5)
+    mensajes, cursor = [], None
+    while True:
+        page = db.get_conversaciones_antes("5491100000000", cursor, limit=3)
+        mensajes += [c["mensaje"] for c in page["conversaciones"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert mensajes == [f"mensaje {i}" for i in reversed(range(7))]
+    print("✅ Cursores estables con desempate por id y filtros combinados")
+
+def test_color_filter():
+    """Prueba que el filtro por color no distinga mayúsculas y use la PK de producto_colores"""
+    print("\n🎨 Probando filtro por color...")
+    import sqlite3
+    import tempfile
+    from database import Database
+    
+    db = Database(os.path.join(tempfile.mkdtemp(), "colores.db"))
+    base = {"marca": "Nike", "categoria": "Running", "precio": 1000, "tallas": ["40"], "stock": {"40": 1}}
+    db.save_productos_data([
+        dict(base, id=1, nombre="Uno", colores=["Negro", "Blanco"]),
+        dict(base, id=2, nombre="Dos", colores=["negro"]),
+        dict(base, id=3, nombre="Tres", colores=["Rojo"]),
+    ])
+    
+    assert [p["id"] for p in db.get_productos_pagina(color="NEGRO")["productos"]] == [1, 2]
+    assert db.get_productos_pagina(color="Fucsia")["productos"] == []
+    
+    # Los ids salen del índice por color, no de recorrer producto_colores por cada producto
+    conn = sqlite3.connect(db.db_path)
+    plan = " ".join(row[3] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM productos p WHERE p.id IN (SELECT c.producto_id FROM producto_colores c WHERE c.color = ?)",
+        ("negro",)
+    ))
+    assert "SEARCH c USING COVERING INDEX" in plan and "SCAN c" not in plan, plan
+    
+    # Bases anteriores con colores en mayúsculas se normalizan al abrir
+    conn.execute("INSERT INTO producto_colores (producto_id, color) VALUES (3, 'Verde')")
+    conn.commit()
+    conn.close()
+    db.init_database()
+    assert [p["id"] for p in db.get_productos_pagina(color="verde")["productos"]] == [3]
+    print("✅ Filtro por color sin distinguir mayúsculas y por índice")
+
+def test_archive():
+    """Prueba el archivado por mes y la exportación de archivo + base"""
+    print("\n🗄️  Probando archivo de conversaciones...")
+    import json
+    import sqlite3
+    import tempfile
+    from archive import ConversationArchive, _PhoneBloom
+    from database import Database
+    
+    tmp = tempfile.mkdtemp()
+    db_path = os.path.join(tmp, "archivo.db")
+    db = Database(db_path)
+    archive = ConversationArchive(db, os.path.join(tmp, "archivo"))
+    
+    def insertar(filas):
+        conn = sqlite3.connect(db_path)
+        conn.executemany("INSERT INTO conversaciones (phone_number, mensaje, respuesta, timestamp) VALUES (?, ?, ?, ?)", filas)
+        conn.commit()
+        conn.close()
+    
+    # Dos meses viejos y uno reciente; "b" solo habla en enero
+    insertar([
+        ("a", "enero a", "r", "2026-01-10 10:00:00"),
+        ("b", "enero b", "r", "2026-01-11 10:00:00"),
+        ("a", "febrero a", "r", "2026-02-10 10:00:00"),
+    ])
+    assert archive.run(older_than_days=30) == 3
+    assert archive.partitions() == ["2026-01", "2026-02"]
+    assert db.get_conversaciones_pagina(0) == []
+    
+    # Roll-over: otra corrida agrega un segmento sin repetir filas; sin nada nuevo no hace nada
+    insertar([("c", "enero c", "r", "2026-01-20 10:00:00")])
+    db.save_conversation("a", "hoy a", "r")
+    db.flush(timeout=5)
+    assert archive.run(older_than_days=30) == 1
+    assert [row["mensaje"] for row in db.get_conversaciones_pagina(0)] == ["hoy a"]
+    assert archive.run(older_than_days=30) == 0
+    segments = archive.read_index("2026-01")["segments"]
+    assert [segment["rows"] for segment in segments] == [2, 1]
+    
+    # El índice no guarda teléfonos: van en el filtro de Bloom del segmento
+    assert all("phones" not in segment and segment["bloom"]["file"].endswith(".bloom") for segment in segments)
+    
+    # Exportación en orden: primero lo archivado, después lo vivo
+    assert [row["mensaje"] for row in archive.iter_conversation("a")] == ["enero a", "febrero a", "hoy a"]
+    assert [row["mensaje"] for row in archive.iter_conversation("c")] == ["enero c"]
+    assert len(list(archive.iter_conversation())) == 5
+    assert json.loads(json.dumps(next(archive.iter_conversation("b"))))["mensaje"] == "enero b"
+    
+    # El filtro no da falsos negativos y casi no da falsos positivos
+    phones = [f"549110000{i:04d}" for i in range(1000)]
+    bloom = _PhoneBloom.build(phones)
+    assert all(phone in bloom for phone in phones)
+    assert sum(f"549120000{i:04d}" in bloom for i in range(1000)) < 50
+    print("✅ Archivado por mes, roll-over y exportación en orden")
+
+def test_reservations():
+    """Prueba que las reservas concurrentes no vendan de más"""
+    print("\n🛒 Probando reservas de stock...")
+    try:
+        import sqlite3
+        import tempfile
+        import threading
+        from database import Database
+        from reservations import StockReservations, ReservationError
+        
+        db_path = os.path.join(tempfile.mkdtemp(), "reservas.db")
+        db = Database(db_path)
+        talla = next(iter(db.get_producto_por_id(1)["stock"]))
+        conn = sqlite3.connect(db_path)
+        conn.execute("UPDATE stock_tallas SET cantidad = 3 WHERE producto_id = 1 AND talla = ?", (talla,))
+        conn.commit()
+        fila_producto = conn.execute("SELECT * FROM productos WHERE id = 1").fetchone()
+        conn.close()
+        
+        reservations = StockReservations(db_path)
+        reservadas = []
+        version_productos = db.get_catalog_version("productos")
+        version_stock = db.get_catalog_version("stock")
+        
+        def reservar(i):
+            try:
+                reservadas.append(reservations.reserve(f"cliente{i}", 1, talla))
+            except ReservationError:
+                pass
+        
+        threads = [threading.Thread(target=reservar, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        reservations.release(reservadas[0]["id"])
+        stock = db.get_producto_por_id(1)["stock"][talla]
+        
+        # El stock sale de stock_tallas: la fila del producto no se reescribe
+        conn = sqlite3.connect(db_path)
+        fila_intacta = conn.execute("SELECT * FROM productos WHERE id = 1").fetchone() == fila_producto
+        conn.close()
+        
+        # Solo cambia la versión del stock: los caches del catálogo siguen valiendo
+        versiones_ok = (db.get_catalog_version("productos") == version_productos
+                        and db.get_catalog_version("stock") != version_stock)
+        
+        if len(reservadas) == 3 and stock == 1 and versiones_ok and fila_intacta:
+            print("✅ 3 reservas para 3 pares, stock devuelto al liberar")
+            return True
+        else:
+            print(f"❌ Reservas inesperadas: {len(reservadas)} (stock {stock}, versiones {versiones_ok}, fila {fila_intacta})")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en reservas: {str(e)}")
+        return False
+
+def test_rate_limit():
+    """Prueba los límites de uso de la IA por cliente y global"""
+    print("\n🚦 Probando límites de uso de la IA...")
+    try:
+        from rate_limit import RateLimiter, SCOPE_CUSTOMER, SCOPE_GLOBAL
+        
+        limiter = RateLimiter(customer_rate=0.01, customer_burst=3, global_rate=0.01, global_burst=5)
+        spam = [limiter.acquire("5491100000000") for _ in range(5)]
+        
+        # Otros clientes siguen teniendo fichas hasta que se agota el balde global
+        otros = [limiter.acquire(f"54911000000{i:02d}") for i in range(1, 4)]
+        
+        if spam[:3] == [None] * 3 and spam[3][0] == SCOPE_CUSTOMER and otros[:2] == [None] * 2 and otros[2][0] == SCOPE_GLOBAL:
+            print("✅ Cliente frenado sin afectar a los demás; límite global respetado")
+            return True
+        else:
+            print(f"❌ Resultados inesperados: {spam} {otros}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en límites de uso: {str(e)}")
+        return False
+
+def test_admission():
+    """Prueba que con carga se descarten primero los carriles de menor prioridad"""
+    print("\n🚥 Probando control de admisión...")
+    try:
+        from admission import AdmissionController, lane_for, LANE_HIGH, LANE_NORMAL, LANE_LOW
+        
+        controller = AdmissionController(max_inflight=4, max_queue=10)
+        admitidos = [controller.admit(lane) for lane in [LANE_LOW, LANE_LOW, LANE_LOW, LANE_NORMAL, LANE_NORMAL, LANE_HIGH, LANE_HIGH]]
+        controller.release()
+        
+        # Con la cola llena se descarta todo, incluso el carril alto
+        cola_llena = controller.admit(LANE_HIGH, queue_depth=11)
+        carriles = (lane_for("talla", False), lane_for("horario", True), lane_for("precio", False), lane_for("horario", False))
+        
+        if (admitidos == [True, True, False, True, False, True, False] and not cola_llena
+                and carriles == (LANE_HIGH, LANE_HIGH, LANE_NORMAL, LANE_LOW)):
+            print("✅ Carriles bajos descartados antes que los altos")
+            return True
+        else:
+            print(f"❌ Decisiones inesperadas: {admitidos} {cola_llena} {carriles}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en control de admisión: {str(e)}")
+        return False
+
+def test_admission_tenants():
+    """Prueba que la admisión cuente la cola de todas las tiendas, como cuenta las generaciones"""
+    print("\n🚦 Probando admisión con varias tiendas...")
+    import json
+    import tempfile
+    from admission import LANE_HIGH, LANE_LOW, get_controller
+    from tenants import load_tenants
+    
+    workdir = tempfile.mkdtemp()
+    tenants_file = os.path.join(workdir, "tiendas.json")
+    with open(tenants_file, "w", encoding="utf-8") as f:
+        json.dump({"tiendas": [
+            {"id": "uno", "phone_number_id": "111", "db_path": os.path.join(workdir, "uno.db"),
+             "data_dir": "data", "archive_dir": os.path.join(workdir, "archivo-uno")},
+            {"id": "dos", "phone_number_id": "222", "db_path": os.path.join(workdir, "dos.db"),
+             "data_dir": "data", "archive_dir": os.path.join(workdir, "archivo-dos")},
+        ]}, f)
+    
+    # El controlador es del proceso: al terminar vuelve a mirar las tiendas que miraba
+    previous = get_controller()._queue_depth
+    tenants = load_tenants(serialize=json.dumps, path=tenants_file)
+    controller = tenants.get("uno").whatsapp.admission
+    assert controller is tenants.get("dos").whatsapp.admission
+    max_queue = controller.max_queue
+    try:
+        controller.max_queue = 50
+        # La cola de "dos" cuenta para un mensaje de "uno": 30/50 pasa el umbral del carril bajo
+        tenants.get("dos").executor.queue_depth = lambda: 30
+        assert tenants.queue_depth() == 30
+        assert not controller.admit(LANE_LOW)
+        assert controller.admit(LANE_HIGH)
+        controller.release()
+    finally:
+        controller.max_queue = max_queue
+        controller.set_queue_function(previous)
+        for tenant in tenants:
+            tenant.executor.shutdown(wait=False)
+    print("✅ La cola de todas las tiendas cuenta para la admisión")
+
+def test_usage():
+    """Prueba la contabilidad de tokens y latencia de la IA"""
+    print("\n🧮 Probando uso de la IA...")
+    try:
+        import tempfile
+        import time
+        from database import Database
+        from openrouter import OpenRouterAI
+        
+        db = Database(os.path.join(tempfile.mkdtemp(), "uso.db"))
+        ai = OpenRouterAI(db)
+        respuesta = {"model": "modelo-a", "usage": {"prompt_tokens": 900, "completion_tokens": 40,
+                                                    "prompt_tokens_details": {"cached_tokens": 600}}}
+        ai.record_usage("111", "precio", "ok", time.perf_counter(), respuesta)
+        ai.record_usage("111", "talla", "ok", time.perf_counter(), respuesta)
+        ai.record_usage("222", "precio", "http_error", time.perf_counter())
+        db.flush()
+        
+        por_modelo = {fila["modelo"]: fila for fila in db.get_uso_ia("modelo")}
+        por_cliente = db.get_uso_ia("cliente")
+        por_intencion = {fila["intencion"]: fila["generaciones"] for fila in db.get_uso_ia("intencion")}
+        
+        if (por_modelo["modelo-a"]["tokens"] == 1880 and por_modelo["modelo-a"]["cached_tokens"] == 1200
+                and por_modelo[ai.model]["errores"] == 1 and por_cliente[0]["phone_number"] == "111"
+                and por_intencion == {"precio": 2, "talla": 1}):
+            print("✅ Tokens y errores agregados por modelo, cliente e intención")
+            return True
+        else:
+            print(f"❌ Agregados inesperados: {por_modelo} {por_cliente} {por_intencion}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en uso de la IA: {str(e)}")
+        return False
+
+def test_prompt_layout():
+    """Prueba que el prompt de sistema sea igual para todos y el historial vaya en turnos"""
+    print("\n🧱 Probando armado del prompt...")
+    try:
+        import tempfile
+        from database import Database
+        from openrouter import OpenRouterAI
+        
+        db = Database(os.path.join(tempfile.mkdtemp(), "prompt.db"))
+        ai = OpenRouterAI(db)
+        db.save_conversation("111", "hola", "hola, ¿qué buscás?")
+        db.save_conversation("111", "unas nike", "tenemos varias")
+        
+        con_historial = ai.build_messages("¿cuánto salen?", "111")
+        sin_historial = ai.build_messages("hola", "222")
+        roles = [message["role"] for message in con_historial]
+        
+        if (con_historial[0]["content"] == sin_historial[0]["content"]
+                and roles == ["system", "user", "assistant", "user", "assistant", "user"]
+                and con_historial[1]["content"] == "hola" and con_historial[-1]["content"] == "¿cuánto salen?"):
+            print("✅ Sistema idéntico entre clientes e historial en turnos")
+            return True
+        else:
+            print(f"❌ Mensajes inesperados: {roles}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error armando el prompt: {str(e)}")
+        return False
+
+def test_message_templates():
+    """Prueba que los mensajes salientes se cacheen hasta que cambie el catálogo"""
+    print("\n🧩 Probando plantillas de mensajes...")
+    try:
+        import tempfile
+        from database import Database
+        from message_templates import MessageCache
+        
+        db = Database(os.path.join(tempfile.mkdtemp(), "plantillas.db"))
+        messages = MessageCache(db)
+        producto = db.get_producto_por_id(1)
+        
+        tarjeta = messages.product(producto)
+        cacheada = messages.product(dict(producto, nombre="Otro nombre"))
+        # El stock no se cachea: cambia con cada reserva
+        con_stock = messages.product(dict(producto, stock={"40": 1}))
+        catalogo = messages.catalog()
+        contacto = messages.store("contacto")
+        
+        # Con otra versión de la tienda el mensaje se vuelve a armar
+        db.save_tienda_data(dict(db.get_tienda_info(), telefono="+54 9 11 0000-0000"))
+        messages.invalidate()
+        
+        if (tarjeta == cacheada and producto["nombre"] in tarjeta and "*Stock total:* 1 unidades" in con_stock
+                and catalogo.startswith("🛍️")
+                and "+54 9 11 0000-0000" not in contacto and "+54 9 11 0000-0000" in messages.store("contacto")):
+            print("✅ Mensajes cacheados por versión del catálogo")
+            return True
+        else:
+            print("❌ Mensajes inesperados")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en plantillas de mensajes: {str(e)}")
+        return False
+
+def test_async_engine():
+    """Prueba que el motor asyncio descarte duplicados y atienda reservas y botones como el de hilos"""
+    print("\n⚡ Probando motor asyncio...")
+    import asyncio
+    import tempfile
+    from async_engine import AsyncWhatsAppAPI
+    from database import Database
+    from reservations import StockReservations
+    from whatsapp import WhatsAppAPI
+    
+    db = Database(os.path.join(tempfile.mkdtemp(), "asyncio.db"))
+    whatsapp = WhatsAppAPI(db=db)
+    whatsapp.reservations = StockReservations(db.storage)
+    producto = db.get_producto_por_id(1)
+    talla = next(talla for talla, cantidad in producto["stock"].items() if cantidad > 0)
+    
+    async def run():
+        engine = AsyncWhatsAppAPI(None, whatsapp)
+        engine.coalesce_window = 0
+        enviados = []
+        
+        async def post(payload, to):
+            enviados.append(payload)
+            return True
+        engine._post = post
+        
+        try:
+            texto = {"from": "549111", "id": "wamid.r1", "type": "text", "text": {"body": f"reservar 1 talle {talla}"}}
+            assert await engine.process_message(texto)
+            # Reintento de Meta: mismo id, no se responde de nuevo
+            assert await engine.process_message(texto)
+            assert len(enviados) == 1 and enviados[0]["type"] == "interactive", enviados
+            
+            confirmar = enviados[0]["interactive"]["action"]["buttons"][0]["reply"]["id"]
+            assert await engine.process_message({
+                "from": "549111", "id": "wamid.r2", "type": "interactive",
+                "interactive": {"type": "button_reply", "button_reply": {"id": confirmar, "title": "Confirmar"}}
+            })
+            assert await engine.process_message({
+                "from": "549111", "id": "wamid.r3", "type": "interactive",
+                "interactive": {"type": "button_reply", "button_reply": {"id": "horarios", "title": "Horarios"}}
+            })
+        finally:
+            engine.close()
+        return enviados
+    
+    enviados = asyncio.run(run())
+    assert enviados[1]["text"]["body"].startswith("Confirmado"), enviados[1]
+    assert enviados[2]["text"]["body"] == whatsapp.messages.store("horarios")
+    print("✅ Duplicados, reservas y botones en modo asyncio")
+
+def test_async_pipeline():
+    """Prueba el camino de texto asyncio: ráfagas agrupadas, clientes en paralelo y orden por cliente"""
+    print("\n🔀 Probando flujo de texto asyncio...")
+    import asyncio
+    import tempfile
+    from async_engine import AsyncWhatsAppAPI
+    from database import Database
+    from whatsapp import WhatsAppAPI
+    
+    whatsapp = WhatsAppAPI(db=Database(os.path.join(tempfile.mkdtemp(), "flujo.db")))
+    whatsapp.rate_limiter = None
+    whatsapp.admission = None
+    
+    async def run():
+        engine = AsyncWhatsAppAPI(None, whatsapp)
+        engine.coalesce_window = 0.05
+        pedidos, enviados, en_curso = [], [], {"total": 0, "max": 0}
+        
+        async def generate_response(text, phone, intent=None):
+            pedidos.append((phone, text))
+            en_curso["total"] += 1
+            en_curso["max"] = max(en_curso["max"], en_curso["total"])
+            await asyncio.sleep(0.05)
+            en_curso["total"] -= 1
+            return f"eco: {text}"
+        engine.ai.generate_response = generate_response
+        
+        async def post(payload, to):
+            enviados.append((to, payload["text"]["body"]))
+            return True
+        engine._post = post
+        
+        def mensaje(phone, n, text):
+            return {"from": phone, "id": f"wamid.{phone}.{n}", "type": "text", "text": {"body": text}}
+        
+        try:
+            # Ráfaga de "a": una sola generación con los dos textos; "b" y "c" se atienden a la vez
+            async def rafaga():
+                first = asyncio.ensure_future(engine.process_message(mensaje("a", 1, "hola")))
+                await asyncio.sleep(0.01)
+                return await asyncio.gather(first, engine.process_message(mensaje("a", 2, "¿tienen talle 40?")))
+            await asyncio.gather(
+                rafaga(),
+                engine.process_message(mensaje("b", 1, "hola")),
+                engine.process_message(mensaje("c", 1, "hola"))
+            )
+            assert ("a", "hola\n¿tienen talle 40?") in pedidos and len(pedidos) == 3, pedidos
+            assert en_curso["max"] >= 2, en_curso
+            
+            # Sin ventana, dos mensajes del mismo cliente se responden uno después del otro y en orden
+            engine.coalesce_window = 0
+            pedidos.clear()
+            enviados.clear()
+            en_curso["max"] = 0
+            await asyncio.gather(engine.process_message(mensaje("d", 1, "uno")), engine.process_message(mensaje("d", 2, "dos")))
+            assert en_curso["max"] == 1 and enviados == [("d", "eco: uno"), ("d", "eco: dos")], enviados
+            assert not engine._locks and not engine._bursts and not engine._intake
+        finally:
+            engine.close()
+    
+    asyncio.run(run())
+    print("✅ Ráfagas agrupadas, clientes en paralelo y orden por cliente")
+
+def test_async_tenants():
+    """Prueba que el servidor asyncio rutee cada evento a la tienda dueña del número"""
+    print("\n🏬 Probando tiendas en modo asyncio...")
+    import asyncio
+    import json
+    import tempfile
+    from aiohttp.test_utils import TestClient, TestServer
+    import async_app
+    
+    workdir = tempfile.mkdtemp()
+    tenants_file = os.path.join(workdir, "tiendas.json")
+    with open(tenants_file, "w", encoding="utf-8") as f:
+        json.dump({"tiendas": [
+            {"id": "uno", "phone_number_id": "111", "db_path": os.path.join(workdir, "uno.db"),
+             "data_dir": "data", "archive_dir": os.path.join(workdir, "archivo-uno")},
+            {"id": "dos", "phone_number_id": "222", "db_path": os.path.join(workdir, "dos.db"),
+             "data_dir": "data", "archive_dir": os.path.join(workdir, "archivo-dos")},
+        ]}, f)
+    
+    payload = {"entry": [{"changes": [{"value": {
+        "metadata": {"phone_number_id": "222"},
+        "messages": [{"from": "5491100000000", "id": "wamid.dos", "type": "text", "text": {"body": "hola"}}]
+    }}]}]}
+    
+    async def run():
+        atendidos = []
+        client = TestClient(TestServer(async_app.create_app()))
+        await client.start_server()
+        try:
+            for tenant_id, engine in client.app["engines"].items():
+                async def process_message(message, tenant_id=tenant_id):
+                    atendidos.append((tenant_id, message["id"]))
+                engine.process_message = process_message
+            
+            response = await client.post("/webhook", data=json.dumps(payload))
+            assert response.status == 200
+            await asyncio.sleep(0.05)
+        finally:
+            await client.close()
+        return atendidos
+    
+    previous = os.environ.get("TENANTS_FILE")
+    os.environ["TENANTS_FILE"] = tenants_file
+    try:
+        atendidos = asyncio.run(run())
+    finally:
+        if previous is None:
+            os.environ.pop("TENANTS_FILE", None)
+        else:
+            os.environ["TENANTS_FILE"] = previous
+    
+    assert atendidos == [("dos", "wamid.dos")], atendidos
+    print("✅ Eventos ruteados por phone_number_id")
+
 def test_flask_app():
     """Prueba la aplicación Flask"""
     print("\n🌐 Probando aplicación Flask...")
@@ -111,12 +951,286 @@ def test_flask_app():
                 print(f"❌ Error en endpoint de tienda: {response.status_code}")
                 return False
             
+            # Endpoints admin: sin ADMIN_TOKEN configurado quedan cerrados
+            admin_token = os.environ.pop("ADMIN_TOKEN", None)
+            try:
+                closed = client.get("/debug/traces").status_code == 401
+                os.environ["ADMIN_TOKEN"] = "secreto"
+                denied = client.get("/conversations/5491100000000/export").status_code == 401
+                allowed = client.get("/debug/traces", headers={"X-Admin-Token": "secreto"}).status_code == 200
+                # Un token con caracteres no ASCII se rechaza (antes compare_digest tiraba TypeError → 500)
+                denied = denied and client.get("/debug/traces", headers={"X-Admin-Token": "contraseña"}).status_code == 401
+            finally:
+                os.environ.pop("ADMIN_TOKEN", None)
+                if admin_token is not None:
+                    os.environ["ADMIN_TOKEN"] = admin_token
+            
+            if closed and denied and allowed:
+                print("✅ Endpoints admin protegidos")
+            else:
+                print(f"❌ Endpoints admin: sin token {closed}, token inválido {denied}, token válido {allowed}")
+                return False
+            
             return True
             
     except Exception as e:
         print(f"❌ Error en Flask: {str(e)}")
         return False
 
+def test_catalog_import():
+    """Prueba la importación CSV/NDJSON: filas malas, upsert contra replace y cancelación"""
+    print("\n📥 Probando importación del catálogo...")
+    import io
+    import json
+    import tempfile
+    from catalog_import import CatalogImporter
+    from database import Database
+    
+    db_path = os.path.join(tempfile.mkdtemp(), "catalogo.db")
+    db = Database(db_path)
+    semilla = [p["id"] for p in db.get_productos()]
+    # Bloques de 2 filas: la importación atraviesa varios executemany
+    importer = CatalogImporter(db_path, chunk_size=2)
+    
+    csv_feed = "\n".join([
+        "id,nombre,marca,categoria,precio,stock,colores",
+        "9001,Feed Uno,Nike,Running,1500,40:5;41:3,Negro|Blanco",
+        "9002,Feed Dos,Puma,Urbana,abc,40:1,Rojo",
+        "9003,,Puma,Urbana,1200,40:1,Rojo",
+        "9004,Feed Cuatro,Puma,Urbana,1200,40:-1,Rojo",
+        "9005,Feed Cinco,Puma,Urbana,1200,40:2,Rojo",
+        "9001,Feed Uno bis,Nike,Running,1600,40:4,Negro",
+    ]) + "\n"
+    report = importer.run(io.StringIO(csv_feed), "csv", mode="upsert")
+    assert report["status"] == "done" and report["rows_read"] == 6 and report["rows_imported"] == 3, report
+    assert [sample["line"] for sample in report["error_samples"]] == [3, 4, 5], report["error_samples"]
+    
+    # Upsert: el catálogo anterior sigue y la última fila de un id gana
+    productos = {p["id"]: p for p in db.get_productos()}
+    assert set(semilla) | {9001, 9005} == set(productos)
+    assert productos[9001]["nombre"] == "Feed Uno bis" and productos[9001]["stock"] == {"40": 4}
+    rojos = [p["id"] for p in db.get_productos_pagina(color="rojo", limit=1000)["productos"]]
+    assert 9005 in rojos and 9001 not in rojos
+    
+    # Demasiados errores: se cancela y no se publica nada
+    version = db.get_catalog_version("productos")
+    ndjson_feed = "\n".join([
+        json.dumps({"id": 9100, "nombre": "Solo", "marca": "Vans", "categoria": "Skate", "precio": 900, "stock": {"39": 2}}),
+        "{no es json",
+        json.dumps({"id": -1, "nombre": "Mal", "marca": "Vans", "categoria": "Skate", "precio": 900}),
+    ]) + "\n"
+    report = importer.run(io.StringIO(ndjson_feed), "ndjson", mode="replace", max_errors=1)
+    assert report["status"] == "failed" and report["errors"] == 2, report
+    assert db.get_catalog_version("productos") == version and not db.get_producto_por_id(9100)
+    
+    # Replace: el archivo es el catálogo completo; el mismo contenido da la misma versión
+    report = importer.run(io.StringIO(ndjson_feed), "ndjson", mode="replace")
+    assert report["status"] == "done" and report["rows_imported"] == 1 and report["errors"] == 2, report
+    assert [p["id"] for p in db.get_productos()] == [9100]
+    version = db.get_catalog_version("productos")
+    importer.run(io.StringIO(ndjson_feed), "ndjson", mode="replace")
+    assert db.get_catalog_version("productos") == version
+    
+    # Un replace sin filas válidas no vacía el catálogo
+    report = importer.run(io.StringIO("{no es json\n"), "ndjson", mode="replace")
+    assert report["status"] == "failed" and [p["id"] for p in db.get_productos()] == [9100]
+    print("✅ Filas inválidas reportadas, upsert conserva y replace reemplaza")
+
+def test_facets():
+    """Prueba que las facetas incrementales coincidan con calcularlas de cero"""
+    print("\n🧮 Probando facetas materializadas...")
+    import io
+    import json
+    import statistics
+    import tempfile
+    from catalog_import import CatalogImporter
+    from database import Database
+    from reservations import StockReservations
+    
+    db_path = os.path.join(tempfile.mkdtemp(), "facetas.db")
+    db = Database(db_path)
+    base = {"categoria": "Running", "tallas": ["40", "41"], "colores": ["Negro"]}
+    db.save_productos_data([
+        dict(base, id=1, nombre="Uno", marca="Nike", precio=1000, stock={"40": 1, "41": 0}),
+        dict(base, id=2, nombre="Dos", marca="Nike", precio=3000, stock={"40": 0, "41": 2}),
+        dict(base, id=3, nombre="Tres", marca="Puma", precio=2000, stock={"40": 0, "41": 0}, categoria="Urbana"),
+    ])
+    
+    def de_cero():
+        productos = db.get_productos()
+        
+        def faceta(grupo):
+            precios = [p["precio"] for p in grupo]
+            tallas = sorted({t for p in grupo for t, c in p["stock"].items() if c > 0}, key=float)
+            return {"productos": len(grupo), "precio_min": min(precios), "precio_max": max(precios),
+                    "precio_mediana": statistics.median(precios), "tallas": tallas}
+        
+        return {
+            "total": faceta(productos),
+            "marcas": {m: faceta([p for p in productos if p["marca"] == m]) for m in {p["marca"] for p in productos}},
+            "categorias": {c: faceta([p for p in productos if p["categoria"] == c]) for c in {p["categoria"] for p in productos}},
+        }
+    
+    assert db.get_facetas() == de_cero()
+    assert db.get_facetas()["marcas"]["Nike"]["precio_mediana"] == 2000
+    
+    # Upsert que cambia de marca el único Puma: la faceta de Puma desaparece
+    fila = dict(base, id=3, nombre="Tres", marca="Vans", precio=2500, stock={"40": 3}, categoria="Urbana")
+    CatalogImporter(db_path).run(io.StringIO(json.dumps(fila) + "\n"), "ndjson", mode="upsert")
+    facetas = db.get_facetas()
+    assert "Puma" not in facetas["marcas"] and facetas == de_cero()
+    
+    # Agotar la única talla 40 de Nike la saca de sus tallas; liberar la devuelve
+    reservations = StockReservations(db_path)
+    reserva = reservations.reserve("cliente", 1, "40")
+    facetas = db.get_facetas()
+    assert facetas["marcas"]["Nike"]["tallas"] == ["41"] and facetas == de_cero()
+    reservations.release(reserva["id"])
+    assert db.get_facetas()["marcas"]["Nike"]["tallas"] == ["40", "41"] and db.get_facetas() == de_cero()
+    print("✅ Facetas al día después de importar y reservar")
+
+def test_import_holds():
+    """Prueba que reimportar el catálogo con reservas activas no venda de más"""
+    print("\n📦 Probando importación con reservas activas...")
+    import io
+    import json
+    import tempfile
+    from catalog_import import CatalogImporter
+    from database import Database
+    from reservations import StockReservations
+    
+    db_path = os.path.join(tempfile.mkdtemp(), "import.db")
+    db = Database(db_path)
+    reservations = StockReservations(db_path)
+    producto = db.get_producto_por_id(1)
+    talla = next(iter(producto["stock"]))
+    
+    def feed(cantidad):
+        fila = dict(producto, stock={talla: cantidad})
+        return io.StringIO(json.dumps(fila) + "\n")
+    
+    # El feed cuenta los 2 pares reservados: disponibles quedan 3
+    reserva = reservations.reserve("cliente", 1, talla, 2)
+    CatalogImporter(db_path).run(feed(5), "ndjson", mode="upsert")
+    assert db.get_producto_por_id(1)["stock"][talla] == 3
+    
+    # Al liberar se vuelve a la cantidad del feed, no a feed + reservado
+    reservations.release(reserva["id"])
+    assert db.get_producto_por_id(1)["stock"][talla] == 5
+    
+    # Lo mismo con replace y con el seed de data/productos.json
+    reserva = reservations.reserve("cliente", 1, talla, 2)
+    CatalogImporter(db_path).run(feed(4), "ndjson", mode="replace")
+    assert db.get_producto_por_id(1)["stock"][talla] == 2
+    db.save_productos_data([dict(producto, stock={talla: 1})])
+    assert db.get_producto_por_id(1)["stock"][talla] == 0
+    reservations.release(reserva["id"])
+    assert db.get_producto_por_id(1)["stock"][talla] == 1
+    print("✅ Las reservas activas se descuentan del stock importado")
+
+def test_catalog_cache():
+    """Prueba ETag/304, cuerpos comprimidos y que dos URLs no compartan cuerpo"""
+    print("\n🗜️  Probando cache de respuestas del catálogo...")
+    import gzip
+    import json
+    import zlib
+    from flask import Flask, request
+    from catalog_cache import CatalogCache
+    
+    class Versiones:
+        version = "v1"
+        
+        def get_catalog_version(self, kind):
+            return self.version
+    
+    db = Versiones()
+    cache = CatalogCache(db, serialize=json.dumps, check_interval=0)
+    app = Flask(__name__)
+    armados = []
+    
+    def responder(path, headers=None):
+        with app.test_request_context(path, headers=headers or {}):
+            return cache.respond(request, ("productos",), lambda: armados.append(path) or {"path": path, "relleno": "x" * 1000})
+    
+    response = responder("/products?limit=10", {"Accept-Encoding": "gzip"})
+    etag = response.headers["ETag"]
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(response.get_data()))["path"] == "/products?limit=10"
+    
+    # Misma versión: 304 sin armar de nuevo; sin gzip aceptado va el cuerpo plano
+    assert responder("/products?limit=10", {"If-None-Match": etag}).status_code == 304
+    plano = responder("/products?limit=10")
+    assert "Content-Encoding" not in plano.headers and json.loads(plano.get_data())["path"] == "/products?limit=10"
+    assert armados == ["/products?limit=10"]
+    
+    # Versión nueva: el ETag viejo ya no vale y el cuerpo se vuelve a armar
+    db.version = "v2"
+    response = responder("/products?limit=10", {"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    assert armados == ["/products?limit=10"] * 2
+    
+    # Dos URLs con el mismo crc32 comparten el texto del ETag pero no el cuerpo
+    path, otro = "/products?cursor=c50963c80102", "/products?cursor=d3f504638284"
+    assert zlib.crc32(path.encode("utf-8")) == zlib.crc32(otro.encode("utf-8"))
+    assert responder(otro).headers["ETag"] == responder(path).headers["ETag"]
+    assert json.loads(responder(path).get_data())["path"] == path
+    assert json.loads(responder(otro).get_data())["path"] == otro
+    print("✅ 304 con el ETag vigente, gzip y un cuerpo por URL")
+
+def test_postgres():
+    """Prueba el camino de PostgreSQL contra TEST_DATABASE_URL (una base descartable; sin ella se salta)"""
+    print("\n🐘 Probando PostgreSQL...")
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        print("⏭️  TEST_DATABASE_URL sin configurar: se salta")
+        if "pytest" in sys.modules:
+            import pytest
+            pytest.skip("TEST_DATABASE_URL sin configurar")
+        return
+    
+    import io
+    import json
+    import uuid
+    from catalog_import import CatalogImporter
+    from database import Database
+    from reservations import ReservationError, StockReservations
+    
+    # Esquema y seed; la segunda vez no tiene que fallar (init idempotente)
+    Database(url)
+    db = Database(url)
+    assert db.get_tienda_info()
+    assert db.get_productos()
+    
+    # Historial (pasa por la escritura diferida si está activa)
+    phone = f"test-{uuid.uuid4().hex[:8]}"
+    db.save_conversation(phone, "hola", "¡Hola!")
+    db.save_conversation(phone, "¿tienen talle 40?", "Sí")
+    historial = db.get_conversation_history(phone)
+    assert [turno["mensaje"] for turno in historial] == ["¿tienen talle 40?", "hola"], historial
+    
+    # Importación upsert de un producto propio de esta corrida
+    producto_id = 900000 + int(uuid.uuid4().hex[:4], 16)
+    fila = {"id": producto_id, "nombre": "Prueba PG", "marca": "PG", "categoria": "Test",
+            "precio": 1000, "stock": {"40": 2}, "colores": ["Negro"]}
+    report = CatalogImporter(url).run(io.StringIO(json.dumps(fila) + "\n"), "ndjson", mode="upsert")
+    assert report["status"] == "done" and report["rows_imported"] == 1, report
+    assert db.get_producto_por_id(producto_id)["stock"] == {"40": 2}
+    pagina = db.get_productos_pagina(marca="PG", color="negro", limit=1000)
+    assert producto_id in [p["id"] for p in pagina["productos"]]
+    
+    # Reserva: descuenta, no deja pasar de lo que hay y devuelve al liberar
+    reservations = StockReservations(url)
+    reserva = reservations.reserve(phone, producto_id, "40", 2)
+    assert db.get_producto_por_id(producto_id)["stock"] == {"40": 0}
+    try:
+        reservations.reserve("otro-" + phone, producto_id, "40")
+        assert False, "reservó sin stock"
+    except ReservationError as e:
+        assert e.code == "sin_stock"
+    reservations.release(reserva["id"])
+    assert db.get_producto_por_id(producto_id)["stock"] == {"40": 2}
+    print("✅ Esquema, historial, importación y reservas en PostgreSQL")
+
 def main():
     """Función principal de prueba"""
     print("🚀 Iniciando pruebas del Bot WhatsApp Zapatillas Dolores...\n")
@@ -125,6 +1239,30 @@ def main():
         ("Base de datos", test_database),
         ("OpenRouter AI", test_openrouter),
         ("WhatsApp", test_whatsapp),
+        ("Agrupación", test_coalescer),
+        ("Ejecutor", test_executor),
+        ("Vaciado", test_drain),
+        ("Webhook", test_webhook_events),
+        ("Escritura diferida", test_write_buffer),
+        ("Intercambios recientes", test_turn_cache),
+        ("Paginación", test_pagination),
+        ("Filtro por color", test_color_filter),
+        ("Archivo", test_archive),
+        ("Reservas", test_reservations),
+        ("Importación", test_catalog_import),
+        ("Importación con reservas", test_import_holds),
+        ("Facetas", test_facets),
+        ("Límites de uso", test_rate_limit),
+        ("Admisión", test_admission),
+        ("Admisión por tienda", test_admission_tenants),
+        ("Uso de la IA", test_usage),
+        ("Prompt cacheable", test_prompt_layout),
+        ("Plantillas", test_message_templates),
+        ("Motor asyncio", test_async_engine),
+        ("Flujo asyncio", test_async_pipeline),
+        ("Tiendas asyncio", test_async_tenants),
+        ("Cache del catálogo", test_catalog_cache),
+        ("PostgreSQL", test_postgres),
         ("Flask App", test_flask_app)
     ]
     
@@ -132,8 +1270,9 @@ def main():
     
     for test_name, test_func in tests:
         try:
+            # Las pruebas con assert no devuelven nada: si no fallaron, pasaron
             result = test_func()
-            results.append((test_name, result))
+            results.append((test_name, result is not False))
         except Exception as e:
             print(f"❌ Error inesperado en {test_name}: {str(e)}")
             results.append((test_name, False))
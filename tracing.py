@@ -0,0 +1,162 @@
+"""
+Trazas por mensaje: línea de tiempo de cada respuesta
+
+Una traza nace al recibir el webhook y viaja con el mensaje por la cola,
+la agrupación y la generación. Las trazas terminadas quedan en un ring
+buffer en memoria; una muestra (más todas las lentas) se persiste en SQLite
+desde un hilo aparte.
+"""
+
+import collections
+import contextvars
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_current: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+
+_buffer = collections.deque(maxlen=int(os.getenv("TRACE_BUFFER_SIZE", 500)))
+_sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+_slow_ms = float(os.getenv("TRACE_SLOW_MS", "5000"))
+
+_persist_queue: queue.Queue = queue.Queue(maxsize=1000)
+_persister: Optional[Callable[[List[Dict[str, Any]]], None]] = None
+_persist_thread: Optional[threading.Thread] = None
+
+
+class Trace:
+    """Una traza con sus spans (offset y duración relativos al inicio)"""
+
+    def __init__(self, name: str, start: float = None, **attrs):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.t0 = start if start is not None else time.perf_counter()
+        self.started_at = time.time() - (time.perf_counter() - self.t0)
+        self.last_mark = self.t0
+        self.spans: List[tuple] = []
+        self.duration_ms = None
+
+    def add_span(self, name: str, start: float, end: float):
+        self.spans.append((name, (start - self.t0) * 1000, (end - start) * 1000))
+
+    def mark(self, name: str):
+        """Registra un span desde la marca anterior hasta ahora"""
+        now = time.perf_counter()
+        self.add_span(name, self.last_mark, now)
+        self.last_mark = now
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "attrs": self.attrs,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms or 0, 3),
+            "spans": [
+                {"name": name, "offset_ms": round(offset, 3), "duration_ms": round(duration, 3)}
+                for name, offset, duration in self.spans
+            ]
+        }
+
+
+def new_trace(name: str, start: float = None, **attrs) -> Trace:
+    """Crea una traza (sin activarla)"""
+    return Trace(name, start, **attrs)
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def activate(trace: Optional[Trace]):
+    """Hace que la traza sea la actual en este hilo o tarea"""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str):
+    """Mide un bloque dentro de la traza actual (no hace nada si no hay traza)"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, time.perf_counter())
+
+
+def record(name: str, start: float, end: float):
+    """Agrega un span ya medido a la traza actual"""
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, start, end)
+
+
+def mark(name: str):
+    """Marca un span desde la marca anterior en la traza actual"""
+    trace = _current.get()
+    if trace is not None:
+        trace.mark(name)
+
+
+def finish(trace: Optional[Trace]):
+    """Cierra la traza, la guarda en el ring buffer y decide si persistirla"""
+    if trace is None or trace.duration_ms is not None:
+        return
+
+    trace.duration_ms = (time.perf_counter() - trace.t0) * 1000
+    _buffer.append(trace)
+
+    if _persister is not None and (trace.duration_ms >= _slow_ms or random.random() < _sample_rate):
+        try:
+            _persist_queue.put_nowait(trace.to_dict())
+        except queue.Full:
+            pass
+
+
+def slowest(limit: int = 20) -> List[Dict[str, Any]]:
+    """Trazas más lentas del ring buffer"""
+    traces = sorted(list(_buffer), key=lambda trace: trace.duration_ms, reverse=True)
+    return [trace.to_dict() for trace in traces[:limit]]
+
+
+def set_persister(persister: Callable[[List[Dict[str, Any]]], None]):
+    """Configura dónde se guardan las trazas muestreadas (ej. Database.save_trazas)"""
+    global _persister, _persist_thread
+    _persister = persister
+
+    if _persist_thread is None:
+        _persist_thread = threading.Thread(target=_persist_loop, name="trace-persister", daemon=True)
+        _persist_thread.start()
+
+
+def _persist_loop():
+    while True:
+        batch = [_persist_queue.get()]
+        while True:
+            try:
+                batch.append(_persist_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            _persister(batch)
+        except Exception as e:
+            logger.error("Error guardando trazas: %s", e)
@@ -0,0 +1,82 @@
+"""
+Cache en memoria de los últimos intercambios por cliente
+
+LRU sobre clientes, con un tope de intercambios por cliente. Se llena al
+leer el historial de SQLite (miss) y se mantiene al día desde
+save_conversation (write-through), así una conversación activa no vuelve a
+consultar la base para armar el contexto.
+
+Solo sirve con un único proceso escribiendo el historial (un worker y
+SQLite): Database no lo usa cuando la base es compartida.
+"""
+
+import collections
+import threading
+from typing import Any, Dict, List, Optional
+
+import metrics
+
+_caches: Dict[str, "RecentTurnsCache"] = {}
+_caches_lock = threading.Lock()
+
+
+class RecentTurnsCache:
+    """Últimos max_turns intercambios de los max_customers clientes más recientes"""
+
+    def __init__(self, max_customers: int = 10000, max_turns: int = 10):
+        self.max_customers = max_customers
+        self.max_turns = max_turns
+        self._turns: "collections.OrderedDict[str, collections.deque]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, phone_number: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Últimos intercambios (más nuevo primero) o None si no están en memoria"""
+        if limit > self.max_turns:
+            return None
+
+        with self._lock:
+            turns = self._turns.get(phone_number)
+            if turns is None:
+                metrics.HISTORY_CACHE.inc("miss")
+                return None
+            self._turns.move_to_end(phone_number)
+            recent = list(turns)[-limit:] if limit > 0 else []
+
+        metrics.HISTORY_CACHE.inc("hit")
+        return list(reversed(recent))
+
+    def load(self, phone_number: str, history: List[Dict[str, Any]]):
+        """Guarda lo leído de la base (más nuevo primero, como get_conversation_history)"""
+        with self._lock:
+            self._turns[phone_number] = collections.deque(reversed(history[:self.max_turns]), maxlen=self.max_turns)
+            self._turns.move_to_end(phone_number)
+            self._evict()
+
+    def append(self, phone_number: str, turn: Dict[str, Any]):
+        """Write-through: solo actualiza clientes que ya están en memoria"""
+        with self._lock:
+            turns = self._turns.get(phone_number)
+            if turns is not None:
+                turns.append(turn)
+                self._turns.move_to_end(phone_number)
+
+    def clear(self):
+        with self._lock:
+            self._turns.clear()
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def _evict(self):
+        while len(self._turns) > self.max_customers:
+            self._turns.popitem(last=False)
+
+
+def get_cache(db_path: str, **kwargs) -> RecentTurnsCache:
+    """Un único cache por archivo de base de datos (compartido entre instancias)"""
+    with _caches_lock:
+        cache = _caches.get(db_path)
+        if cache is None:
+            cache = RecentTurnsCache(**kwargs)
+            _caches[db_path] = cache
+        return cache
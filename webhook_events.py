@@ -0,0 +1,83 @@
+"""
+Clasificación rápida de los payloads del webhook de WhatsApp
+
+La mayoría de los POST son callbacks de estado (sent/delivered/read), no
+mensajes. Se reconocen mirando los bytes crudos antes de parsear el JSON,
+así el caso más común no paga el parseo ni el recorrido del payload.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+KIND_MESSAGES = "messages"
+KIND_STATUSES = "statuses"
+KIND_OTHER = "other"
+
+_MESSAGES_KEY = b'"messages"'
+_STATUSES_KEY = b'"statuses"'
+
+
+def classify(raw: bytes) -> str:
+    """Tipo de payload según las claves presentes (sin parsear el JSON)"""
+    if _MESSAGES_KEY in raw:
+        return KIND_MESSAGES
+    if _STATUSES_KEY in raw:
+        return KIND_STATUSES
+    return KIND_OTHER
+
+
+def split(data: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[tuple]]:
+    """Separa en una sola pasada los mensajes y los estados de un payload
+
+    Los estados salen como tuplas (message_id, estado, destinatario, timestamp),
+    listas para guardarse en bloque.
+    """
+    messages = []
+    statuses = []
+
+    for number_messages, number_statuses in split_by_number(data).values():
+        messages.extend(number_messages)
+        statuses.extend(number_statuses)
+
+    return messages, statuses
+
+
+def split_by_number(data: Dict[str, Any]) -> Dict[Optional[str], Tuple[List[Dict[str, Any]], List[tuple]]]:
+    """Como split, pero agrupado por el número de la tienda que recibió el evento
+
+    La clave es metadata.phone_number_id de cada change (None si no viene).
+    """
+    groups: Dict[Optional[str], Tuple[List[Dict[str, Any]], List[tuple]]] = {}
+
+    for entry in data.get("entry") or ():
+        for change in entry.get("changes") or ():
+            value = change.get("value") or {}
+            phone_number_id = (value.get("metadata") or {}).get("phone_number_id")
+            messages, statuses = groups.setdefault(phone_number_id, ([], []))
+            messages.extend(value.get("messages") or ())
+
+            for status in value.get("statuses") or ():
+                statuses.append((
+                    status.get("id"),
+                    status.get("status"),
+                    status.get("recipient_id"),
+                    _to_int(status.get("timestamp"))
+                ))
+
+    return groups
+
+
+def parse(raw: bytes) -> Optional[Dict[str, Any]]:
+    """Parsea el cuerpo; devuelve None si no es JSON válido"""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -1,61 +1,191 @@
 import requests
 import json
 import os
-from typing import Dict, Any, Optional
-from openrouter import OpenRouterAI
+import logging
+from typing import Dict, Any, Optional, Tuple
+from openrouter import OpenRouterAI, detect_intent
+from coalescer import MessageCoalescer
+import metrics
+import tracing
 import urllib.parse
+import re
+import admission
+import message_templates
+import rate_limit
+from reservations import ReservationError
+
+logger = logging.getLogger(__name__)
+
+# URL del PDF con la lista de precios
+PRICE_LIST_PDF_URL = "https://doc-0g-5c-apps-viewer.googleusercontent.com/viewer/secure/pdf/jq1q8fvv4aj7nkrdgvl63dj88876jnbk/65m3raapm4se7qlhg2193gs5ja0tiqqu/1760484750000/drive/00711664236692323085/ACFrOgDILoXafo33PBcGg4aFLa40OhoeY44iUscZR1wuToeGycwIHQ8pQW9A-brTgcJ_KJeLYjWh0QCz0T_eg-Hgqoh3IMlc8c-1ckh7U1lCA21kS7iH0SFm40QrsuJ7hM9FSgj2vbMlOtwRMgxnNla5YB25JpgCde9faWC2Ie91j7mzYr_s13D36zA__T7gLCtDuUjlzgPWCKelyQhACpDwO00ciBYhNifFV2-iANKOAdhr1VK9Lv6NKPglLZ2GpStzvXzMzeRokdn39BTK?print=true&nonce=dd5nm6p9npifa&user=00711664236692323085&hash=dt87jesvspr4r80forvrjm1kv8c91itn"
+
+# Palabras clave que disparan el envío de la lista de precios
+PRICE_LIST_KEYWORDS = [
+    "lista de precios", "lista precios", "precios", "catálogo", "catalogo",
+    "precio lista", "lista", "pdf", "archivo", "documento", "precio",
+    "cuanto cuesta", "cuánto cuesta", "precio", "valores", "tarifa"
+]
+
+PRICE_LIST_MESSAGE = "📋 Te envío nuestra lista de precios actualizada. Ahí vas a encontrar todos los productos con sus precios y descuentos disponibles."
+PRICE_LIST_CAPTION = "📋 Lista de Precios - Zapatillas Dolores\n\nAquí tenés todos nuestros productos con precios actualizados. ¡Cualquier consulta, avisame!"
+
+# "reservar 3 talle 41", "reservo el 3 en 40.5 x2"
+RESERVATION_PATTERN = re.compile(
+    r"\breserv\w*\s+(?:el\s+|la\s+)?(?:producto\s+|modelo\s+|c[oó]digo\s+)?#?(\d+)"
+    r"\s+(?:en\s+)?(?:(?:la\s+|el\s+)?(?:talla|talle|n[uú]mero|nro\.?)\s*)?(\d+(?:[.,]5)?)"
+    r"(?:\s*(?:x|por)\s*(\d+))?",
+    re.IGNORECASE
+)
+
+# Botones de una reserva: "<acción>:<id de la reserva>"
+RESERVATION_CONFIRM = "reserva_confirmar"
+RESERVATION_RELEASE = "reserva_liberar"
+
+RESERVATION_ERRORS = {
+    "producto": "No encontré ese código de producto. ¿Me lo pasás de nuevo junto con el talle?",
+    "sin_stock": "Uh, no nos queda stock de ese talle 😕 ¿Querés que te fije otro talle o modelo?",
+    "vencida": "La reserva se venció y liberamos el par. Si todavía lo querés, escribime de nuevo \"reservar\" y lo vemos.",
+    "no_encontrada": "No encontré esa reserva. ¿Me pasás de nuevo el código del producto y el talle?",
+    "estado": "Esa reserva ya estaba cerrada. ¿Te ayudo con algo más?"
+}
+
+QUICK_REPLY_DEFAULT = "Gracias por tu mensaje. ¿En qué más puedo ayudarte?"
+
+def parse_reservation(message_text: str) -> Optional[tuple]:
+    """(producto_id, talla, cantidad) si el mensaje pide reservar, None si no"""
+    match = RESERVATION_PATTERN.search(message_text)
+    if not match:
+        return None
+    producto_id, talla, cantidad = match.groups()
+    return int(producto_id), talla.replace(",", "."), int(cantidad or 1)
+
+def parse_quick_reply(message_data: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    """(número, id del botón) de una respuesta rápida"""
+    phone_number = message_data.get("from")
+    quick_reply = message_data.get("interactive", {}).get("button_reply", {})
+    if phone_number and quick_reply.get("id"):
+        logger.info("Respuesta rápida recibida de %s: %s", phone_number, quick_reply.get("title"))
+    return phone_number, quick_reply.get("id")
+
+def wants_price_list(message_text: str) -> bool:
+    """Indica si el mensaje pide la lista de precios"""
+    message_lower = message_text.lower()
+    return any(keyword in message_lower for keyword in PRICE_LIST_KEYWORDS)
 
 class WhatsAppAPI:
-    def __init__(self):
-        self.access_token = os.getenv("WHATSAPP_TOKEN")
-        self.phone_number_id = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
+    def __init__(self, phone_number_id: str = None, access_token: str = None, db=None):
+        # Sin parámetros: la tienda única configurada por variables de entorno
+        self.access_token = access_token or os.getenv("WHATSAPP_TOKEN")
+        self.phone_number_id = phone_number_id or os.getenv("WHATSAPP_PHONE_NUMBER_ID")
         self.verify_token = os.getenv("WHATSAPP_VERIFY_TOKEN")
-        self.base_url = f"https://graph.facebook.com/v18.0/{self.phone_number_id}/messages"
-        self.ai = OpenRouterAI()
+        graph_url = os.getenv("WHATSAPP_GRAPH_URL", "https://graph.facebook.com/v18.0")
+        self.base_url = f"{graph_url}/{self.phone_number_id}/messages"
+        self.ai = OpenRouterAI(db)
+        # Mensajes de la tienda y tarjetas de producto ya renderizados
+        self.messages = message_templates.MessageCache(self.ai.db)
+        
+        # Ventana para juntar mensajes seguidos del mismo cliente (0 = desactivado)
+        coalesce_window = float(os.getenv("COALESCE_WINDOW_SECONDS", "2"))
+        coalesce_max_wait = float(os.getenv("COALESCE_MAX_WAIT_SECONDS", "6"))
+        self.coalescer = None
+        if coalesce_window > 0:
+            self.coalescer = MessageCoalescer(self._process_coalesced, coalesce_window, coalesce_max_wait)
+        
+        # Ejecutor por conversación (lo asigna app.py); sin él se procesa en el hilo actual
+        self.executor = None
         
+        # Reservas de stock (las asigna app.py); sin ellas no se reserva desde el chat
+        self.reservations = None
+        
+        # Límite de mensajes a la IA por cliente y global (uno solo para todas las tiendas)
+        self.rate_limiter = rate_limit.get_limiter()
+        # Al pasarse: "fallback" responde por palabras clave, "defer" reintenta cuando haya ficha
+        self.rate_limit_action = os.getenv("RATE_LIMIT_ACTION", "fallback")
+        self.rate_limit_max_defer = float(os.getenv("RATE_LIMIT_MAX_DEFER_SECONDS", 10))
+        
+        # Control de admisión con carriles de prioridad (compartido entre tiendas)
+        self.admission = admission.get_controller()
+        
+    def build_headers(self) -> Dict[str, str]:
+        """Headers para la Graph API"""
+        return {
+            "Authorization": f"Bearer {self.access_token}",
+            "Content-Type": "application/json"
+        }
+    
+    def build_text_payload(self, to: str, message: str) -> Dict[str, Any]:
+        """Payload de un mensaje de texto"""
+        return {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "text",
+            "text": {
+                "body": message
+            }
+        }
+    
+    def build_document_payload(self, to: str, document_url: str, filename: str, caption: str) -> Dict[str, Any]:
+        """Payload de un mensaje con documento"""
+        return {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "document",
+            "document": {
+                "link": document_url,
+                "filename": filename,
+                "caption": caption
+            }
+        }
+    
+    def build_buttons_payload(self, to: str, body: str, buttons: list) -> Dict[str, Any]:
+        """Payload de un mensaje con botones de respuesta rápida (máximo 3)"""
+        return {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "interactive",
+            "interactive": {
+                "type": "button",
+                "body": {"text": body},
+                "action": {
+                    "buttons": [
+                        {"type": "reply", "reply": {"id": button_id, "title": title}}
+                        for button_id, title in buttons
+                    ]
+                }
+            }
+        }
+    
     def send_message(self, to: str, message: str) -> bool:
         """Envía un mensaje de texto a WhatsApp"""
         try:
-            headers = {
-                "Authorization": f"Bearer {self.access_token}",
-                "Content-Type": "application/json"
-            }
+            headers = self.build_headers()
+            payload = self.build_text_payload(to, message)
             
-            payload = {
-                "messaging_product": "whatsapp",
-                "to": to,
-                "type": "text",
-                "text": {
-                    "body": message
-                }
-            }
-            
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
+            with metrics.stage("send"):
+                response = requests.post(
+                    self.base_url,
+                    headers=headers,
+                    json=payload,
+                    timeout=30
+                )
             
             if response.status_code == 200:
-                print(f"Mensaje enviado exitosamente a {to}")
+                logger.debug("Mensaje enviado a %s", to, extra={"event": "send_ok"})
                 return True
             else:
-                print(f"Error enviando mensaje: {response.status_code}")
-                print(f"Respuesta: {response.text}")
+                logger.error("Error enviando mensaje: %s %s", response.status_code, response.text)
+                metrics.ERRORS.inc("whatsapp_send")
                 return False
                 
         except Exception as e:
-            print(f"Error enviando mensaje: {str(e)}")
+            logger.error("Error enviando mensaje: %s", e)
+            metrics.ERRORS.inc("whatsapp_send")
             return False
     
     def send_template_message(self, to: str, template_name: str, language_code: str = "es") -> bool:
         """Envía un mensaje de plantilla a WhatsApp"""
         try:
-            headers = {
-                "Authorization": f"Bearer {self.access_token}",
-                "Content-Type": "application/json"
-            }
+            headers = self.build_headers()
             
             payload = {
                 "messaging_product": "whatsapp",
@@ -77,268 +207,340 @@ class WhatsAppAPI:
             )
             
             if response.status_code == 200:
-                print(f"Plantilla enviada exitosamente a {to}")
+                logger.debug("Plantilla enviada a %s", to)
                 return True
             else:
-                print(f"Error enviando plantilla: {response.status_code}")
-                print(f"Respuesta: {response.text}")
+                logger.error("Error enviando plantilla: %s %s", response.status_code, response.text)
                 return False
                 
         except Exception as e:
-            print(f"Error enviando plantilla: {str(e)}")
+            logger.error("Error enviando plantilla: %s", e)
             return False
     
     def send_document_message(self, to: str, document_url: str, filename: str = "lista_precios.pdf", caption: str = "") -> bool:
         """Envía un documento PDF a WhatsApp"""
         try:
-            headers = {
-                "Authorization": f"Bearer {self.access_token}",
-                "Content-Type": "application/json"
-            }
+            headers = self.build_headers()
+            payload = self.build_document_payload(to, document_url, filename, caption)
             
-            payload = {
-                "messaging_product": "whatsapp",
-                "to": to,
-                "type": "document",
-                "document": {
-                    "link": document_url,
-                    "filename": filename,
-                    "caption": caption
-                }
-            }
+            with metrics.stage("send"):
+                response = requests.post(
+                    self.base_url,
+                    headers=headers,
+                    json=payload,
+                    timeout=30
+                )
             
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
+            if response.status_code == 200:
+                logger.debug("Documento enviado a %s", to)
+                return True
+            else:
+                logger.error("Error enviando documento: %s %s", response.status_code, response.text)
+                metrics.ERRORS.inc("whatsapp_send")
+                return False
+                
+        except Exception as e:
+            logger.error("Error enviando documento: %s", e)
+            metrics.ERRORS.inc("whatsapp_send")
+            return False
+    
+    def send_buttons_message(self, to: str, body: str, buttons: list) -> bool:
+        """Envía un mensaje con botones [(id, título), ...]"""
+        try:
+            payload = self.build_buttons_payload(to, body, buttons)
+            
+            with metrics.stage("send"):
+                response = requests.post(
+                    self.base_url,
+                    headers=self.build_headers(),
+                    json=payload,
+                    timeout=30
+                )
             
             if response.status_code == 200:
-                print(f"Documento enviado exitosamente a {to}")
+                logger.debug("Botones enviados a %s", to)
                 return True
             else:
-                print(f"Error enviando documento: {response.status_code}")
-                print(f"Respuesta: {response.text}")
+                logger.error("Error enviando botones: %s %s", response.status_code, response.text)
+                metrics.ERRORS.inc("whatsapp_send")
                 return False
                 
         except Exception as e:
-            print(f"Error enviando documento: {str(e)}")
+            logger.error("Error enviando botones: %s", e)
+            metrics.ERRORS.inc("whatsapp_send")
             return False
     
     def send_product_message(self, to: str, product: Dict[str, Any]) -> bool:
         """Envía información de un producto en formato estructurado"""
         try:
-            # Crear mensaje con información del producto
-            message = f"""
-🛍️ *{product['marca']} {product['nombre']}*
-
-💰 *Precio:* ${product['precio']:,}
-📏 *Tallas disponibles:* {', '.join(product['tallas'])}
-🎨 *Colores:* {', '.join(product['colores'])}
-📦 *Stock total:* {sum(product['stock'].values())} unidades
-
-📝 *Descripción:*
-{product['descripcion']}
-
-¿Te interesa este producto? ¿Qué talla necesitas?
-            """.strip()
-            
-            return self.send_message(to, message)
+            return self.send_message(to, self.messages.product(product))
             
         except Exception as e:
-            print(f"Error enviando información del producto: {str(e)}")
+            logger.error("Error enviando información del producto: %s", e)
             return False
     
-    def send_catalog_message(self, to: str, products: list) -> bool:
-        """Envía un catálogo de productos"""
+    def send_catalog_message(self, to: str, products: list = None) -> bool:
+        """Envía un catálogo de productos (sin products: el de la tienda)"""
         try:
-            if not products:
-                message = "No encontré productos que coincidan con tu búsqueda. ¿Podrías ser más específico?"
-                return self.send_message(to, message)
-            
-            message = "🛍️ *Catálogo de Productos*\n\n"
-            
-            for i, product in enumerate(products[:5], 1):  # Mostrar máximo 5 productos
-                message += f"{i}. *{product['marca']} {product['nombre']}*\n"
-                message += f"   💰 ${product['precio']:,}\n"
-                message += f"   📏 Tallas: {', '.join(product['tallas'])}\n"
-                message += f"   🎨 Colores: {', '.join(product['colores'])}\n\n"
-            
-            if len(products) > 5:
-                message += f"... y {len(products) - 5} productos más.\n\n"
-            
-            message += "¿Te interesa algún producto específico? Puedo darte más detalles."
-            
-            return self.send_message(to, message)
+            return self.send_message(to, self.messages.catalog(products))
             
         except Exception as e:
-            print(f"Error enviando catálogo: {str(e)}")
+            logger.error("Error enviando catálogo: %s", e)
             return False
     
     def send_store_info_message(self, to: str) -> bool:
         """Envía información de la tienda"""
         try:
-            tienda_info = self.ai.db.get_tienda_info()
-            
-            message = f"""
-🏪 *{tienda_info.get('nombre', 'Zapatillas Dolores')}*
-
-📍 *Ubicación:* {tienda_info.get('ubicacion', 'Dolores, Buenos Aires, Argentina')}
-🏠 *Dirección:* {tienda_info.get('direccion', 'Calle Principal 123, Dolores, Buenos Aires')}
-📞 *Teléfono:* {tienda_info.get('telefono', '+54 9 11 1234-5678')}
-📧 *Email:* {tienda_info.get('email', 'info@zapatillasdolores.com')}
-
-🕒 *Horarios de Atención:*
-            """
-            
-            if 'horarios' in tienda_info:
-                for dia, horario in tienda_info['horarios'].items():
-                    message += f"• {dia.replace('_', ' ').title()}: {horario}\n"
-            
-            message += f"""
-💳 *Métodos de Pago:*
-            """
-            
-            if 'metodos_pago' in tienda_info:
-                for metodo in tienda_info['metodos_pago']:
-                    message += f"• {metodo}\n"
-            
-            message += f"""
-🚚 *Envíos:*
-            """
-            
-            if 'envios' in tienda_info:
-                for tipo, precio in tienda_info['envios'].items():
-                    message += f"• {tipo.title()}: {precio}\n"
-            
-            message += "\n¡Te esperamos en nuestra tienda! 🛍️"
-            
-            return self.send_message(to, message)
+            return self.send_message(to, self.messages.store("tienda_info"))
             
         except Exception as e:
-            print(f"Error enviando información de la tienda: {str(e)}")
+            logger.error("Error enviando información de la tienda: %s", e)
             return False
     
     def send_price_list_pdf(self, to: str) -> bool:
         """Envía la lista de precios en PDF"""
         try:
-            # URL del PDF proporcionada
-            pdf_url = "https://doc-0g-5c-apps-viewer.googleusercontent.com/viewer/secure/pdf/jq1q8fvv4aj7nkrdgvl63dj88876jnbk/65m3raapm4se7qlhg2193gs5ja0tiqqu/1760484750000/drive/00711664236692323085/ACFrOgDILoXafo33PBcGg4aFLa40OhoeY44iUscZR1wuToeGycwIHQ8pQW9A-brTgcJ_KJeLYjWh0QCz0T_eg-Hgqoh3IMlc8c-1ckh7U1lCA21kS7iH0SFm40QrsuJ7hM9FSgj2vbMlOtwRMgxnNla5YB25JpgCde9faWC2Ie91j7mzYr_s13D36zA__T7gLCtDuUjlzgPWCKelyQhACpDwO00ciBYhNifFV2-iANKOAdhr1VK9Lv6NKPglLZ2GpStzvXzMzeRokdn39BTK?print=true&nonce=dd5nm6p9npifa&user=00711664236692323085&hash=dt87jesvspr4r80forvrjm1kv8c91itn"
+            pdf_url = PRICE_LIST_PDF_URL
             
-            print(f"📋 Enviando lista de precios a {to}")
-            print(f"📋 URL del PDF: {pdf_url[:100]}...")
+            logger.info("Enviando lista de precios a %s", to)
             
             # Primero enviar un mensaje explicativo
-            message = "📋 Te envío nuestra lista de precios actualizada. Ahí vas a encontrar todos los productos con sus precios y descuentos disponibles."
+            message = PRICE_LIST_MESSAGE
             message_success = self.send_message(to, message)
-            print(f"📋 Mensaje explicativo enviado: {message_success}")
             
             # Luego enviar el PDF
-            caption = "📋 Lista de Precios - Zapatillas Dolores\n\nAquí tenés todos nuestros productos con precios actualizados. ¡Cualquier consulta, avisame!"
+            caption = PRICE_LIST_CAPTION
             pdf_success = self.send_document_message(to, pdf_url, "lista_precios.pdf", caption)
-            print(f"📋 PDF enviado: {pdf_success}")
+            logger.debug("Lista de precios enviada: mensaje=%s pdf=%s", message_success, pdf_success)
             
             return pdf_success
             
         except Exception as e:
-            print(f"❌ Error enviando lista de precios: {str(e)}")
+            logger.error("Error enviando lista de precios: %s", e)
             return False
     
-    def process_message(self, message_data: Dict[str, Any]) -> bool:
+    def process_message(self, message_data: Dict[str, Any], trace: tracing.Trace = None) -> bool:
         """Procesa un mensaje entrante y genera respuesta"""
         try:
+            # Botones (confirmar/liberar reservas, menú)
+            if message_data.get("type") == "interactive":
+                try:
+                    return self.process_quick_reply(message_data)
+                finally:
+                    tracing.finish(trace)
+            
             # Extraer información del mensaje
             phone_number = message_data.get("from")
             message_text = message_data.get("text", {}).get("body", "")
             message_id = message_data.get("id")
             
             if not phone_number or not message_text:
-                print("Mensaje inválido recibido")
+                logger.warning("Mensaje inválido recibido")
+                tracing.finish(trace)
                 return False
             
-            print(f"Mensaje recibido de {phone_number}: {message_text}")
-            
-            # Verificar si pide lista de precios
-            message_lower = message_text.lower()
-            price_list_keywords = [
-                "lista de precios", "lista precios", "precios", "catálogo", "catalogo",
-                "precio lista", "lista", "pdf", "archivo", "documento", "precio",
-                "cuanto cuesta", "cuánto cuesta", "precio", "valores", "tarifa"
-            ]
+            logger.debug("Mensaje recibido de %s: %s", phone_number, message_text, extra={"event": "message_text"})
             
-            print(f"🔍 Verificando palabras clave en: '{message_lower}'")
-            print(f"🔍 Palabras clave: {price_list_keywords}")
+            if trace is None:
+                trace = tracing.new_trace("mensaje", phone_number=phone_number, message_id=message_id)
+            trace.mark("queue_wait")
             
-            if any(keyword in message_lower for keyword in price_list_keywords):
-                print("✅ Usuario pidió lista de precios, enviando PDF...")
-                return self.send_price_list_pdf(phone_number)
-            else:
-                print("❌ No se detectaron palabras clave para lista de precios")
-            
-            # Procesar mensaje con IA
-            ai_response = self.ai.generate_response(message_text, phone_number)
+            # Si el cliente manda varios mensajes seguidos, esperar y responder una sola vez
+            # (apagando, el coalescer ya no junta: se responde acá, en el shard del cliente)
+            if self.coalescer and self.coalescer.add(phone_number, (message_text, trace)):
+                return True
             
-            # Enviar respuesta
-            success = self.send_message(phone_number, ai_response)
+            return self._handle_traced(trace, phone_number, message_text)
             
-            if success:
-                print(f"Respuesta enviada a {phone_number}")
-            else:
-                print(f"Error enviando respuesta a {phone_number}")
+        except Exception as e:
+            logger.error("Error procesando mensaje: %s", e)
+            return False
+    
+    def _process_coalesced(self, phone_number: str, items: list) -> bool:
+        """Procesa en una sola respuesta los mensajes agrupados de un cliente"""
+        texts = [text for text, _ in items]
+        if len(texts) > 1:
+            logger.info("Agrupando %d mensajes de %s", len(texts), phone_number)
+        
+        # La traza del primer mensaje representa la espera completa del cliente
+        trace = items[0][1]
+        trace.attrs["merged_messages"] = len(texts)
+        trace.mark("coalesce_wait")
+        for _, other in items[1:]:
+            other.attrs["merged_into"] = trace.id
+            tracing.finish(other)
+        
+        # Volver al shard del cliente para no competir con otra respuesta suya
+        if self.executor:
+            if self.executor.submit(phone_number, self._handle_traced, trace, phone_number, "\n".join(texts)):
+                return True
             
-            return success
+            # Shard lleno o cerrado: el webhook ya respondió 200 y WhatsApp no lo va a reintentar
+            logger.error("No se pudo encolar la respuesta a %s, se responde en este hilo", phone_number)
+            metrics.ERRORS.inc("coalesce_submit")
+        return self._handle_traced(trace, phone_number, "\n".join(texts))
+    
+    def _handle_traced(self, trace: tracing.Trace, phone_number: str, message_text: str) -> bool:
+        """Ejecuta handle_text con la traza del mensaje activa"""
+        with tracing.activate(trace):
+            if self.executor:
+                trace.mark("queue_wait")
+            try:
+                return self.handle_text(phone_number, message_text)
+            finally:
+                tracing.finish(trace)
+    
+    def handle_text(self, phone_number: str, message_text: str) -> bool:
+        """Genera y envía la respuesta para el texto de un cliente"""
+        try:
+            with metrics.stage("process_message"):
+                # Pedido de reserva: se resuelve sin la IA
+                pedido = parse_reservation(message_text) if self.reservations else None
+                if pedido:
+                    metrics.INTENTS.inc("reserva")
+                    return self.handle_reservation(phone_number, *pedido)
+                
+                # Verificar si pide lista de precios
+                if wants_price_list(message_text):
+                    metrics.INTENTS.inc("lista_precios")
+                    logger.info("Usuario pidió lista de precios")
+                    return self.send_price_list_pdf(phone_number)
+                
+                intent = detect_intent(message_text)
+                metrics.INTENTS.inc(intent)
+                
+                # Antes de gastar cuota de la IA: ¿le quedan fichas al cliente y al proceso?
+                limited = self.rate_limiter.acquire(phone_number) if self.rate_limiter else None
+                if limited and self.wait_for_rate_limit(phone_number, *limited):
+                    limited = self.rate_limiter.acquire(phone_number)
+                if limited:
+                    return self.handle_rate_limited(phone_number, message_text, *limited)
+                
+                # Con la IA saturada, los carriles de menor prioridad se responden sin ella
+                admitted = False
+                if self.admission:
+                    lane = admission.lane_for(intent, not self.ai.db.get_recent_turns(phone_number, 1))
+                    if not self.admission.admit(lane):
+                        return self.handle_shed(phone_number, message_text, lane)
+                    admitted = True
+                
+                # Procesar mensaje con IA
+                try:
+                    ai_response = self.ai.generate_response(message_text, phone_number, intent)
+                finally:
+                    if admitted:
+                        self.admission.release()
+                
+                # Enviar respuesta
+                success = self.send_message(phone_number, ai_response)
+                
+                if success:
+                    logger.info("Respuesta enviada a %s", phone_number)
+                else:
+                    logger.error("Error enviando respuesta a %s", phone_number)
+                
+                return success
             
         except Exception as e:
-            print(f"Error procesando mensaje: {str(e)}")
+            logger.error("Error procesando mensaje: %s", e)
+            metrics.ERRORS.inc("process_message")
+            return False
+    
+    def wait_for_rate_limit(self, phone_number: str, scope: str, retry_after: float) -> bool:
+        """En modo "defer", espera la ficha en el shard del cliente; True si hay que volver a intentar"""
+        if not (self.rate_limit_action == "defer" and self.executor and retry_after <= self.rate_limit_max_defer):
             return False
+        
+        metrics.RATE_LIMITED.inc(scope, "defer")
+        logger.info("Límite %s para %s, reintento en %.1fs", scope, phone_number, retry_after)
+        # Se espera sin soltar el shard: los mensajes siguientes del cliente quedan detrás de este
+        if self.executor.sleep(retry_after):
+            return True
+        
+        logger.info("Apagando: sin esperar la ficha de %s", phone_number)
+        return False
+    
+    def handle_rate_limited(self, phone_number: str, message_text: str, scope: str, retry_after: float) -> bool:
+        """Mensaje que superó el límite: se responde sin la IA"""
+        metrics.RATE_LIMITED.inc(scope, "fallback")
+        metrics.FALLBACKS.inc("rate_limit")
+        logger.info("Límite %s para %s, respuesta de respaldo", scope, phone_number)
+        return self.send_message(phone_number, self.ai.get_fallback_response(message_text))
+    
+    def handle_shed(self, phone_number: str, message_text: str, lane: str) -> bool:
+        """Mensaje descartado por carga: respuesta de respaldo sin la IA"""
+        metrics.FALLBACKS.inc("shed")
+        logger.info("IA saturada, respuesta de respaldo a %s (carril %s)", phone_number, lane)
+        return self.send_message(phone_number, self.ai.get_fallback_response(message_text))
+    
+    def reservation_reply(self, phone_number: str, producto_id: int, talla: str, cantidad: int) -> Tuple[str, list]:
+        """Reserva stock para el cliente: (texto, botones para confirmar o liberar; sin botones si no se pudo)"""
+        producto = self.ai.db.get_producto_por_id(producto_id)
+        if not producto:
+            return RESERVATION_ERRORS["producto"], []
+        
+        try:
+            reserva = self.reservations.reserve(phone_number, producto_id, talla, cantidad)
+        except ReservationError as e:
+            return RESERVATION_ERRORS.get(e.code, str(e)), []
+        
+        minutos = max(1, round(self.reservations.ttl / 60))
+        body = (
+            f"Listo, te aparté {reserva['cantidad']} par(es) de {producto['nombre']} "
+            f"talle {reserva['talla']} por {minutos} minutos. ¿Confirmás la compra?"
+        )
+        return body, [
+            (f"{RESERVATION_CONFIRM}:{reserva['id']}", "Confirmar"),
+            (f"{RESERVATION_RELEASE}:{reserva['id']}", "Liberar")
+        ]
+    
+    def handle_reservation(self, phone_number: str, producto_id: int, talla: str, cantidad: int) -> bool:
+        """Reserva stock para el cliente y le manda botones para confirmar o liberar"""
+        body, buttons = self.reservation_reply(phone_number, producto_id, talla, cantidad)
+        if buttons:
+            return self.send_buttons_message(phone_number, body, buttons)
+        return self.send_message(phone_number, body)
+    
+    def reservation_action_text(self, phone_number: str, action: str, reserva_id: str) -> str:
+        """Confirma o libera una reserva desde sus botones; devuelve el texto para el cliente"""
+        if not self.reservations:
+            return QUICK_REPLY_DEFAULT
+        
+        try:
+            if action == RESERVATION_CONFIRM:
+                self.reservations.confirm(reserva_id, phone_number)
+                return "Confirmado 🙌 Te esperamos en el local para retirar y pagar. Cualquier cosa, escribime."
+            self.reservations.release(reserva_id, phone_number)
+            return "Listo, liberé la reserva. Si querés ver otro modelo, decime."
+        except ReservationError as e:
+            return RESERVATION_ERRORS.get(e.code, str(e))
+    
+    def quick_reply_text(self, phone_number: str, button_id: str) -> str:
+        """Respuesta a un botón (reservas, catálogo, info de la tienda); solo toca la base"""
+        action, _, reserva_id = button_id.partition(":")
+        if action in (RESERVATION_CONFIRM, RESERVATION_RELEASE) and reserva_id:
+            return self.reservation_action_text(phone_number, action, reserva_id)
+        
+        if button_id == "catalogo":
+            return self.messages.catalog()
+        
+        if button_id in message_templates.STORE_MESSAGES:
+            return self.messages.store(button_id)
+        
+        # Respuesta genérica para botones no reconocidos
+        return QUICK_REPLY_DEFAULT
     
     def process_quick_reply(self, message_data: Dict[str, Any]) -> bool:
         """Procesa respuestas rápidas (botones)"""
         try:
-            phone_number = message_data.get("from")
-            quick_reply = message_data.get("interactive", {}).get("button_reply", {})
-            button_id = quick_reply.get("id")
-            button_title = quick_reply.get("title")
-            
+            phone_number, button_id = parse_quick_reply(message_data)
             if not phone_number or not button_id:
                 return False
             
-            print(f"Respuesta rápida recibida de {phone_number}: {button_title}")
-            
-            # Procesar según el botón presionado
-            if button_id == "catalogo":
-                products = self.ai.db.get_productos()
-                return self.send_catalog_message(phone_number, products)
-            
-            elif button_id == "tienda_info":
-                return self.send_store_info_message(phone_number)
-            
-            elif button_id == "horarios":
-                tienda_info = self.ai.db.get_tienda_info()
-                message = "🕒 *Horarios de Atención:*\n\n"
-                if 'horarios' in tienda_info:
-                    for dia, horario in tienda_info['horarios'].items():
-                        message += f"• {dia.replace('_', ' ').title()}: {horario}\n"
-                return self.send_message(phone_number, message)
-            
-            elif button_id == "contacto":
-                tienda_info = self.ai.db.get_tienda_info()
-                message = f"""
-📞 *Información de Contacto:*
-
-🏠 *Dirección:* {tienda_info.get('direccion', 'Calle Principal 123, Dolores, Buenos Aires')}
-📞 *Teléfono:* {tienda_info.get('telefono', '+54 9 11 1234-5678')}
-📧 *Email:* {tienda_info.get('email', 'info@zapatillasdolores.com')}
-                """.strip()
-                return self.send_message(phone_number, message)
-            
-            else:
-                # Respuesta genérica para botones no reconocidos
-                return self.send_message(phone_number, "Gracias por tu mensaje. ¿En qué más puedo ayudarte?")
+            return self.send_message(phone_number, self.quick_reply_text(phone_number, button_id))
             
         except Exception as e:
-            print(f"Error procesando respuesta rápida: {str(e)}")
+            logger.error("Error procesando respuesta rápida: %s", e)
             return False
     
     def send_welcome_message(self, phone_number: str) -> bool:
@@ -361,14 +563,14 @@ Soy tu asistente virtual y estoy aquí para ayudarte con:
             return self.send_message(phone_number, message)
             
         except Exception as e:
-            print(f"Error enviando mensaje de bienvenida: {str(e)}")
+            logger.error("Error enviando mensaje de bienvenida: %s", e)
             return False
     
     def verify_webhook(self, mode: str, token: str, challenge: str) -> Optional[str]:
         """Verifica el webhook de WhatsApp"""
         if mode == "subscribe" and token == self.verify_token:
-            print("Webhook verificado exitosamente")
+            logger.info("Webhook verificado exitosamente")
             return challenge
         else:
-            print("Webhook verification failed")
+            logger.warning("Webhook verification failed")
             return None
@@ -0,0 +1,288 @@
+"""
+Escritura diferida (write-behind) con group commit
+
+Las escrituras del camino de respuesta (historial, estados de entrega) se
+encolan y un único hilo escritor por base las guarda con executemany en
+una sola transacción, cuando se junta un lote o pasa el intervalo. Así cada
+respuesta deja de pagar su propio commit (y su fsync). En PostgreSQL el
+executemany va en pipeline: un viaje de ida y vuelta por lote.
+
+- Lectura de lo propio: las filas pendientes se registran con una clave (ej.
+  el teléfono); quien lee esa clave espera a que se guarden con wait_for().
+- Durabilidad: close() y el apagado del proceso vacían la cola antes de salir.
+- Fallas: un lote que no se pudo guardar tras max_retries queda en una cola
+  de reintento y se vuelve a escribir junto con lo siguiente (sin
+  adelantarse, así el orden se mantiene). Mientras tanto wait_for() y
+  flush() devuelven False. Si al cerrar todavía no se puede escribir, las
+  filas van a un archivo de derrame (spill_dir) que el próximo escritor de
+  la misma base vuelve a cargar al arrancar.
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Sequence
+
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+_writers: Dict[str, "WriteBehindBuffer"] = {}
+_writers_lock = threading.Lock()
+
+_STOP = object()
+
+
+class WriteBehindBuffer:
+    """Cola de escrituras con un hilo escritor que hace commits por lote"""
+
+    def __init__(self, db_path, max_batch: int = 500, flush_interval: float = 0.05, max_retries: int = 3,
+                 retry_interval: float = 1.0, spill_dir: Optional[str] = "spill"):
+        # Ruta/URL o un Storage ya abierto
+        self.storage = storage.open_storage(db_path)
+        self.db_path = self.storage.key
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        # Un archivo por base (la URL puede tener la clave: solo se usa su hash)
+        self.spill_path = None
+        if spill_dir:
+            name = hashlib.sha1(self.db_path.encode()).hexdigest()[:16]
+            self.spill_path = os.path.join(spill_dir, f"{name}.jsonl")
+        self._queue: queue.Queue = queue.Queue()
+        # Filas encoladas y todavía no guardadas, por clave
+        self._pending: Dict[Hashable, int] = {}
+        self._enqueued = 0
+        self._committed = 0
+        # Lotes que fallaron y se reintentan (solo los toca el hilo escritor) y sus claves
+        self._retry: list = []
+        self._failed_keys: set = set()
+        self._spilled = 0
+        self._cond = threading.Condition()
+        self._flush_now = threading.Event()
+        self._closed = False
+        self._replay_path = self._claim_spill()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, sql: str, params: Sequence, key: Hashable = None):
+        """Encola una fila; key identifica a quién hay que esperar para leerla"""
+        self.add_many(sql, [params], key)
+
+    def add_many(self, sql: str, rows: List[Sequence], key: Hashable = None):
+        """Encola varias filas de la misma sentencia"""
+        if not rows:
+            return
+
+        with self._cond:
+            if not self._closed:
+                self._enqueued += 1
+                if key is not None:
+                    self._pending[key] = self._pending.get(key, 0) + 1
+                # Dentro del lock: nada puede quedar detrás del aviso de cierre
+                self._queue.put((sql, list(rows), key))
+                return
+
+        # Después de cerrar se escribe directo (no se pierde nada)
+        batch = [(sql, list(rows), key)]
+        if not self._write(batch):
+            self._spill(batch)
+
+    def pending(self) -> int:
+        """Lotes encolados que todavía no se guardaron"""
+        with self._cond:
+            return self._enqueued - self._committed
+
+    def wait_for(self, key: Hashable, timeout: float = 5.0) -> bool:
+        """Espera a que se guarden las filas pendientes de una clave (False si no se pudieron guardar)"""
+        with self._cond:
+            if not self._pending.get(key):
+                return True
+            self._flush_now.set()
+            self._cond.wait_for(lambda: not self._pending.get(key) or key in self._failed_keys, timeout)
+            return not self._pending.get(key)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Espera a que se guarde todo lo encolado hasta ahora (False si algo quedó para reintentar)"""
+        with self._cond:
+            target = self._enqueued
+            if self._committed >= target:
+                return True
+            self._flush_now.set()
+            self._cond.wait_for(lambda: self._committed >= target or self._failed_keys, timeout)
+            return self._committed >= target
+
+    def close(self, timeout: float = None) -> bool:
+        """Guarda todo lo pendiente y detiene el hilo escritor (False si algo fue al archivo de derrame)"""
+        with self._cond:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(_STOP)
+        self._thread.join(timeout)
+        return not self._thread.is_alive() and not self._spilled
+
+    def _run(self):
+        while True:
+            try:
+                # Con lotes para reintentar no se espera indefinidamente
+                item = self._queue.get(timeout=self.retry_interval if self._retry else None)
+            except queue.Empty:
+                item = None
+            stop = item is _STOP
+            batch = [] if stop or item is None else [item]
+            rows = len(batch[0][1]) if batch else 0
+
+            # Juntar hasta completar el lote o hasta que venza el intervalo
+            deadline = time.monotonic() + self.flush_interval
+            while not stop and rows < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if self._flush_now.is_set():
+                    remaining = 0
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                rows += len(item[1])
+
+            self._flush_now.clear()
+
+            # Lo que falló antes va primero y en la misma transacción
+            batch = self._retry + batch
+            if batch:
+                if self._write(batch):
+                    self._retry = []
+                    self._done(batch)
+                    self._forget_replay()
+                else:
+                    self._retry = batch
+                    self._failed(batch)
+
+            if stop:
+                # Quedan pendientes (y en _failed_keys): wait_for y flush siguen dando False
+                if self._retry:
+                    self._spill(self._retry)
+                    self._forget_replay()
+                return
+
+    def _write(self, batch: list) -> bool:
+        """Guarda el lote en una sola transacción, agrupando por sentencia"""
+        grouped: Dict[str, List[Sequence]] = {}
+        for sql, rows, _ in batch:
+            grouped.setdefault(sql, []).extend(rows)
+
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with metrics.stage("db_flush"):
+                    conn = self.storage.connect(timeout=30)
+                    try:
+                        with conn:
+                            for sql, rows in grouped.items():
+                                conn.executemany(sql, rows)
+                    finally:
+                        conn.close()
+                return True
+            except self.storage.errors as e:
+                logger.error("Error guardando lote (intento %s/%s): %s", attempt, self.max_retries, e)
+                metrics.ERRORS.inc("db_writer")
+                time.sleep(0.1 * attempt)
+
+        logger.error("No se pudieron guardar %s filas tras %s intentos; quedan para reintentar", sum(len(rows) for rows in grouped.values()), self.max_retries)
+        return False
+
+    def _failed(self, batch: list):
+        """Despierta a quienes esperan filas del lote: no se guardaron"""
+        with self._cond:
+            self._failed_keys.update(key for _, _, key in batch)
+            self._cond.notify_all()
+
+    def _done(self, batch: list):
+        with self._cond:
+            self._failed_keys.clear()
+            self._committed += len(batch)
+            for _, _, key in batch:
+                if key is None:
+                    continue
+                count = self._pending.get(key, 0) - 1
+                if count > 0:
+                    self._pending[key] = count
+                else:
+                    self._pending.pop(key, None)
+            self._cond.notify_all()
+
+    def _spill(self, batch: list):
+        """Guarda en el archivo de derrame lo que no se pudo escribir en la base"""
+        rows = sum(len(item[1]) for item in batch)
+        self._spilled += rows
+        if not self.spill_path:
+            logger.error("Se perdieron %s filas: la base no responde y no hay archivo de derrame", rows)
+            return
+
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for sql, item_rows, _ in batch:
+                f.write(json.dumps({"sql": sql, "rows": item_rows}, ensure_ascii=False, default=str) + "\n")
+        logger.error("%s filas que no se pudieron guardar quedaron en %s", rows, self.spill_path)
+
+    def _claim_spill(self) -> Optional[str]:
+        """Carga para reintentar lo derramado por un escritor anterior de esta base"""
+        if not self.spill_path:
+            return None
+
+        # El rename lo gana un solo proceso aunque arranquen varios workers juntos
+        claimed = f"{self.spill_path}.{os.getpid()}"
+        try:
+            os.rename(self.spill_path, claimed)
+        except FileNotFoundError:
+            return None
+
+        with open(claimed, encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        self._retry = [(line["sql"], line["rows"], None) for line in lines]
+        self._enqueued += len(self._retry)
+        logger.warning("Reintentando %s lotes del archivo de derrame %s", len(self._retry), self.spill_path)
+        return claimed
+
+    def _forget_replay(self):
+        # Lo cargado del archivo ya está en la base (o volvió a derramarse)
+        if self._replay_path:
+            os.remove(self._replay_path)
+            self._replay_path = None
+
+
+def get_writer(db_path, **kwargs) -> WriteBehindBuffer:
+    """Un único escritor por base de datos (ruta/URL o Storage)"""
+    target = storage.open_storage(db_path)
+    with _writers_lock:
+        writer = _writers.get(target.key)
+        if writer is None:
+            writer = WriteBehindBuffer(target, **kwargs)
+            _writers[target.key] = writer
+            metrics.DB_WRITE_PENDING.set_function(_total_pending)
+        return writer
+
+
+def close_all(timeout: Optional[float] = None) -> bool:
+    """Vacía y cierra todos los escritores (al apagar)"""
+    with _writers_lock:
+        writers = list(_writers.values())
+    return all([writer.close(timeout) for writer in writers])
+
+
+def _total_pending() -> int:
+    with _writers_lock:
+        writers = list(_writers.values())
+    return sum(writer.pending() for writer in writers)
+
+
+atexit.register(close_all)